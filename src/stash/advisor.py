@@ -0,0 +1,97 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+
+"""
+An advisor which suggests indexes for the fields of a stash.
+
+The advisor looks at the plan which sqlite chooses for each query made
+by find_files.  When the plan scans the whole files table while the
+query compares a field with a value, or sorts the results with a
+temporary b-tree while the query orders them by a field, the field is
+counted as one which an index would have helped.  Fields whose counts
+reach a threshold are proposed for indexing.
+"""
+
+import re
+from collections import Counter, deque
+
+# Comparisons which can use an index.  Like patterns cannot, unless
+# they are case sensitive prefixes, which the viewer never makes.
+comparison = r'''(?:=|==|<|>|<=|>=|!=|\bbetween\b|\bin\b|\bis\b)'''
+
+def _name_pattern(name):
+    name = re.escape(name)
+    return r'''(?:"%s"|`%s`|\[%s\]|\b%s\b)'''%(name, name, name, name)
+
+class IndexAdvisor:
+    """
+    Collects the query plans of searches and counts, for each field,
+    the searches which would have used an index on it.  The most recent
+    plans are kept in log, as (query, plan) pairs.
+    """
+    def __init__(self, threshold=20, log_size=100):
+        self.threshold = threshold
+        self.counts = Counter()
+        self.log = deque(maxlen=log_size)
+
+    def observe(self, connection, query, fields, parameters=()):
+        """
+        Explain a query and count the fields in it which an index would
+        have helped.  Returns the list of those fields.
+        """
+        # An explained statement never checks the schema, so read from
+        # sqlite_master to load any indexes made by other connections,
+        # and name the version so that no plan cached before a change
+        # of the schema is reused.
+        connection.execute('select count(*) from sqlite_master').fetchone()
+        version = connection.execute('pragma schema_version').fetchone()[0]
+        plan = [row[-1] for row in connection.execute(
+            'explain query plan %s\n-- schema %d'%(query, version),
+            parameters).fetchall()]
+        self.log.append((query, plan))
+        scans = any(re.match(r'SCAN (files|TABLE files)\b', step)
+                    for step in plan)
+        sorts = 'USE TEMP B-TREE FOR ORDER BY' in plan
+        match = re.search(r'\border\s+by\b', query, re.I)
+        if match:
+            where, order_by = query[:match.start()], query[match.end():]
+        else:
+            where, order_by = query, ''
+        helped = []
+        for field in fields:
+            name = _name_pattern(field)
+            if scans and re.search(name + r'\s*' + comparison, where, re.I):
+                helped.append(field)
+            elif sorts and re.match(r'\s*' + name, order_by, re.I):
+                helped.append(field)
+        self.counts.update(helped)
+        return helped
+
+    def proposals(self, indexed=()):
+        """
+        Return the fields which have reached the threshold and are not
+        indexed, most often used first.
+        """
+        return [field for field, count in self.counts.most_common()
+                if count >= self.threshold and field not in indexed]
@@ -191,6 +191,8 @@ class StashViewer():
         File_menu.add_command(label='New...'+scut['New'], command=self.app.new)
         
         Action_menu.add_command(label='Import...', command=self.import_file)
+        Action_menu.add_command(label='Import Folder...',
+                                command=self.import_folder)
         Action_menu.add_command(label='Export...', command=self.export_file)
         Action_menu.add_command(label='Remove...', command=self.remove_file)
         Action_menu.add_command(label='Metadata...', command=self.metadata)
@@ -336,15 +338,9 @@ class StashViewer():
             if self.keyword_vars[k].get()]
         for column in self.columns:
             filter = self.filters[column].get()
-            if not filter:
-                continue
-            terms = filter.split()
-            for term in terms:
-                filters.append("%s like '%%%s%%'"%(column, term))
-        if not filters:
-            where_clause = '1' + order_by
-        else:
-            where_clause = ' and '.join(filters) + order_by
+            for term in filter.split():
+                filters.append((column, term))
+        where_clause = self.stash.match_clause(filters) + order_by
         return where_clause, selected_keywords
 
     def match(self, event=None):
@@ -355,7 +351,7 @@ class StashViewer():
     def clear_status(self):
         self.status.set('')
 
-    def import_file(self):# Could accept many files?
+    def import_file(self):
         self.status.set('Import file.')
         filename = askopenfilename(title='Choose a file to import',
                                        filetypes=[('All files', '*')])
@@ -386,12 +382,44 @@ class StashViewer():
             time.sleep(1)
             subprocess.call(['xattr', '-c', filename])
         try:
-            self.stash.insert_file(filename, dialog.result, hash_string)
+            self.stash.insert_file(filename, dialog.result, hash_string,
+                                   single_pass=True)
         except StashError as E:
             showerror('Import File', E.value)
         self.status.set('')
         self.match()
 
+    def import_folder(self):
+        self.status.set('Import folder.')
+        directory = askdirectory(parent=self.window, mustexist=True,
+                                 initialdir=self.curdir,
+                                 title='Choose a folder to import')
+        if directory is None or directory == '':
+            self.status.set('Import cancelled.')
+            self.window.after(1000, self.clear_status)
+            return
+        self.curdir = directory
+        metadata = OrderedDict([(x, '') for x in self.columns])
+        dialog = MetadataEditor(self.window, metadata, self.stash.keywords,
+                                    'Metadata for All Files')
+        if dialog.result is None:
+            self.status.set('Import cancelled')
+            self.window.after(1000, self.clear_status)
+            return
+        self.status.set('Importing %s ...'%directory)
+        self.window.update_idletasks()
+        try:
+            report = self.stash.import_tree(directory, dialog.result)
+        except StashError as E:
+            showerror('Import Folder', E.value)
+            return
+        if report.errors:
+            showwarning('Import Folder', '\n'.join(
+                [repr(result) for result in report.errors[:20]]))
+        self.status.set('%d imported, %d duplicates, %d errors.'%(
+            len(report.imported), len(report.duplicates), len(report.errors)))
+        self.match()
+
     def export_file(self, index=None):
         self.status.set('Exporting file.')
         if index is None:
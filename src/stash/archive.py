@@ -0,0 +1,107 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+
+"""
+Reading the files in zip and tar archives without extracting them.
+"""
+
+import os
+import lzma
+import zlib
+import tarfile
+import zipfile
+
+# The exceptions which may be raised while reading a damaged archive.
+read_errors = (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError,
+               zlib.error, lzma.LZMAError)
+
+class Archive:
+    """
+    The regular files in a zip or tar archive.  Members are named by
+    their paths in the archive.  The members of a zip archive can be
+    read concurrently by several threads, so parallel is True for zip
+    archives.  The members of a tar archive are read in order, which
+    for a compressed tar archive is the only efficient way.
+    """
+    def __init__(self, path):
+        self.path = path
+        if zipfile.is_zipfile(path):
+            self.zip, self.tar = zipfile.ZipFile(path), None
+            self.parallel = True
+        elif tarfile.is_tarfile(path):
+            self.zip, self.tar = None, tarfile.open(path, 'r:*')
+            self.parallel = False
+        else:
+            raise ValueError('%s is not a zip or tar archive.'%path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def members(self):
+        """
+        Generate a triple (name, size, info) for each regular file in
+        the archive, in the order in which they are stored.  The info
+        is a ZipInfo or TarInfo which can be passed to open.
+        """
+        if self.zip:
+            for info in self.zip.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, info
+        else:
+            for info in self.tar:
+                if info.isreg():
+                    yield info.name, info.size, info
+
+    def open(self, member):
+        """
+        Return a binary file object for reading a member, which is
+        given by its name or its info.
+        """
+        if self.zip:
+            return self.zip.open(member)
+        return self.tar.extractfile(member)
+
+    def read(self, name):
+        """
+        Return the content of a member.  Raises KeyError if there is no
+        such member.  For a compressed tar archive this may require
+        reading the archive up to the member.
+        """
+        with self.open(name) as infile:
+            return infile.read()
+
+    def close(self):
+        if self.zip:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+def member_filename(name):
+    """
+    Return the file name of a member, without its directory.
+    """
+    return os.path.basename(name.rstrip('/'))
@@ -0,0 +1,122 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+
+"""
+In-memory bitmaps of the files which have each keyword.
+
+A bitmap is a Python int whose bit n is set when the file with _file_id
+n has the keyword.  File ids are assigned consecutively, so this is a
+compact representation, and the int operations &, | and & ~ compute
+AND, OR and NOT queries at C speed.  Bitmaps are loaded from the
+keyword_x_file table the first time a keyword is used in a query, and
+are then kept up to date as keywords are added to and removed from
+files.  Changes committed through other connections are noticed by
+checking the data_version pragma, which discards the loaded bitmaps.
+"""
+
+def from_ids(ids):
+    """
+    Return the bitmap with the bits in an iterable of ints set.
+    """
+    data = bytearray()
+    for n in ids:
+        index = n >> 3
+        if index >= len(data):
+            data.extend(bytes(index + 1 - len(data) + len(data)//2))
+        data[index] |= 1 << (n & 7)
+    return int.from_bytes(data, 'little')
+
+def members(bitmap):
+    """
+    Generate the numbers of the set bits of a bitmap, in order.
+    """
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    for index, byte in enumerate(data):
+        if byte:
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield index << 3 | bit
+
+def count(bitmap):
+    return bin(bitmap).count('1')
+
+class KeywordBitmaps:
+    """
+    The bitmaps of the keywords of a stash, by keyword id.  The caller
+    must hold the write lock of the database when loading or updating
+    them, since they are read through the writer.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self._bitmaps = {}
+        self._version = None
+
+    def bitmap(self, keyword_id):
+        """
+        Return the bitmap of the files which have a keyword.
+        """
+        bitmap = self._bitmaps.get(keyword_id)
+        if bitmap is None:
+            query = 'select _file_id from keyword_x_file where _keyword_id=?'
+            rows = self.connection.execute(query, (keyword_id,))
+            bitmap = self._bitmaps[keyword_id] = from_ids(
+                row[0] for row in rows)
+        return bitmap
+
+    def refresh(self):
+        """
+        Discard the loaded bitmaps if another connection, in this or
+        another process, has committed a change to the database since
+        the last refresh.  The data_version pragma does not change when
+        our own connection commits, and our own changes are applied by
+        update.
+        """
+        version = self.connection.execute('pragma data_version').fetchone()[0]
+        if version != self._version:
+            self._bitmaps = {}
+            self._version = version
+
+    def update(self, added, removed):
+        """
+        Apply lists of (file_id, keyword_id) pairs which were added to
+        or removed from keyword_x_file to the loaded bitmaps.
+        """
+        bitmaps = self._bitmaps
+        for file_id, keyword_id in added:
+            if keyword_id in bitmaps:
+                bitmaps[keyword_id] |= 1 << file_id
+        for file_id, keyword_id in removed:
+            if keyword_id in bitmaps:
+                bitmaps[keyword_id] &= ~(1 << file_id)
+
+    def remove_file(self, file_id):
+        mask = ~(1 << file_id)
+        for keyword_id in self._bitmaps:
+            self._bitmaps[keyword_id] &= mask
+
+    def forget(self, keyword_id):
+        self._bitmaps.pop(keyword_id, None)
+
+    def clear(self):
+        self._bitmaps = {}
@@ -0,0 +1,160 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Support for importing many files into a stash at once.
+"""
+
+import os
+import time
+from collections import Counter
+
+class ImportResult:
+    """
+    The outcome of importing one file.  The status is one of
+    'imported', 'duplicate' or 'error'.  The strategy is the way that
+    an imported file was copied into the stash.
+    """
+    def __init__(self, path, hash_string=None, status='imported',
+                     size=0, error=None, strategy=None):
+        self.path = path
+        self.hash_string = hash_string
+        self.status = status
+        self.size = size
+        self.error = error
+        self.strategy = strategy
+
+    def __repr__(self):
+        if self.error:
+            return '%s: %s (%s)'%(self.path, self.status, self.error)
+        return '%s: %s %s'%(self.path, self.status, self.hash_string)
+
+class ImportBatch:
+    """
+    The database rows for a batch of imported files, which are collected
+    while the objects are stored and are then written in one short
+    transaction.
+    """
+    def __init__(self):
+        self.files = []
+        self.objects = []
+        # Staged references to records of the packed and chunk stores,
+        # and the rows of the chunk manifests.
+        self.packed = {}
+        self.chunks = {}
+        self.manifests = []
+        # Metadata for set_fields_many.
+        self.metadata = []
+        # Rows for the sync_manifest table.
+        self.synced = []
+
+class ImportReport:
+    """
+    Per-file results and throughput statistics for a bulk import.
+    """
+    def __init__(self):
+        self.results = []
+        # The number of files skipped by a sync because they had not
+        # changed.
+        self.unchanged = 0
+        self.start = time.time()
+        self.finish = None
+
+    def __repr__(self):
+        return ('%d imported, %d duplicates, %d errors in %.1f s '
+                '(%.1f files/s, %.1f MB/s)')%(
+                    len(self.imported), len(self.duplicates),
+                    len(self.errors), self.elapsed,
+                    self.files_per_second(), self.bytes_per_second() / 1.0e6)
+
+    def add(self, result):
+        self.results.append(result)
+
+    def done(self):
+        self.finish = time.time()
+
+    def _select(self, status):
+        return [r for r in self.results if r.status == status]
+
+    @property
+    def imported(self):
+        return self._select('imported')
+
+    @property
+    def duplicates(self):
+        return self._select('duplicate')
+
+    @property
+    def errors(self):
+        return self._select('error')
+
+    @property
+    def elapsed(self):
+        finish = self.finish if self.finish else time.time()
+        return finish - self.start
+
+    @property
+    def bytes(self):
+        """
+        The number of bytes processed, including duplicates.
+        """
+        return sum(r.size for r in self.results)
+
+    def strategies(self):
+        """
+        Return a Counter showing how the imported files were copied.
+        """
+        return Counter(r.strategy for r in self.imported)
+
+    def files_per_second(self):
+        elapsed = self.elapsed
+        return len(self.results) / elapsed if elapsed else 0.0
+
+    def bytes_per_second(self):
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed else 0.0
+
+def walk_files(path):
+    """
+    Generate the pathnames of all regular files below a directory, in
+    a stable order.  Symbolic links are not followed.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            pathname = os.path.join(dirpath, filename)
+            if os.path.isfile(pathname) and not os.path.islink(pathname):
+                yield pathname
+
+def batches(iterable, size):
+    """
+    Generate lists of at most size items from an iterable.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
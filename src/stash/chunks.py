@@ -0,0 +1,233 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Deduplicating storage of objects as content-defined chunks.
+
+An object is cut into chunks at positions chosen by a hash of a sliding
+window of its content, so an insertion or deletion near the start of a
+file only changes the chunks around it.  Each distinct chunk is stored
+once, in a pack file, and is named by its blake2b hash.  The chunk
+manifest of an object lists its chunks in order, and each chunk has a
+reference count which is the number of times it appears in manifests.
+"""
+
+import io
+import os
+import re
+import zlib
+import hashlib
+from .hashing import encode
+from .packs import PackStore
+
+# Chunk boundaries are only considered just after an anchor byte, one
+# whose low six bits are 100101, which can be found by the re module
+# without a Python loop over the data.  In random data one byte in 64 is
+# an anchor, and in text the letter e is.  These must never change, since
+# the chunk boundaries of stored objects depend on them.
+ANCHORS = re.compile(rb'[\x25\x65\xa5\xe5]')
+WINDOW = 48
+
+class Chunker:
+    """
+    Content-defined chunking.  A chunk ends after the first anchor byte,
+    at least min_size bytes into it, for which the low bits of the crc32
+    of the WINDOW bytes ending with the anchor are all zero.  Since this
+    only depends on the nearby content, an insertion or deletion only
+    moves the boundaries close to it.  For random data the average
+    chunk size is about min_size + avg_size.  No chunk is longer than
+    max_size.
+    """
+    def __init__(self, min_size=16384, avg_size=65536, max_size=262144):
+        if not WINDOW <= min_size < max_size:
+            raise ValueError('The minimum chunk size must be less than the '
+                             'maximum.')
+        self.mask = (1 << max(0, avg_size.bit_length() - 7)) - 1
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def cut(self, data, start):
+        """
+        Return the end of the chunk of data which begins at start.
+        """
+        end = min(len(data), start + self.max_size)
+        mask, crc32 = self.mask, zlib.crc32
+        for match in ANCHORS.finditer(data, start + self.min_size, end):
+            n = match.end()
+            if not crc32(data[n - WINDOW:n]) & mask:
+                return n
+        return end
+
+    def chunks(self, infile):
+        """
+        Generate the chunks of the data read from a binary file object.
+        """
+        data, start = b'', 0
+        while True:
+            block = infile.read(4 * self.max_size)
+            data = data[start:] + block
+            start = 0
+            while len(data) - start >= self.max_size or (
+                    not block and start < len(data)):
+                end = self.cut(data, start)
+                yield data[start:end]
+                start = end
+            if not block:
+                return
+
+def chunk_key(chunk):
+    """
+    Return the name of a chunk.
+    """
+    return encode(hashlib.blake2b(chunk, digest_size=20))
+
+class ChunkStore:
+    """
+    Objects stored as chunk manifests, with the chunks in pack files in
+    the directory .chunks of a stash tree.  The caller is responsible
+    for committing.
+    """
+    def __init__(self, root, connection, chunker=None):
+        self.connection = connection
+        self.chunker = chunker or Chunker()
+        self.packs = PackStore(os.path.join(root, '.chunks'), connection,
+                                   'chunks')
+
+    def store(self, hash_string, filename):
+        """
+        Store a file as the object with the given hash.  Returns the
+        number of bytes which were written to pack files, which is less
+        than the size of the file when some of its chunks were already
+        stored.
+        """
+        records, manifests = {}, []
+        written = self.stage(hash_string, filename, records, manifests)
+        self.apply(records, manifests)
+        return written
+
+    def stage(self, hash_string, filename, records, manifests):
+        """
+        Store the chunks of a file, as store does, without writing to
+        the database.  The references to the chunks are recorded in the
+        dict records, as by PackStore.stage, and the rows of the chunk
+        manifest are appended to the list manifests.  The caller passes
+        both to apply.  Neither is changed if the file cannot be read.
+        """
+        staged, rows, written = {}, [], 0
+        with open(filename, 'rb') as infile:
+            for seq, chunk in enumerate(self.chunker.chunks(infile)):
+                key = chunk_key(chunk)
+                if key in records:
+                    staged.setdefault(key, [None, None, None, 0])[3] += 1
+                elif self.packs.stage(key, chunk, staged):
+                    written += len(chunk)
+                rows.append((hash_string, seq, key))
+        for key, entry in staged.items():
+            if key in records:
+                records[key][3] += entry[3]
+            else:
+                records[key] = entry
+        manifests.extend(rows)
+        return written
+
+    def apply(self, records, manifests):
+        """
+        Write the records and manifest rows collected by stage to the
+        database, without committing.
+        """
+        self.packs.apply(records)
+        self.connection.executemany(
+            'insert into object_chunks (hash, seq, chunk) values (?, ?, ?)',
+            manifests)
+
+    def locations(self, hash_string):
+        """
+        Return a list of the (pack, offset, length) triples of the chunks
+        of an object, in order.  Raises KeyError if a chunk is missing.
+        """
+        query = """select object_chunks.chunk, chunks.pack, chunks.offset,
+                   chunks.length from object_chunks left join chunks
+                   on object_chunks.chunk=chunks.key
+                   where object_chunks.hash=? order by object_chunks.seq"""
+        rows = self.connection.execute(query, (hash_string,)).fetchall()
+        for key, pack, offset, length in rows:
+            if pack is None:
+                raise KeyError(key)
+        return [row[1:] for row in rows]
+
+    def open(self, hash_string):
+        """
+        Return a buffered binary file object for reading an object.
+        Raises KeyError if one of its chunks is missing.
+        """
+        return io.BufferedReader(ChunkReader(self.packs,
+                                             self.locations(hash_string)))
+
+    def delete(self, hash_string):
+        """
+        Remove the manifest of an object and release its chunks.
+        """
+        query = 'select chunk from object_chunks where hash=?'
+        for key, in self.connection.execute(query,
+                (hash_string,)).fetchall():
+            self.packs.release(key)
+        self.connection.execute('delete from object_chunks where hash=?',
+                                (hash_string,))
+
+    def rename(self, old_hash, new_hash):
+        self.connection.execute(
+            'update object_chunks set hash=? where hash=?',
+            (new_hash, old_hash))
+
+    def close(self):
+        self.packs.close()
+
+class ChunkReader(io.RawIOBase):
+    """
+    A raw binary stream which reads a sequence of records from a
+    PackStore, one at a time.
+    """
+    def __init__(self, packs, locations):
+        self.packs = packs
+        self.locations = iter(locations)
+        self.current = b''
+        self.position = 0
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def readinto(self, buffer):
+        while self.position >= len(self.current):
+            location = next(self.locations, None)
+            if location is None:
+                return 0
+            self.current, self.position = self.packs.read(*location), 0
+        count = min(len(buffer), len(self.current) - self.position)
+        buffer[:count] = self.current[self.position:self.position + count]
+        self.position += count
+        self.offset += count
+        return count
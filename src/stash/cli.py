@@ -0,0 +1,293 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Maintenance commands which can be run from a terminal, e.g.
+
+    stash reshard <stash> --depth 2 --width 2
+
+Running stash with no command starts the GUI.
+"""
+
+import sys
+import time
+import argparse
+from .stash import Stash, StashError
+from .compression import codecs, parse_rules
+from .hashing import configure
+
+def open_stash(dirname):
+    stash = Stash()
+    stash.open(dirname)
+    return stash
+
+def reshard(args):
+    stash = open_stash(args.stash)
+    try:
+        if args.depth is None and args.width is None:
+            layout = None
+        else:
+            depth, width = stash.tree.layout
+            layout = (args.depth or depth, args.width or width)
+        count = stash.reshard(layout)
+        print('Moved %d objects.  The layout is now %d,%d.'%(
+            count, *stash.tree.layout))
+    finally:
+        stash.close()
+
+def scrub(args):
+    if args.block_size:
+        configure(block_size=int(args.block_size * (1 << 20)))
+    stash = open_stash(args.stash)
+    def show(hash_string, status, detail):
+        if status != 'ok':
+            print('%s: %s %s'%(status, hash_string, detail))
+    try:
+        bandwidth = args.bandwidth * 1.0e6 if args.bandwidth else None
+        report = stash.scrub(workers=args.workers, bandwidth=bandwidth,
+                             restart=args.restart, callback=show)
+        for path in report.orphaned:
+            print('orphaned: %s'%path)
+        print(report)
+    finally:
+        stash.close()
+    if not report.clean:
+        sys.exit(2)
+
+def gc(args):
+    stash = open_stash(args.stash)
+    try:
+        report = stash.collect_garbage(dry_run=args.dry_run,
+                                       grace=args.grace)
+        if args.dry_run:
+            for path in report.orphaned + report.temporary:
+                print(path)
+        print(report)
+    finally:
+        stash.close()
+
+def sync(args):
+    if args.block_size:
+        configure(block_size=int(args.block_size * (1 << 20)))
+    stash = open_stash(args.stash)
+    try:
+        value_dict = {'keywords': []}
+        for assignment in args.set:
+            name, _, value = assignment.partition('=')
+            value_dict[name] = value
+        if args.hash_cache:
+            stash.use_hash_cache(shared=True)
+        while True:
+            report = stash.sync(args.source, value_dict, workers=args.workers)
+            for result in report.errors:
+                print(result, file=sys.stderr)
+            print('%s; %d unchanged.'%(report, report.unchanged))
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    finally:
+        stash.close()
+
+def import_archive(args):
+    stash = open_stash(args.stash)
+    try:
+        value_dict = {'keywords': []}
+        for assignment in args.set:
+            name, _, value = assignment.partition('=')
+            value_dict[name] = value
+        report = stash.import_archive(args.archive, value_dict,
+            manifest=args.manifest, workers=args.workers)
+        for result in report.errors:
+            print(result, file=sys.stderr)
+        print(report)
+    finally:
+        stash.close()
+
+def storage(args):
+    stash = open_stash(args.stash)
+    try:
+        if args.storage:
+            stash.set_storage(args.storage)
+        print('New files use %s storage.'%stash.storage)
+    finally:
+        stash.close()
+
+def compression(args):
+    stash = open_stash(args.stash)
+    try:
+        if args.codec or args.rule:
+            codec = args.codec if args.codec != 'none' else None
+            if not args.codec:
+                codec = stash.compression
+            rules = dict(stash.compression_rules)
+            rules.update(parse_rules(','.join(args.rule)))
+            stash.set_compression(codec, rules)
+        print('New files are compressed with %s.'%(
+            stash.compression or 'nothing'))
+        for extension, codec in sorted(stash.compression_rules.items()):
+            print('  %s: %s'%(extension, codec or 'none'))
+    finally:
+        stash.close()
+
+def pack(args):
+    stash = open_stash(args.stash)
+    try:
+        if args.threshold is not None:
+            stash.set_pack_threshold(args.threshold)
+        if not stash.pack_threshold:
+            print('Packing is turned off.')
+            return
+        count = stash.pack_objects()
+        print('Packed %d objects.  Objects smaller than %d bytes are '
+              'packed.'%(count, stash.pack_threshold))
+    finally:
+        stash.close()
+
+def hot_cache(args):
+    stash = open_stash(args.stash)
+    try:
+        if args.size is not None:
+            stash.set_hot_cache(int(args.size * (1 << 30)), args.dir)
+        hot = stash.tree.hot
+        if hot is None:
+            print('The hot cache is turned off.')
+            return
+        print('The hot cache in %s holds %.1f of at most %.1f GB.'%(
+            hot.directory, hot.usage() / (1 << 30), hot.max_bytes / (1 << 30)))
+    finally:
+        stash.close()
+
+parser = argparse.ArgumentParser(prog='stash',
+    description='Maintain a stash.  With no command, start the GUI.')
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+command = subparsers.add_parser('reshard',
+    help='change the directory layout of a stash, or resume a change')
+command.add_argument('stash')
+command.add_argument('--depth', type=int,
+    help='the number of levels of directories')
+command.add_argument('--width', type=int,
+    help='the number of hash characters in each directory name')
+command.set_defaults(func=reshard)
+
+command = subparsers.add_parser('scrub',
+    help='check that the files in a stash are intact')
+command.add_argument('stash')
+command.add_argument('--workers', type=int,
+    help='the number of processes which rehash files')
+command.add_argument('--bandwidth', type=float,
+    help='the maximum read rate, in MB per second')
+command.add_argument('--restart', action='store_true',
+    help='start over instead of resuming an interrupted scrub')
+command.add_argument('--block-size', type=float,
+    help='the size of each read, in MB (default 4)')
+command.set_defaults(func=scrub)
+
+command = subparsers.add_parser('gc',
+    help='remove orphaned objects, temporary files and dangling records')
+command.add_argument('stash')
+command.add_argument('--dry-run', action='store_true',
+    help='only report what would be removed')
+command.add_argument('--grace', type=float, default=3600,
+    help='ignore files modified within this many seconds (default 3600)')
+command.set_defaults(func=gc)
+
+command = subparsers.add_parser('sync',
+    help='import the new and changed files in a folder')
+command.add_argument('source')
+command.add_argument('stash')
+command.add_argument('--set', action='append', default=[],
+    metavar='FIELD=VALUE', help='a metadata value for the imported files')
+command.add_argument('--workers', type=int,
+    help='the number of processes which hash files')
+command.add_argument('--interval', type=float,
+    help='keep running, syncing again after this many seconds')
+command.add_argument('--hash-cache', action='store_true',
+    help="use the user's shared cache of file hashes")
+command.add_argument('--block-size', type=float,
+    help='the size of each read, in MB (default 4)')
+command.set_defaults(func=sync)
+
+command = subparsers.add_parser('import-archive',
+    help='import the files in a zip or tar archive without extracting it')
+command.add_argument('archive')
+command.add_argument('stash')
+command.add_argument('--set', action='append', default=[],
+    metavar='FIELD=VALUE', help='a metadata value for the imported files')
+command.add_argument('--manifest', metavar='MEMBER',
+    help='a JSON file in the archive with metadata for each member')
+command.add_argument('--workers', type=int,
+    help='the number of threads which read a zip archive')
+command.set_defaults(func=import_archive)
+
+command = subparsers.add_parser('storage',
+    help='show or choose how new files are stored')
+command.add_argument('stash')
+command.add_argument('storage', nargs='?', choices=Stash.storages,
+    help='tree: one file per object; chunks: deduplicated chunks')
+command.set_defaults(func=storage)
+
+command = subparsers.add_parser('compression',
+    help='show or choose how new files are compressed')
+command.add_argument('stash')
+command.add_argument('codec', nargs='?', choices=codecs + ('none',),
+    help='the codec for files which have no rule')
+command.add_argument('--rule', action='append', default=[],
+    metavar='.EXT=CODEC', help='the codec, or none, for an extension')
+command.set_defaults(func=compression)
+
+command = subparsers.add_parser('pack',
+    help='store small files in pack files')
+command.add_argument('stash')
+command.add_argument('--threshold', type=int,
+    help='pack files smaller than this many bytes; 0 turns packing off')
+command.set_defaults(func=pack)
+
+command = subparsers.add_parser('hot-cache',
+    help='keep recently used files in a cache on a fast disk')
+command.add_argument('stash')
+command.add_argument('--size', type=float,
+    help='the size of the cache, in GB; 0 turns the cache off')
+command.add_argument('--dir',
+    help='the directory of the cache (default: in your cache directory)')
+command.set_defaults(func=hot_cache)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in subparsers.choices and argv[0] not in (
+            '-h', '--help'):
+        from .app import main as app_main
+        return app_main()
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except StashError as E:
+        print('Stash Error:', E.value, file=sys.stderr)
+        sys.exit(1)
+    except ValueError as E:
+        print('Stash Error:', E, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Compression codecs for objects stored in the tree.
+
+An object is compressed as a single zlib, bz2 or lzma stream and keeps
+its usual name, with the codec recorded in the objects table.  Files
+whose extensions indicate that they are already compressed are stored
+as they are unless a rule for the extension says otherwise.
+"""
+
+import io
+import bz2
+import lzma
+import zlib
+
+codecs = ('zlib', 'bz2', 'lzma')
+
+incompressible = frozenset("""
+    .7z .aac .apk .avi .bz2 .docx .epub .flac .gif .gz .heic .jar .jpeg
+    .jpg .lzma .m4a .m4v .mkv .mov .mp3 .mp4 .odp .ods .odt .ogg .opus .pdf
+    .png .pptx .rar .tbz .tgz .txz .webm .webp .xlsx .xz .zip .zst
+    """.split())
+
+def check_codec(codec):
+    """
+    Raise ValueError if the codec name is not valid.
+    """
+    if codec not in codecs:
+        raise ValueError('Unknown codec %s.'%codec)
+    return codec
+
+def new_compressor(codec):
+    check_codec(codec)
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+    elif codec == 'bz2':
+        return bz2.BZ2Compressor(9)
+    return lzma.LZMACompressor()
+
+def parse_rules(rules):
+    """
+    Convert rules given as a string '.csv=lzma,.jpg=none' into a dict
+    mapping lower case extensions to a codec or None.
+    """
+    if not isinstance(rules, str):
+        return {ext.lower(): codec for ext, codec in (rules or {}).items()}
+    result = {}
+    for rule in rules.split(','):
+        if rule:
+            extension, _, codec = rule.partition('=')
+            result[extension.lower()] = None if codec == 'none' else codec
+    return result
+
+def format_rules(rules):
+    return ','.join('%s=%s'%(ext, codec or 'none')
+                    for ext, codec in sorted(rules.items()))
+
+def choose_codec(extension, default, rules):
+    """
+    Return the codec to use for a file with the given extension, or None
+    if it should not be compressed.
+    """
+    extension = extension.lower()
+    if extension in rules:
+        return rules[extension]
+    if extension in incompressible:
+        return None
+    return default
+
+class DecompressingReader(io.RawIOBase):
+    """
+    A raw binary stream which decompresses a compressed binary file
+    object as it is read.  Decompressed data is produced at most
+    BLOCK_SIZE bytes at a time, so memory use is bounded however well
+    the data was compressed.
+    """
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, infile, codec):
+        self.infile = infile
+        self.codec = check_codec(codec)
+        if codec == 'zlib':
+            self.decompressor = zlib.decompressobj()
+        elif codec == 'bz2':
+            self.decompressor = bz2.BZ2Decompressor()
+        else:
+            self.decompressor = lzma.LZMADecompressor()
+        self.pending = b''
+        self.position = 0
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.offset
+
+    def _decompress(self):
+        """
+        Return the next piece of decompressed data, which may be empty,
+        or None at the end of the stream.
+        """
+        decompressor = self.decompressor
+        if decompressor.eof:
+            return None
+        if self.codec == 'zlib':
+            data = decompressor.unconsumed_tail
+        else:
+            data = b''
+        if self.codec == 'zlib' and not data or getattr(
+                decompressor, 'needs_input', False):
+            data = self.infile.read(self.BLOCK_SIZE)
+            if not data:
+                raise OSError('The compressed object is truncated.')
+        try:
+            return decompressor.decompress(data, self.BLOCK_SIZE)
+        except (zlib.error, lzma.LZMAError) as E:
+            raise OSError('The compressed object is corrupt: %s'%E)
+
+    def readinto(self, buffer):
+        while self.position >= len(self.pending):
+            data = self._decompress()
+            if data is None:
+                return 0
+            self.pending, self.position = data, 0
+        count = min(len(buffer), len(self.pending) - self.position)
+        buffer[:count] = self.pending[self.position:self.position + count]
+        self.position += count
+        self.offset += count
+        return count
+
+    def close(self):
+        self.infile.close()
+        super().close()
+
+def open_compressed(path, codec):
+    """
+    Return a buffered binary file object which reads the decompressed
+    content of a compressed object.
+    """
+    return io.BufferedReader(DecompressingReader(open(path, 'rb'), codec))
@@ -0,0 +1,158 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Copy files with as little work in user space as the platform allows.
+
+The strategies are tried in this order:
+
+reflink
+    Ask the filesystem to share the source's blocks with the target
+    (the FICLONE ioctl, supported on btrfs, XFS and others on linux).
+copy_file_range
+    Copy inside the kernel, which some filesystems turn into a server
+    side or block level copy.
+sendfile
+    Copy inside the kernel between two file descriptors.
+buffer
+    Read and write through a large reusable buffer.
+
+A strategy which is not supported for a pair of files falls through to
+the next one.  The name of the strategy which succeeded is returned, and
+the module keeps a count of how often each strategy was used.
+"""
+
+import os
+import sys
+import errno
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+strategies = ('reflink', 'copy_file_range', 'sendfile', 'buffer')
+
+# How often each strategy has been used by this process.
+stats = Counter()
+
+BUFFER_SIZE = 1 << 20
+# The _IOW(0x94, 9, int) ioctl from linux/fs.h.
+FICLONE = 0x40049409
+# Errors which mean that a strategy does not apply to these files.
+_unsupported = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY,
+                errno.EINVAL, errno.EBADF, errno.EPERM, errno.ENOTSUP}
+
+def _reflink(infd, outfd, size):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, 'reflinks are not supported')
+    fcntl.ioctl(outfd, FICLONE, infd)
+
+def _copy_file_range(infd, outfd, size):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not supported')
+    offset = 0
+    while offset < size:
+        count = os.copy_file_range(infd, outfd, size - offset)
+        if count == 0:
+            break
+        offset += count
+
+def _sendfile(infd, outfd, size):
+    if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+        # Elsewhere the target of sendfile must be a socket.
+        raise OSError(errno.ENOSYS, 'sendfile is not supported')
+    offset = 0
+    while offset < size:
+        count = os.sendfile(outfd, infd, offset, size - offset)
+        if count == 0:
+            break
+        offset += count
+
+def _buffer(infd, outfd, size):
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(infd, 'rb', buffering=0, closefd=False) as infile, \
+         open(outfd, 'wb', buffering=0, closefd=False) as outfile:
+        while True:
+            count = infile.readinto(buffer)
+            if not count:
+                break
+            written = 0
+            while written < count:
+                written += outfile.write(view[written:count])
+
+_methods = {
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'buffer': _buffer,
+}
+
+def copy_fd(infd, outfd, allowed=strategies):
+    """
+    Copy the contents of the open file infd, from its start, to the open
+    file outfd, which should be empty.  Returns the name of the strategy
+    which was used.
+    """
+    size = os.fstat(infd).st_size
+    for strategy in allowed:
+        try:
+            os.lseek(infd, 0, os.SEEK_SET)
+            _methods[strategy](infd, outfd, size)
+        except OSError as E:
+            if E.errno not in _unsupported or strategy == 'buffer':
+                raise
+            # Start over with the next strategy.
+            os.ftruncate(outfd, 0)
+            os.lseek(outfd, 0, os.SEEK_SET)
+            continue
+        stats[strategy] += 1
+        return strategy
+    raise OSError(errno.ENOSYS, 'No copy strategy was available.')
+
+def copy_file(source, target, exclusive=False, allowed=strategies):
+    """
+    Copy the data of the file source to the file target.  If exclusive
+    is True, raise FileExistsError if target exists.  Returns the name
+    of the strategy which was used.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    if exclusive:
+        flags |= os.O_EXCL
+    infd = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        outfd = os.open(target, flags, 0o666)
+        try:
+            return copy_fd(infd, outfd, allowed)
+        except BaseException:
+            os.close(outfd)
+            outfd = None
+            os.unlink(target)
+            raise
+        finally:
+            if outfd is not None:
+                os.close(outfd)
+    finally:
+        os.close(infd)
@@ -0,0 +1,108 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+
+"""
+Connections to the sqlite database of a stash.
+"""
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+class Database:
+    """
+    The connections to the database of a stash.  The database is put
+    in WAL mode, when the file system supports it, so that readers and
+    the writer do not block each other, and every connection waits up
+    to timeout seconds for a lock held by another process instead of
+    failing with "database is locked".  All writes go through a single
+    connection, the writer, which threads share by holding lock while
+    they write.  Each thread which only needs to read can use its own
+    connection, returned by reader.
+    """
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.writer = self._connect()
+        # WAL mode is stored in the database file, so this only
+        # changes anything the first time.  It fails, leaving the
+        # journal mode unchanged, on network file systems.
+        self.journal_mode = self.writer.execute(
+            'pragma journal_mode=wal').fetchone()[0]
+        if self.journal_mode == 'wal':
+            self.writer.execute('pragma synchronous=normal')
+        self._local = threading.local()
+        self._readers = []
+        # Functions which are called when writing rolls back, so that
+        # caches of the database can be discarded.
+        self.rollback_hooks = []
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout,
+                               check_same_thread=False)
+
+    def reader(self):
+        """
+        Return the read-only connection of the calling thread.  It sees
+        the changes made by the writer once they are committed.
+        """
+        connection = getattr(self._local, 'reader', None)
+        if connection is None:
+            connection = self._connect()
+            connection.execute('pragma query_only=on')
+            self._local.reader = connection
+            with self.lock:
+                self._readers.append(connection)
+        return connection
+
+    @contextmanager
+    def writing(self, immediate=False):
+        """
+        A context manager which holds the write lock and yields the
+        writer.  The changes are committed when the block ends, or
+        rolled back if it raises an exception.  If immediate is True
+        the transaction begins at once, rather than at the first write,
+        so that other connections cannot change what the block reads
+        before it writes.
+        """
+        with self.lock:
+            if immediate and not self.writer.in_transaction:
+                self.writer.execute('begin immediate')
+            try:
+                yield self.writer
+            except BaseException:
+                self.writer.rollback()
+                for hook in self.rollback_hooks:
+                    hook()
+                raise
+            self.writer.commit()
+
+    def close(self):
+        with self.lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers = []
+            self._local = threading.local()
+            self.writer.close()
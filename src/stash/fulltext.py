@@ -0,0 +1,127 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+
+"""
+A full-text index of the text fields of a stash.
+
+The table files_fts is an external content FTS5 table which indexes
+the filename and the text fields of the files table, and triggers on
+the files table keep it up to date.  Since the columns of an FTS5 table
+cannot be changed, the table and its triggers are rebuilt whenever a
+text field is added or removed.  Searches match words which begin with
+each search term and are ranked with BM25.  If the sqlite library was
+built without FTS5, searches fall back to like patterns.
+"""
+
+import sqlite3
+
+def fts_available(connection):
+    """
+    Return True if the sqlite library supports FTS5.
+    """
+    try:
+        connection.execute(
+            'create virtual table temp._fts_probe using fts5(x)')
+    except sqlite3.OperationalError:
+        return False
+    connection.execute('drop table temp._fts_probe')
+    return True
+
+def fts_columns(connection):
+    """
+    Return the list of columns of files_fts, which is empty if the
+    table does not exist.
+    """
+    rows = connection.execute('pragma table_info(files_fts)').fetchall()
+    return [row[1] for row in rows]
+
+def quote_name(name):
+    return '"%s"'%name.replace('"', '""')
+
+drop_statements = [
+    'drop trigger if exists files_fts_insert',
+    'drop trigger if exists files_fts_delete',
+    'drop trigger if exists files_fts_update',
+    'drop table if exists files_fts',
+]
+
+def create_statements(columns):
+    """
+    Return the statements which create files_fts, with the given
+    columns of the files table, and the triggers which maintain it, and
+    then index the existing rows.
+    """
+    names = ', '.join(quote_name(column) for column in columns)
+    new = ', '.join('new.' + quote_name(column) for column in columns)
+    old = ', '.join('old.' + quote_name(column) for column in columns)
+    return [
+        """create virtual table files_fts using fts5(%s, content='files',
+        content_rowid='_file_id', tokenize='unicode61 remove_diacritics 2')
+        """%names,
+        """create trigger files_fts_insert after insert on files begin
+        insert into files_fts(rowid, %s) values (new._file_id, %s);
+        end"""%(names, new),
+        """create trigger files_fts_delete after delete on files begin
+        insert into files_fts(files_fts, rowid, %s)
+        values ('delete', old._file_id, %s);
+        end"""%(names, old),
+        """create trigger files_fts_update after update of %s on files begin
+        insert into files_fts(files_fts, rowid, %s)
+        values ('delete', old._file_id, %s);
+        insert into files_fts(rowid, %s) values (new._file_id, %s);
+        end"""%(names, names, old, names, new),
+        "insert into files_fts(files_fts) values ('rebuild')",
+    ]
+
+def sql_string(text):
+    return "'%s'"%text.replace("'", "''")
+
+def match_expression(filters, any_term=False):
+    """
+    Return an FTS5 query for a list of (column, term) pairs, matching
+    words which begin with each term in the column, or in any column if
+    the column is None.  The terms must all match unless any_term is
+    True.
+    """
+    parts = []
+    for column, term in filters:
+        phrase = '"%s"*'%term.replace('"', '""')
+        if column is None:
+            parts.append(phrase)
+        else:
+            parts.append('{%s} : %s'%(quote_name(column), phrase))
+    return (' OR ' if any_term else ' AND ').join(parts)
+
+def like_clause(filters, columns, any_term=False):
+    """
+    Return a where clause which matches the (column, term) pairs with
+    like patterns, where a column of None means any of the columns.
+    """
+    parts = []
+    for column, term in filters:
+        pattern = sql_string('%%%s%%'%term)
+        names = columns if column is None else [column]
+        parts.append('(%s)'%' or '.join('files.%s like %s'%(
+            quote_name(name), pattern) for name in names))
+    return (' or ' if any_term else ' and ').join(parts)
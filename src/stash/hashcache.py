@@ -0,0 +1,147 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+A persistent cache of the hashes of files outside of a stash.
+
+A file is identified by its device, inode, size and modification time,
+so a file which has not changed since it was last hashed does not need
+to be read again.  The cache is a small sqlite database which can be
+kept in a stash directory or shared by all of a user's stashes.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+from .hashing import hash_file_all
+
+cache_schema = """
+    create table if not exists hashes (
+        device integer,
+        inode integer,
+        size integer,
+        mtime integer,
+        algorithm text,
+        hash text,
+        used real,
+        primary key (device, inode, size, mtime, algorithm)
+    )"""
+
+def user_cache_path():
+    """
+    Return the path of the hash cache which is shared by all of a
+    user's stashes.
+    """
+    if sys.platform == 'darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+    elif sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'Stash', 'hashcache.sqlite')
+
+class HashCache:
+    """
+    A cache of file hashes keyed by (device, inode, size, mtime).  When
+    the cache is closed, entries which have not been used for max_age
+    seconds are evicted, followed by the least recently used entries
+    beyond max_entries.
+    """
+    def __init__(self, path, max_entries=1000000, max_age=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(cache_schema)
+        self.connection.commit()
+
+    @staticmethod
+    def key(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def lookup(self, stat, algorithms):
+        """
+        Return a list of the cached hashes for a file with the given
+        stat result, one for each algorithm, or None if any is missing.
+        """
+        key = self.key(stat)
+        query = """select hash from hashes where device=? and inode=?
+                   and size=? and mtime=? and algorithm=?"""
+        hashes = []
+        for algorithm in algorithms:
+            row = self.connection.execute(query, key + (algorithm,)).fetchone()
+            if row is None:
+                return None
+            hashes.append(row[0])
+        query = """update hashes set used=? where device=? and inode=?
+                   and size=? and mtime=?"""
+        self.connection.execute(query, (time.time(),) + key)
+        return hashes
+
+    def store(self, stat, algorithms, hashes):
+        """
+        Save the hashes of a file with the given stat result.
+        """
+        now = time.time()
+        query = 'insert or replace into hashes values (?, ?, ?, ?, ?, ?, ?)'
+        self.connection.executemany(query, [self.key(stat) + (a, h, now)
+            for a, h in zip(algorithms, hashes)])
+
+    def hash_file(self, filename, algorithms):
+        """
+        Return a list of the hashes of a file, one for each algorithm,
+        reading the file only if they are not all in the cache.
+        """
+        stat = os.stat(filename)
+        hashes = self.lookup(stat, algorithms)
+        if hashes is None:
+            hashes = hash_file_all(filename, algorithms)
+            self.store(stat, algorithms, hashes)
+            self.commit()
+        return hashes
+
+    def commit(self):
+        self.connection.commit()
+
+    def evict(self):
+        """
+        Remove expired entries and then the least recently used entries
+        until at most max_entries remain.
+        """
+        if self.max_age:
+            self.connection.execute('delete from hashes where used < ?',
+                                    (time.time() - self.max_age,))
+        if self.max_entries is not None:
+            self.connection.execute("""delete from hashes where rowid in
+                (select rowid from hashes order by used desc
+                 limit -1 offset ?)""", (self.max_entries,))
+        self.connection.commit()
+
+    def close(self):
+        if self.connection:
+            self.evict()
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,347 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Content hash algorithms for stashes.
+
+An algorithm is named by a string such as 'md5', 'sha256' or
+'blake2b-32'.  The optional suffix of a blake2 or treehash algorithm is
+the digest size in bytes.  The 'treehash' algorithm hashes large files
+using all of the cores of a machine.  Stashes created before algorithms
+were configurable use 'md5'.  A hash string is the base62 encoding of
+the digest.
+"""
+
+import os
+import stat
+import mmap
+import time
+import hashlib
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import base62
+
+default_algorithm = 'md5'
+
+def _blake2(constructor, max_size, default_size=None):
+    def factory(size=None):
+        if size is None:
+            size = default_size or max_size
+        size = int(size)
+        if not 16 <= size <= max_size:
+            raise ValueError('The digest size must be between 16 and %d.'%
+                                 max_size)
+        return constructor(digest_size=size)
+    return factory
+
+class TreeHasher:
+    """
+    A hashlib style hasher for the 'treehash' algorithm, which can use
+    all of the cores of a machine to hash one large file.  The data is cut
+    into leaves of LEAF_SIZE bytes which are hashed with blake2b by a
+    pool of threads, since hashlib releases the GIL.  The digest is the
+    blake2b hash of the leaf digests followed by the length of the
+    data.  The leaf size and the personalization strings are part of
+    the definition of the algorithm, so they must never change.
+    """
+    LEAF_SIZE = 1 << 22
+    workers = os.cpu_count() or 1
+    _pool = None
+    _pool_pid = None
+    _pool_lock = threading.Lock()
+
+    def __init__(self, digest_size=32):
+        self.digest_size = digest_size
+        self.leaf = bytearray()
+        self.length = 0
+        self.pending = collections.deque()
+        self.leaf_digests = []
+
+    @classmethod
+    def pool(cls):
+        with cls._pool_lock:
+            # The threads of a pool do not survive a fork.
+            if cls._pool is None or cls._pool_pid != os.getpid():
+                cls._pool = ThreadPoolExecutor(cls.workers,
+                                               thread_name_prefix='treehash')
+                cls._pool_pid = os.getpid()
+            return cls._pool
+
+    @staticmethod
+    def hash_leaf(data):
+        return hashlib.blake2b(data, digest_size=32,
+                               person=b'stash-leaf').digest()
+
+    def _submit(self, data):
+        self.pending.append(self.pool().submit(self.hash_leaf, data))
+        # Bound the memory used by leaves waiting to be hashed.
+        while len(self.pending) > 2 * self.workers:
+            self.leaf_digests.append(self.pending.popleft().result())
+
+    def update(self, data):
+        data = memoryview(data).cast('B')
+        self.length += len(data)
+        start = 0
+        while start < len(data):
+            if not self.leaf and len(data) - start >= self.LEAF_SIZE:
+                self._submit(bytes(data[start:start + self.LEAF_SIZE]))
+                start += self.LEAF_SIZE
+                continue
+            count = min(self.LEAF_SIZE - len(self.leaf), len(data) - start)
+            self.leaf += data[start:start + count]
+            start += count
+            if len(self.leaf) == self.LEAF_SIZE:
+                self._submit(bytes(self.leaf))
+                self.leaf = bytearray()
+
+    def digest(self):
+        digests = self.leaf_digests + [f.result() for f in self.pending]
+        if self.leaf or not digests:
+            digests.append(self.hash_leaf(bytes(self.leaf)))
+        root = hashlib.blake2b(digest_size=self.digest_size,
+                               person=b'stash-root')
+        for leaf_digest in digests:
+            root.update(leaf_digest)
+        root.update(self.length.to_bytes(8, 'big'))
+        return root.digest()
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+algorithms = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': _blake2(hashlib.blake2b, 64),
+    'blake2s': _blake2(hashlib.blake2s, 32),
+    'treehash': _blake2(TreeHasher, 64, 32),
+}
+
+def register_algorithm(name, factory):
+    """
+    Make a new hash algorithm available.  The factory is called with no
+    arguments, or with the digest size parsed from a name like
+    'name-20', and must return an object with the hashlib interface.
+    """
+    if '-' in name:
+        raise ValueError('Algorithm names may not contain "-".')
+    algorithms[name] = factory
+
+def new_hasher(algorithm=default_algorithm):
+    """
+    Return a new hashlib style hasher for the named algorithm.
+    """
+    name, _, size = algorithm.partition('-')
+    try:
+        factory = algorithms[name]
+    except KeyError:
+        raise ValueError('Unknown hash algorithm %s.'%algorithm)
+    try:
+        return factory(size) if size else factory()
+    except TypeError:
+        raise ValueError('The %s algorithm has no digest size.'%name)
+
+def check_algorithm(algorithm):
+    """
+    Raise ValueError if the algorithm name is not valid.
+    """
+    new_hasher(algorithm)
+    return algorithm
+
+def encode(hasher):
+    """
+    Return the hash string for a hasher.
+    """
+    return base62.encode(int.from_bytes(hasher.digest(), 'big'))
+
+class Throttle:
+    """
+    Limit the rate at which data is read to a number of bytes per second.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.total = 0
+
+    def consume(self, count):
+        """
+        Account for count bytes, sleeping as long as needed to keep the
+        average rate at or below the limit.
+        """
+        self.total += count
+        ahead = self.total / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+# The hashing engine reads files in blocks of block_size bytes into a
+# buffer which is reused, so that each block costs one system call and
+# no allocation.  Regular files of at least mmap_threshold bytes are
+# mapped into memory instead of being read.
+block_size = 1 << 22
+mmap_threshold = 1 << 26
+
+_local = threading.local()
+
+def configure(block_size=None, mmap_threshold=None):
+    """
+    Set the block size used for reading files, e.g. 1 to 8 MB, and the
+    size above which files are memory mapped.  This is a module level
+    function so that it can be used to initialize a process pool.
+    """
+    settings = globals()
+    if block_size is not None:
+        if block_size < 4096:
+            raise ValueError('The block size must be at least 4096 bytes.')
+        settings['block_size'] = int(block_size)
+    if mmap_threshold is not None:
+        settings['mmap_threshold'] = int(mmap_threshold)
+
+def blocks(infile):
+    """
+    Generate memoryviews of the successive blocks of data read from a
+    binary file object.  The blocks are read into a buffer belonging to
+    the calling thread, so each view is only valid until the next one
+    is generated.
+    """
+    buffer = getattr(_local, 'buffer', None)
+    if buffer is None or len(buffer) != block_size:
+        buffer = _local.buffer = bytearray(block_size)
+    readinto = getattr(infile, 'readinto', None)
+    if readinto is None:
+        while True:
+            block = infile.read(block_size)
+            if not block:
+                return
+            yield memoryview(block)
+    view = memoryview(buffer)
+    while True:
+        count = readinto(view)
+        if not count:
+            return
+        yield view[:count]
+
+def file_blocks(filename):
+    """
+    Generate memoryviews of the successive blocks of a file, as for
+    blocks.  Large regular files are memory mapped, so that their data
+    is hashed where it lies in the page cache without being copied.
+    """
+    with open(filename, 'rb', buffering=0) as infile:
+        info = os.fstat(infile.fileno())
+        mapped = None
+        if stat.S_ISREG(info.st_mode) and info.st_size >= mmap_threshold:
+            try:
+                mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass
+        if mapped is None:
+            yield from blocks(infile)
+            return
+        with mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                for start in range(0, len(mapped), block_size):
+                    block = view[start:start + block_size]
+                    try:
+                        yield block
+                    finally:
+                        # The map cannot be closed while views exist.
+                        block.release()
+            finally:
+                view.release()
+
+def _hash_blocks(blocks, algorithms, throttle):
+    hashers = [new_hasher(algorithm) for algorithm in algorithms]
+    for block in blocks:
+        for hasher in hashers:
+            hasher.update(block)
+        if throttle:
+            throttle.consume(len(block))
+    return [encode(hasher) for hasher in hashers]
+
+def hash_file_all(filename, algorithms, throttle=None):
+    """
+    Return a list of the hash strings of a file for each of the given
+    algorithms, reading the file only once.  If a Throttle is provided
+    it is used to limit the read rate.  This is the hashing primitive
+    used for importing, checking and scrubbing files.  It is a module
+    level function so that it can be used by a process pool.
+    """
+    return _hash_blocks(file_blocks(filename), algorithms, throttle)
+
+def hash_stream(infile, algorithms, throttle=None):
+    """
+    Return a list of the hash strings of the data read from a binary
+    file object for each of the given algorithms.
+    """
+    return _hash_blocks(blocks(infile), algorithms, throttle)
+
+def hash_file(filename, algorithm=default_algorithm):
+    """
+    Return the hash string of a file.
+    """
+    return hash_file_all(filename, (algorithm,))[0]
+
+PARTIAL_SIZE = 4096
+
+def partial_hash(filename):
+    """
+    Return the md5 hex digest of the first and last PARTIAL_SIZE bytes
+    of a file.  This is only used to show that two files of the same
+    size are different without reading all of either one.
+    """
+    hasher = hashlib.md5()
+    with open(filename, 'rb') as infile:
+        hasher.update(infile.read(PARTIAL_SIZE))
+        size = os.fstat(infile.fileno()).st_size
+        if size > PARTIAL_SIZE:
+            infile.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+            hasher.update(infile.read(PARTIAL_SIZE))
+    return hasher.hexdigest()
+
+class PartialHasher:
+    """
+    Computes the partial hash of data which is provided in blocks, as
+    partial_hash does for a file.
+    """
+    def __init__(self):
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+
+    def update(self, data):
+        if len(self.head) < PARTIAL_SIZE:
+            self.head += data[:PARTIAL_SIZE - len(self.head)]
+        self.tail += data
+        del self.tail[:-PARTIAL_SIZE]
+        self.size += len(data)
+
+    def hexdigest(self):
+        hasher = hashlib.md5(self.head)
+        if self.size > PARTIAL_SIZE:
+            count = min(PARTIAL_SIZE, self.size - PARTIAL_SIZE)
+            hasher.update(self.tail[len(self.tail) - count:])
+        return hasher.hexdigest()
@@ -0,0 +1,164 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+A hot tier for stashes which are kept on slow disks.
+
+The hot cache is a directory, normally on a fast local disk, holding
+copies of recently used objects named like the objects themselves.
+Since the names are content hashes, one hot cache can be shared by
+several stashes.  The modification time of each copy records when it
+was last used, and the least recently used copies are evicted when the
+total size exceeds a limit.
+"""
+
+import os
+import shutil
+import tempfile
+from .copier import copy_file
+
+class HotCache:
+    """
+    A size-capped directory of copies of recently used objects.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._total = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """
+        Return the path of the copy with the given name, marking it as
+        recently used, or None if there is no such copy.
+        """
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add_file(self, source, name):
+        """
+        Copy a file into the cache and return the path of the copy, or
+        None if the file is too big to be cached.
+        """
+        size = os.path.getsize(source)
+        if size > self.max_bytes:
+            return None
+        temp_path = self._temp_path()
+        try:
+            os.unlink(temp_path)
+            copy_file(source, temp_path, exclusive=True)
+        except BaseException:
+            self._discard_temp(temp_path)
+            raise
+        return self._install(temp_path, name, size)
+
+    def add_stream(self, infile, name):
+        """
+        Copy the data read from a binary file object into the cache and
+        return the path of the copy, or None if it is too big to be
+        cached.
+        """
+        temp_path = self._temp_path()
+        try:
+            with open(temp_path, 'wb') as outfile:
+                shutil.copyfileobj(infile, outfile, 1 << 20)
+            size = os.path.getsize(temp_path)
+        except BaseException:
+            self._discard_temp(temp_path)
+            raise
+        if size > self.max_bytes:
+            self._discard_temp(temp_path)
+            return None
+        return self._install(temp_path, name, size)
+
+    def _temp_path(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.hot-')
+        os.close(fd)
+        return temp_path
+
+    def _discard_temp(self, temp_path):
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+
+    def _install(self, temp_path, name, size):
+        path = self.path(name)
+        os.replace(temp_path, path)
+        if self._total is not None:
+            self._total += size
+        self.evict(keep=path)
+        return path
+
+    def discard(self, name):
+        """
+        Remove the copy with the given name, if there is one.
+        """
+        path = self.path(name)
+        try:
+            size = os.path.getsize(path)
+            os.unlink(path)
+        except FileNotFoundError:
+            return
+        if self._total is not None:
+            self._total -= size
+
+    def usage(self):
+        """
+        Return the total size of the copies in the cache.
+        """
+        if self._total is None:
+            self._total = sum(entry.stat().st_size
+                              for entry in os.scandir(self.directory)
+                              if entry.is_file())
+        return self._total
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used copies, other than the one whose
+        path is keep, until the cache is no bigger than max_bytes.
+        Copies which are still being written are left alone.
+        """
+        if self.usage() <= self.max_bytes:
+            return
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                   for entry in os.scandir(self.directory)
+                   if entry.is_file() and not entry.name.startswith('.hot-')]
+        self._total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self._total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._total -= size
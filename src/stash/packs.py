@@ -0,0 +1,355 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Append-only pack files holding many small records.
+
+A PackStore keeps records in numbered files named pack-000001, ... in
+its directory.  Each record is identified by a key, and a table in the
+stash database maps the key to (pack, offset, length) together with a
+reference count.  Records are never modified in place: releasing the
+last reference leaves dead space, which compact reclaims by copying the
+live records out of mostly dead packs.  Records are only appended to
+the newest pack, whose number is kept in the lock file of the directory
+so that the number of a pack which compact has removed is never used
+again.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+def pack_schema(table):
+    """
+    Return the statement which creates the index table for a PackStore.
+    """
+    return """
+    create table if not exists %s (
+        key text primary key,
+        pack integer,
+        offset integer,
+        length integer,
+        refs integer
+    )"""%table
+
+class PackStore:
+    """
+    Records stored in append-only pack files, indexed by a table in a
+    sqlite database.  The caller is responsible for committing.
+    """
+    def __init__(self, directory, connection, table, pack_size=1 << 28):
+        self.directory = directory
+        self.connection = connection
+        self.table = table
+        self.pack_size = pack_size
+        self._fds = {}
+        # The pack which is open for appending, as a pair (pack, fd).
+        self._writer = None
+        self._lock_fd = None
+
+    def pack_path(self, pack):
+        return os.path.join(self.directory, 'pack-%06d'%pack)
+
+    def _fd(self, pack):
+        fd = self._fds.get(pack)
+        if fd is not None and os.fstat(fd).st_nlink == 0:
+            # The pack was removed by compact in another stash.
+            os.close(self._fds.pop(pack))
+            fd = None
+        if fd is None:
+            fd = os.open(self.pack_path(pack),
+                         os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            self._fds[pack] = fd
+        return fd
+
+    def _last_pack(self):
+        """
+        Return the number of the newest pack, or 0 if there is none.
+        The caller must hold the lock.
+        """
+        os.lseek(self._lock_fd, 0, os.SEEK_SET)
+        data = os.read(self._lock_fd, 32)
+        if data.strip():
+            return int(data)
+        # The directory was made before the number was recorded.
+        packs = self.packs()
+        return packs[-1] if packs else 0
+
+    def _new_pack(self):
+        """
+        Record and return the number of a new pack.  The caller must
+        hold the lock.
+        """
+        pack = self._last_pack() + 1
+        data = b'%d\n'%pack
+        os.lseek(self._lock_fd, 0, os.SEEK_SET)
+        os.write(self._lock_fd, data)
+        os.ftruncate(self._lock_fd, len(data))
+        return pack
+
+    def _writable_pack(self, length):
+        """
+        Return the number of the pack which the next record should be
+        appended to.  The caller must hold the lock.
+        """
+        pack = self._last_pack()
+        if pack == 0:
+            return self._new_pack()
+        try:
+            size = os.path.getsize(self.pack_path(pack))
+        except FileNotFoundError:
+            size = 0
+        if size > 0 and size + length > self.pack_size:
+            pack = self._new_pack()
+        return pack
+
+    def packs(self):
+        """
+        Return a sorted list of the numbers of the existing packs.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[5:]) for name in names
+                      if name.startswith('pack-') and name[5:].isdigit())
+
+    def locate(self, key):
+        """
+        Return (pack, offset, length) for a key, or None.
+        """
+        query = 'select pack, offset, length from %s where key=?'%self.table
+        return self.connection.execute(query, (key,)).fetchone()
+
+    def __contains__(self, key):
+        return self.locate(key) is not None
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold an exclusive lock on the lock file in the directory, which
+        serializes appends by all stashes and processes sharing it.
+        """
+        if self._lock_fd is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_fd = os.open(os.path.join(self.directory, 'lock'),
+                                    os.O_RDWR | os.O_CREAT)
+        fd = self._lock_fd
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+    def _append(self, data):
+        with self._locked():
+            pack = self._writable_pack(len(data))
+            if self._writer is None or self._writer[0] != pack:
+                self._close_writer()
+                fd = os.open(self.pack_path(pack),
+                             os.O_WRONLY | os.O_CREAT | os.O_APPEND |
+                             getattr(os, 'O_BINARY', 0))
+                self._writer = (pack, fd)
+            fd = self._writer[1]
+            # Other stashes may have appended since we last did, so the
+            # offset must be found under the lock.
+            offset = os.fstat(fd).st_size
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        return pack, offset
+
+    def _close_writer(self):
+        if self._writer:
+            os.close(self._writer[1])
+            self._writer = None
+
+    def put(self, key, data):
+        """
+        Add a reference to a record, storing the data if the key is new.
+        Returns True if the data was stored.
+        """
+        query = 'update %s set refs=refs+1 where key=?'%self.table
+        if self.connection.execute(query, (key,)).rowcount:
+            return False
+        pack, offset = self._append(data)
+        query = 'insert into %s values (?, ?, ?, ?, 1)'%self.table
+        self.connection.execute(query, (key, pack, offset, len(data)))
+        return True
+
+    def stage(self, key, data, staged):
+        """
+        Add a reference to a record without writing to the database, so
+        that no transaction is open while the data is appended.  The
+        reference is recorded in staged, a dict which apply writes to
+        the index later.  The data is appended unless the key is staged
+        already or is stored with references.  Returns True if the data
+        was stored.
+        """
+        entry = staged.get(key)
+        if entry:
+            entry[3] += 1
+            return False
+        query = 'select refs from %s where key=?'%self.table
+        row = self.connection.execute(query, (key,)).fetchone()
+        if row and row[0] > 0:
+            staged[key] = [None, None, None, 1]
+            return False
+        pack, offset = self._append(data)
+        staged[key] = [pack, offset, len(data), 1]
+        return True
+
+    def apply(self, staged):
+        """
+        Write the references recorded by stage to the index, without
+        committing.  A record which was appended replaces one with the
+        same key that has lost its references since.  Raises KeyError
+        if a record which was stored when it was staged has since been
+        removed by compact.
+        """
+        for key, (pack, offset, length, refs) in staged.items():
+            if pack is None:
+                query = 'update %s set refs=refs+? where key=?'%self.table
+                if not self.connection.execute(query, (refs, key)).rowcount:
+                    raise KeyError(key)
+                continue
+            # If another stash stored the record meanwhile, the copy
+            # which was appended here is dead space.
+            query = 'update %s set refs=refs+? where key=? and refs>0'%(
+                self.table)
+            if self.connection.execute(query, (refs, key)).rowcount:
+                continue
+            query = 'insert or replace into %s values (?, ?, ?, ?, ?)'%(
+                self.table)
+            self.connection.execute(query, (key, pack, offset, length, refs))
+
+    def get(self, key):
+        """
+        Return the data of a record.
+        """
+        location = self.locate(key)
+        if location is None:
+            raise KeyError(key)
+        return self.read(*location)
+
+    def read(self, pack, offset, length):
+        data = os.pread(self._fd(pack), length, offset)
+        if len(data) != length:
+            raise OSError('Pack %d is truncated.'%pack)
+        return data
+
+    def release(self, key, forget=False):
+        """
+        Remove a reference to a record.  Records with no references are
+        removed from the index by compact, or immediately if forget is
+        True, so that a new record with the same key can be stored with
+        different data.  Either way their space is reclaimed by compact.
+        """
+        query = 'update %s set refs=refs-1 where key=?'%self.table
+        self.connection.execute(query, (key,))
+        if forget:
+            query = 'delete from %s where key=? and refs<=0'%self.table
+            self.connection.execute(query, (key,))
+
+    def rename(self, old_key, new_key):
+        query = 'update %s set key=? where key=?'%self.table
+        self.connection.execute(query, (new_key, old_key))
+
+    def garbage(self):
+        """
+        Return the number of records and bytes which have no references.
+        """
+        query = 'select count(*), total(length) from %s where refs<=0'%(
+            self.table)
+        count, size = self.connection.execute(query).fetchone()
+        return count, int(size)
+
+    def compact(self, threshold=0.5, grace=0):
+        """
+        Forget records with no references, and rewrite each pack which is
+        more than threshold dead space by appending its live records to
+        the newest pack and deleting it.  The newest pack, and packs
+        modified less than grace seconds ago, are left alone, since they
+        may hold records which have been staged but not yet applied.  The
+        database is committed before any pack is deleted.  Returns the
+        number of bytes freed.
+        """
+        self._close_writer()
+        self.connection.execute('delete from %s where refs<=0'%self.table)
+        query = 'select pack, total(length) from %s group by pack'%self.table
+        live = dict(self.connection.execute(query).fetchall())
+        freed = 0
+        doomed = []
+        cutoff = time.time() - grace
+        with self._locked():
+            last = self._last_pack()
+        for pack in self.packs():
+            if pack == last:
+                continue
+            stat = os.stat(self.pack_path(pack))
+            size = stat.st_size
+            if grace and stat.st_mtime >= cutoff:
+                continue
+            if size == 0 or 1 - live.get(pack, 0) / size > threshold:
+                doomed.append((pack, size))
+        for pack, size in doomed:
+            query = 'select key, offset, length from %s where pack=?'%(
+                self.table)
+            for key, offset, length in self.connection.execute(
+                    query, (pack,)).fetchall():
+                new_pack, new_offset = self._append(
+                    self.read(pack, offset, length))
+                self.connection.execute(
+                    'update %s set pack=?, offset=? where key=?'%self.table,
+                    (new_pack, new_offset, key))
+            freed += size - live.get(pack, 0)
+        self.connection.commit()
+        with self._locked():
+            for pack, size in doomed:
+                fd = self._fds.pop(pack, None)
+                if fd is not None:
+                    os.close(fd)
+                os.unlink(self.pack_path(pack))
+        return int(freed)
+
+    def close(self):
+        self._close_writer()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
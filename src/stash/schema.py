@@ -2,6 +2,8 @@
 Schema for the sqlite3 database used by Stash.
 """
 
+from .packs import pack_schema
+
 schema = [
     """
     create table preferences (
@@ -20,10 +22,6 @@ schema = [
         timestamp datetime
     )""",
 
-    """
-    create index file_index on files(_file_id)
-    """,
-
     """
     create table keywords (
         _keyword_id integer primary key autoincrement,
@@ -42,3 +40,82 @@ schema = [
         _keyword_id integer references keywords
     )"""
 ]
+
+
+# These statements are executed whenever a stash is created or opened,
+# so that stashes created by older versions of Stash are upgraded.  The
+# objects table holds information about how each file is stored.  Its
+# storage column is null for objects which are files in the tree,
+# 'chunks' for objects stored by the chunk store and 'packed' for small
+# objects stored in pack files.  The codec column is null unless the
+# object is compressed.
+
+upgrades = [
+    # The primary key of the files table is already indexed.
+    """
+    drop index if exists file_index
+    """,
+
+    """
+    create table if not exists objects (
+        hash text primary key,
+        algorithm text
+    )""",
+
+    """
+    create table if not exists scrub_results (
+        hash text primary key,
+        status text,
+        detail text
+    )""",
+
+    """
+    create table if not exists sync_manifest (
+        source text,
+        path text,
+        size integer,
+        mtime integer,
+        hash text,
+        primary key (source, path)
+    )""",
+
+    pack_schema('chunks'),
+
+    pack_schema('packed'),
+
+    """
+    create table if not exists object_chunks (
+        hash text,
+        seq integer,
+        chunk text,
+        primary key (hash, seq)
+    )""",
+]
+
+# Columns which were added to tables after they were first created, as
+# (table, column, type) triples.
+
+added_columns = [
+    ('objects', 'extension', 'text'),
+    ('objects', 'size', 'integer'),
+    ('objects', 'partial', 'text'),
+    ('objects', 'storage', 'text'),
+    ('objects', 'codec', 'text'),
+]
+
+# Indexes which are created after the added columns exist.
+
+indexes = [
+    """
+    create index if not exists object_size_index on objects(size)
+    """,
+
+    """
+    create index if not exists keyword_file_index
+    on keyword_x_file(_keyword_id, _file_id)
+    """,
+
+    """
+    create index if not exists file_keyword_index on keyword_x_file(_file_id)
+    """,
+]
@@ -0,0 +1,153 @@
+#   This file is part of the program Stash.
+#   Stash helps you to stash your files, and find them later.
+#
+#   Copyright (C) 2010-2025 by Marc Culler and others.
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.  In addition, python modules
+#   distributed with this program may be included in works which are
+#   licensed under terms compatible with version 2 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#   Project homepage: https://github/culler/stash
+#   Author homepage: https://marc-culler.info
+
+"""
+Support for verifying the objects in a stash and for removing objects
+and database records which are no longer used.
+"""
+
+import os
+import time
+from .hashing import hash_file_all, hash_stream, configure, Throttle
+from .compression import open_compressed
+
+# Each worker process has its own throttle, which gets an equal share
+# of the bandwidth.
+_throttle = None
+
+def init_worker(rate, block_size=None, mmap_threshold=None):
+    """
+    Initialize a worker process, limiting it to rate bytes per second
+    if rate is not None and configuring its hashing engine.
+    """
+    global _throttle
+    _throttle = Throttle(rate) if rate else None
+    configure(block_size, mmap_threshold)
+
+def verify_object(job):
+    """
+    Rehash one object.  The job is a tuple (hash_string, path,
+    algorithm, codec) where codec is None unless the object is
+    compressed.  Returns a triple (hash_string, status, detail) where
+    the status is 'ok', 'missing' or 'corrupt'.
+    """
+    hash_string, path, algorithm, codec = job
+    if path is None or not os.path.isfile(path):
+        return hash_string, 'missing', path
+    if codec:
+        return verify_stream(hash_string,
+            lambda: open_compressed(path, codec), algorithm,
+            throttle=_throttle)
+    try:
+        size = os.path.getsize(path)
+        actual = hash_file_all(path, (algorithm,), _throttle)[0]
+    except OSError as E:
+        return hash_string, 'missing', str(E)
+    if actual != hash_string:
+        return hash_string, 'corrupt', 'The %s hash is %s.'%(algorithm, actual)
+    return hash_string, 'ok', size
+
+def verify_stream(hash_string, opener, algorithm, rate=None, throttle=None):
+    """
+    Rehash an object which is read through a file object returned by
+    opener, such as a chunked or compressed object.  Returns a triple
+    like verify_object.  The read rate is limited by the throttle, or
+    to rate bytes per second if that is given instead.
+    """
+    if rate:
+        throttle = Throttle(rate)
+    try:
+        with opener() as infile:
+            actual = hash_stream(infile, (algorithm,), throttle)[0]
+            size = infile.tell()
+    except KeyError as E:
+        return hash_string, 'missing', 'Missing chunk %s.'%E.args[0]
+    except OSError as E:
+        return hash_string, 'missing', str(E)
+    if actual != hash_string:
+        return hash_string, 'corrupt', 'The %s hash is %s.'%(algorithm, actual)
+    return hash_string, 'ok', size
+
+class ScrubReport:
+    """
+    The results of a scrub.  The corrupt and missing lists contain pairs
+    (hash_string, detail), including problems found before the scrub
+    was interrupted and resumed.  The orphaned list contains the paths
+    of objects which do not belong to any file.
+    """
+    def __init__(self):
+        self.checked = 0
+        self.bytes = 0
+        self.corrupt = []
+        self.missing = []
+        self.orphaned = []
+        self.resumed = False
+        self.start = time.time()
+        self.finish = None
+
+    def __repr__(self):
+        return ('%d objects checked, %d corrupt, %d missing, %d orphaned '
+                'in %.1f s')%(self.checked, len(self.corrupt),
+                    len(self.missing), len(self.orphaned), self.elapsed)
+
+    @property
+    def elapsed(self):
+        finish = self.finish if self.finish else time.time()
+        return finish - self.start
+
+    @property
+    def clean(self):
+        return not (self.corrupt or self.missing or self.orphaned)
+
+    def done(self):
+        self.finish = time.time()
+
+class GarbageReport:
+    """
+    The garbage found by a collection.  The orphaned and temporary lists
+    contain paths, dangling_links contains (_file_id, _keyword_id)
+    pairs and stale_objects contains hashes from the objects table.
+    The stale_records list contains the hashes of chunk manifests and
+    packed objects which belong to no file, and dead_records is the
+    number of chunks and packed objects which were no longer referenced
+    before the collection.  If dry_run is True nothing was actually
+    removed.
+    """
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.orphaned = []
+        self.temporary = []
+        self.dangling_links = []
+        self.stale_objects = []
+        self.stale_records = []
+        self.dead_records = 0
+        self.bytes = 0
+
+    def __repr__(self):
+        return ('%s %d orphaned objects, %d temporary files, %d dangling '
+                'keyword links, %d stale object records and %d unused '
+                'pack records (%.1f MB)')%(
+                    'Would remove' if self.dry_run else 'Removed',
+                    len(self.orphaned), len(self.temporary),
+                    len(self.dangling_links), len(self.stale_objects),
+                    self.dead_records, self.bytes / 1.0e6)
@@ -95,7 +95,8 @@ class StashShell:
                     print(' - Cancelled')
                     return
                 print('Finding files matching %s'%search)
-                rows = self.stash.find_files(self.match_clause(search))
+                rows = self.stash.find_files(self.match_clause(search),
+                                             rank=self.match_filters(search))
                 if len(rows) == 0:
                     print('No files were found.')
                     return
@@ -180,15 +181,12 @@ class StashShell:
                 'file': '(d)elete, (e)xport, (k)eys, (v)iew, (u)p, (q)uit'
                }
 
+    def match_filters(self, match):
+        return [(None, term) for term in match.split()]
+
     def match_clause(self, match):
-        terms = match.split()
-        if len(terms) == 0:
-            return '1'
-        booleans = []
-        for term in terms:
-            for column in self.stash.search_keys[2:]:
-                booleans.append("%s like '%%%s%%'"%(column.key, term))
-        return ' or '.join(booleans)
+        return self.stash.match_clause(self.match_filters(match),
+                                       any_term=True)
 
     def choose_file(self, query_result):
                 n = 0
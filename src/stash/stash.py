@@ -21,15 +21,56 @@
 #   Project homepage: https://github/culler/stash
 #   Author homepage: https://marc-culler.info
 
-from .tree import StashTree
-from .schema import schema
+from .tree import StashTree, parse_layout
+from .schema import schema, upgrades, added_columns, indexes
 import os
 import sys
+import time
 import sqlite3
 import subprocess
 import shutil
+import io
+import mmap
+import tempfile
+import itertools
+import json
 from collections import defaultdict
-from .browse import browser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, wraps
+from .tree import copy_and_hash, stream_and_hash
+from .copier import copy_file
+from . import hashing
+from .hashing import (default_algorithm, hash_file_all, hash_stream,
+                      check_algorithm, partial_hash)
+from .bulk import (ImportResult, ImportReport, ImportBatch, walk_files,
+                   batches)
+from .archive import Archive, member_filename, read_errors
+from .hashcache import HashCache, user_cache_path
+from .hotcache import HotCache
+from .database import Database
+from .advisor import IndexAdvisor
+from .bitmaps import KeywordBitmaps, members
+from .scrub import (ScrubReport, GarbageReport, init_worker, verify_object,
+                    verify_stream)
+from .chunks import ChunkStore
+from .compression import (check_codec, parse_rules, format_rules,
+                          choose_codec, new_compressor, open_compressed,
+                          DecompressingReader)
+from .packs import PackStore
+from .fulltext import (fts_available, fts_columns, drop_statements,
+                       create_statements, match_expression, like_clause,
+                       sql_string)
+
+def _serialized(method):
+    """
+    Make a method of Stash hold the write lock of the database while it
+    runs, so that threads which share a stash take turns writing.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.database.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class StashError(Exception):
     def __init__(self, value):
@@ -51,8 +92,9 @@ class Field:
         'keyword'  : 'keyword',
         }
 
-    def __init__(self, row):
+    def __init__(self, row, indexed=False):
         self.name, self.sqltype = row[1], row[2].lower()
+        self.indexed = indexed
         try:
             self.type = Field.sql2keytype[self.sqltype]
             return
@@ -65,17 +107,45 @@ class Field:
 class Stash:
     """
     A searchable stash of files.
+
+    New objects are stored according to the stash's storage setting.
+    With 'tree' storage, the default, each object is a file in the
+    tree.  With 'chunks' storage each object is cut into chunks which
+    are stored once and shared by all objects which contain them.  With
+    tree storage, objects smaller than the pack threshold, if one is
+    set, are appended to pack files instead of having a file each.
     """
+    storages = ('tree', 'chunks')
+
     def __init__(self):
         self.tree = None
+        self.chunks = None
+        self.storage = 'tree'
+        self.compression = None
+        self.compression_rules = {}
+        self.packed = None
+        self.pack_threshold = 0
+        self.database = None
         self.connection = None
         self.stashdir = None
         self.fields = []
         self.keywords = []
+        # Whether searches of text fields use the full-text index.
+        self.full_text = False
+        self.advisor = None
+        self.auto_index = False
+        self.bitmaps = None
+        # Whether every object's size is recorded, or None if unknown.
+        self._sizes_known = None
+        self.hash_cache = None
 
-    def open(self, dirname):
+    def open(self, dirname, cache_listings=False):
         """
-        Attach an existing stash directory.
+        Attach an existing stash directory.  If cache_listings is True,
+        directory listings used to find objects whose extensions are not
+        recorded in the database are cached in memory.  That is only
+        useful for stashes created by older versions of Stash for which
+        index_objects has not been run.
         """
         rootdir =  os.path.join(dirname, '.stashfiles')
         database = os.path.join(dirname, 'db.stash')
@@ -84,15 +154,43 @@ class Stash:
         elif not os.path.isdir(rootdir) or not os.path.isfile(database):
             raise StashError('The directory %s is not a valid stash.'%dirname)
         else:
-            self.tree = StashTree(os.path.abspath(rootdir))
-            self.connection = sqlite3.connect(database)
+            self.database = Database(database)
+            self.connection = self.database.writer
+            self.bitmaps = KeywordBitmaps(self.connection)
+            self.database.rollback_hooks.append(self.bitmaps.clear)
+            self.upgrade()
+            algorithm = self.get_setting('hash_algorithm', default_algorithm)
+            self.tree = StashTree(os.path.abspath(rootdir), algorithm,
+                                      cache_listings=cache_listings)
+            self.tree.reload_layout = self.load_layout
+            self.chunks = ChunkStore(self.tree.root, self.connection)
+            self.packed = PackStore(os.path.join(self.tree.root, '.packs'),
+                                    self.connection, 'packed')
+            self.storage = self.get_setting('storage', 'tree')
+            self.pack_threshold = int(self.get_setting('pack_threshold', 0))
+            self.load_compression()
+            hot_cache_size = int(self.get_setting('hot_cache_size', 0))
+            if hot_cache_size:
+                self.use_hot_cache(self.get_setting('hot_cache_dir'),
+                                   hot_cache_size)
+            self.load_layout()
             self.init_fields()
+            self._update_full_text()
             self.stashdir = os.path.abspath(dirname)
 
-    def create(self, dirname):
+    def create(self, dirname, algorithm=default_algorithm, layout=(1, 2),
+                   storage='tree'):
         """
-        Create a new stash directory.
+        Create a new stash directory.  New files will be hashed with the
+        specified algorithm, e.g. 'md5', 'blake2b-32' or, for stashes of
+        very large files, 'treehash', and stored in
+        directories with the specified (depth, width) layout, or in the
+        chunk store if storage is 'chunks'.
         """
+        check_algorithm(algorithm)
+        layout = parse_layout(layout)
+        if storage not in self.storages:
+            raise StashError('Unknown storage %s.'%storage)
         if os.path.lexists(dirname):
             raise StashError('The path %s is in use.'%os.path.abspath(dirname))
         else:
@@ -101,28 +199,564 @@ class Stash:
             database = os.path.join(dirname, 'db.stash')
             os.mkdir(dirname)
             os.mkdir(rootdir)
-            self.connection = sqlite3.connect(database)
+            self.database = Database(database)
+            self.connection = self.database.writer
+            self.bitmaps = KeywordBitmaps(self.connection)
+            self.database.rollback_hooks.append(self.bitmaps.clear)
             for command in schema:
                 self.connection.execute(command)
-            self.tree = StashTree(os.path.abspath(rootdir))
+            self.upgrade()
+            self.set_setting('hash_algorithm', algorithm)
+            self.set_setting('layout', '%d,%d'%layout)
+            self.tree = StashTree(os.path.abspath(rootdir), algorithm,
+                                      layout=layout)
+            self.tree.reload_layout = self.load_layout
+            self.chunks = ChunkStore(self.tree.root, self.connection)
+            self.packed = PackStore(os.path.join(self.tree.root, '.packs'),
+                                    self.connection, 'packed')
+            self.set_storage(storage)
+            self._update_full_text()
             #Hide .stashfiles on Windows
             if sys.platform == 'win32':
                 os.system('attrib.exe +H %s'%rootdir)
                      
+    def upgrade(self):
+        """
+        Add any tables or columns which are missing from an older stash.
+        """
+        for command in upgrades:
+            self.connection.execute(command)
+        for table, column, sqltype in added_columns:
+            rows = self.connection.execute('pragma table_info(%s)'%table)
+            if column not in [row[1] for row in rows]:
+                self.connection.execute('alter table %s add column %s %s'%(
+                    table, column, sqltype))
+        for command in indexes:
+            self.connection.execute(command)
+        self.connection.commit()
+
+    def load_layout(self):
+        """
+        Read the shard layout of the tree from the settings.  This is
+        also called when an object is not where it is expected to be,
+        since another process may be resharding the tree.
+        """
+        self.tree.layout = parse_layout(self.get_setting('layout', '1,2'))
+        old_layout = self.get_setting('old_layout')
+        self.tree.old_layout = parse_layout(old_layout) if old_layout else None
+
+    def object_path(self, hash_string):
+        """
+        Return the pathname of a file with the content of the object
+        with the given hash, or None if there is no such object.  This
+        is the object itself for objects stored as plain files in the
+        tree, and a copy in the cache directory for chunked, packed or
+        compressed objects.  If a hot cache is in use the object is
+        copied into it, and the path of the copy is returned.
+        """
+        path = self._hot_path(hash_string)
+        if path is not None:
+            return path
+        query = 'select extension, storage, codec from objects where hash=?'
+        row = self.connection.execute(query, (hash_string,)).fetchone()
+        if row is not None and (row[1] or row[2]):
+            return self._materialize(hash_string, row[0] or '')
+        return self._stored_path(hash_string)
+
+    def _stored_path(self, hash_string):
+        """
+        Return the pathname in the tree of the object with the given
+        hash, or None if there is no such object.  The path is computed
+        from the extension recorded in the objects table.  For objects
+        from older stashes, which have no recorded extension, the
+        extension is found by searching the tree and then recorded.
+        """
+        query = 'select extension from objects where hash=?'
+        row = self.connection.execute(query, (hash_string,)).fetchone()
+        if row is not None and row[0] is not None:
+            path = self.tree.locate(hash_string, row[0])
+            if not os.path.exists(path):
+                self.load_layout()
+                path = self.tree.locate(hash_string, row[0])
+            return path
+        extension = self.tree.find_extension(hash_string)
+        if extension is None:
+            self.load_layout()
+            extension = self.tree.find_extension(hash_string)
+            if extension is None:
+                return None
+        with self.database.writing():
+            self._record_object(hash_string, extension)
+        return self.tree.locate(hash_string, extension)
+
+    def _stored_as(self, hash_string):
+        """
+        Return a pair (storage, codec) describing how an object is
+        stored.  The storage is 'tree', 'chunks' or 'packed' and the
+        codec is None unless the object is compressed.
+        """
+        query = 'select storage, codec from objects where hash=?'
+        row = self.connection.execute(query, (hash_string,)).fetchone()
+        if row is None:
+            return 'tree', None
+        return row[0] or 'tree', row[1]
+
+    def _materialize(self, hash_string, extension):
+        """
+        Return the path of a copy of an object which is not a plain file
+        in the tree, such as a chunked object, in the cache directory of
+        the tree.  The copy is made if it does not already exist, and
+        is removed by collect_garbage once it is no longer recent.
+        """
+        path = os.path.join(self.tree.cachedir, hash_string + extension)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+        os.makedirs(self.tree.cachedir, exist_ok=True)
+        os.makedirs(self.tree.tempdir, exist_ok=True)
+        try:
+            infile = self._open_object(hash_string)
+        except KeyError:
+            return None
+        fd, temp_path = tempfile.mkstemp(dir=self.tree.tempdir,
+                                         prefix='cache-')
+        with infile, os.fdopen(fd, 'wb') as outfile:
+            shutil.copyfileobj(infile, outfile, 1 << 20)
+        os.replace(temp_path, path)
+        return path
+
+    def _hot_path(self, hash_string):
+        """
+        Return the path of the copy of an object in the hot cache,
+        copying the object there if necessary.  Returns None if there
+        is no hot cache, or no such object, or if the object is too big
+        to be cached.
+        """
+        hot = self.tree.hot
+        if hot is None:
+            return None
+        query = 'select extension from objects where hash=?'
+        row = self.connection.execute(query, (hash_string,)).fetchone()
+        if row is None or row[0] is None:
+            stored_path = self._stored_path(hash_string)
+            if stored_path is None:
+                return None
+            extension = os.path.splitext(stored_path)[1]
+        else:
+            extension = row[0]
+        name = hash_string + extension
+        path = hot.get(name)
+        if path is not None:
+            return path
+        if self._stored_as(hash_string) == ('tree', None):
+            stored_path = self._stored_path(hash_string)
+            if stored_path is None or not os.path.isfile(stored_path):
+                return None
+            return hot.add_file(stored_path, name)
+        try:
+            infile = self._open_object(hash_string)
+        except KeyError:
+            return None
+        with infile:
+            return hot.add_stream(infile, name)
+
+    def use_hot_cache(self, directory=None, max_bytes=10 << 30):
+        """
+        Keep copies of recently viewed and exported objects in a
+        directory on a fast local disk, which is useful when the stash
+        is on a slow or remote disk.  The least recently used copies
+        are removed when the copies take more than max_bytes.  By
+        default the directory is in the user's cache directory, and is
+        shared by all stashes.  A max_bytes of 0 stops using the cache.
+        """
+        if not max_bytes:
+            self.tree.hot = None
+            return
+        if directory is None:
+            directory = os.path.join(os.path.dirname(user_cache_path()),
+                                     'objects')
+        self.tree.hot = HotCache(directory, max_bytes)
+
+    def set_hot_cache(self, max_bytes, directory=None):
+        """
+        Use a hot cache of at most max_bytes, in the specified directory
+        or the default one, whenever this stash is opened.  A max_bytes
+        of 0 turns this off.
+        """
+        max_bytes = int(max_bytes)
+        if max_bytes < 0:
+            raise StashError('The hot cache size must not be negative.')
+        self.set_setting('hot_cache_size', max_bytes)
+        if directory:
+            directory = os.path.abspath(directory)
+            self.set_setting('hot_cache_dir', directory)
+        else:
+            self.delete_setting('hot_cache_dir')
+        self.use_hot_cache(directory, max_bytes)
+
+    def _open_object(self, hash_string):
+        """
+        Return a binary file object for reading the content of an
+        object.  Raises KeyError if there is no such object.
+        """
+        storage, codec = self._stored_as(hash_string)
+        if storage == 'chunks':
+            return self.chunks.open(hash_string)
+        if storage == 'packed':
+            data = io.BytesIO(self.packed.get(hash_string))
+            if codec:
+                return io.BufferedReader(DecompressingReader(data, codec))
+            return data
+        path = self._stored_path(hash_string)
+        if path is None or not os.path.isfile(path):
+            raise KeyError(hash_string)
+        if codec:
+            return open_compressed(path, codec)
+        return open(path, 'rb')
+
+    def open_object(self, hash_string):
+        """
+        Return a read-only binary file object for reading the content of
+        an object, however it is stored.  A copy in the hot cache is
+        used if there is one, but none is made.
+        """
+        if self.tree.hot:
+            query = 'select extension from objects where hash=?'
+            row = self.connection.execute(query, (hash_string,)).fetchone()
+            if row and row[0] is not None:
+                path = self.tree.hot.get(hash_string + row[0])
+                if path is not None:
+                    return open(path, 'rb')
+        try:
+            return self._open_object(hash_string)
+        except KeyError:
+            raise StashError('The object %s is missing.'%hash_string)
+
+    def object_buffer(self, hash_string):
+        """
+        Return a read-only memoryview of the content of an object.  For
+        objects stored as files this is a view of a memory map of the
+        file, so only the pages which are used are read.  A copy in the
+        hot cache is used if there is one, but none is made.  Chunked
+        and compressed objects are mapped from their copy in the cache,
+        and the content of a packed object is read into memory.  Release
+        the view when it is no longer needed.
+        """
+        storage, codec = self._stored_as(hash_string)
+        if storage == 'packed' and not codec:
+            try:
+                return memoryview(self.packed.get(hash_string))
+            except KeyError:
+                raise StashError('The object %s is missing.'%hash_string)
+        if storage == 'tree' and not codec:
+            path = self._stored_path(hash_string)
+            if self.tree.hot and path is not None:
+                hot_path = self.tree.hot.get(os.path.basename(path))
+                path = hot_path or path
+        else:
+            path = self.object_path(hash_string)
+        if path is None or not os.path.isfile(path):
+            raise StashError('The object %s is missing.'%hash_string)
+        with open(path, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return memoryview(b'')
+            return memoryview(mmap.mmap(infile.fileno(), 0,
+                                        access=mmap.ACCESS_READ))
+
+    def set_storage(self, storage):
+        """
+        Choose how new objects are stored: 'tree' or 'chunks'.  Objects
+        which are already in the stash are not moved.
+        """
+        if storage not in self.storages:
+            raise StashError('Unknown storage %s.'%storage)
+        self.set_setting('storage', storage)
+        self.storage = storage
+
+    def set_compression(self, codec=None, rules=None):
+        """
+        Choose how new objects in the tree are compressed.  The codec is
+        'zlib', 'bz2', 'lzma' or None for no compression.  The rules are
+        a dict mapping extensions, such as '.csv', to the codec, or
+        None, for files with that extension.  Files whose extensions
+        show that they are already compressed, such as '.jpg', are not
+        compressed unless a rule names them.  Objects which are already
+        in the stash are not changed.  Objects stored as chunks are
+        never compressed.
+        """
+        if codec is not None:
+            check_codec(codec)
+        rules = parse_rules(rules)
+        for rule_codec in rules.values():
+            if rule_codec is not None:
+                check_codec(rule_codec)
+        self.set_setting('compression', codec or 'none')
+        self.set_setting('compression_rules', format_rules(rules))
+        self.compression, self.compression_rules = codec, rules
+
+    def set_pack_threshold(self, size):
+        """
+        Store new objects smaller than size bytes in pack files, which
+        saves a file, and a disk block, per object in stashes of many
+        small files.  The size compared with the threshold is the raw,
+        uncompressed size of the object, even if it is compressed.  A
+        size of 0 turns this off.  Objects which are already in the
+        stash stay where they are until pack_objects is run.  Objects
+        stored as chunks are never packed.
+        """
+        size = int(size)
+        if size < 0:
+            raise StashError('The pack threshold must not be negative.')
+        self.set_setting('pack_threshold', size)
+        self.pack_threshold = size
+
+    def _packable(self, filename):
+        """
+        Return True if a new object for this file belongs in a pack.
+        """
+        if self.storage == 'chunks' or not self.pack_threshold:
+            return False
+        try:
+            return os.path.getsize(filename) < self.pack_threshold
+        except OSError:
+            return False
+
+    def pack_objects(self, batch_size=500, callback=None):
+        """
+        Move the objects in the tree which are smaller than the pack
+        threshold into pack files.  Compressed objects stay compressed.
+        Objects whose size is unknown, in stashes made by older versions
+        of Stash, are skipped until index_objects has been run.  The
+        database is committed after each batch, before the moved
+        files are removed, so this can be interrupted and run again.  If
+        provided, callback is called with each hash.  Returns the number
+        of objects which were moved.
+        """
+        if not self.pack_threshold:
+            return 0
+        query = """select files.hash from files join objects
+                   on files.hash=objects.hash where objects.storage is null
+                   and objects.extension is not null and objects.size < ?"""
+        rows = self.connection.execute(query,
+            (self.pack_threshold,)).fetchall()
+        count = 0
+        for batch in batches(rows, batch_size):
+            staged, moved = {}, []
+            for hash_string, in batch:
+                path = self._stored_path(hash_string)
+                try:
+                    with open(path, 'rb') as infile:
+                        data = infile.read()
+                except (OSError, TypeError):
+                    continue
+                with self.database.lock:
+                    self.packed.stage(hash_string, data, staged)
+                moved.append((hash_string, path))
+            try:
+                with self.database.writing():
+                    self.packed.apply(staged)
+                    self.connection.executemany(
+                        "update objects set storage='packed' where hash=?",
+                        [(hash_string,) for hash_string, _ in moved])
+            except KeyError as E:
+                raise StashError('The record %s was removed while the '
+                                 'objects were being packed.'%E.args[0])
+            for hash_string, path in moved:
+                self.tree.discard(path)
+                count += 1
+                if callback:
+                    callback(hash_string)
+        return count
+
+    @_serialized
+    def compact_packs(self, threshold=0.5, grace=0):
+        """
+        Reclaim the space in pack files which is used by deleted objects
+        and chunks, rewriting each pack which is more than threshold
+        unused.  Packs modified less than grace seconds ago are left
+        alone, since an import may be adding to them.  Returns the
+        number of bytes freed.
+        """
+        return (self.packed.compact(threshold, grace) +
+                self.chunks.packs.compact(threshold, grace))
+
+    def load_compression(self):
+        codec = self.get_setting('compression', 'none')
+        self.compression = None if codec == 'none' else codec
+        self.compression_rules = parse_rules(
+            self.get_setting('compression_rules', ''))
+
+    def _codec_for(self, filename):
+        """
+        Return the codec with which a new object should be compressed,
+        or None.
+        """
+        if self.storage == 'chunks':
+            return None
+        return choose_codec(os.path.splitext(filename)[1],
+                            self.compression, self.compression_rules)
+
+    def reshard(self, layout=None, callback=None):
+        """
+        Change the shard layout of the tree to (depth, width), moving
+        the existing objects.  The stash remains usable while this runs
+        and, if it is interrupted, calling reshard again, with or
+        without the layout, finishes the job.  Returns the number of
+        objects which were moved.
+        """
+        if layout is not None:
+            layout = parse_layout(layout)
+        with self.database.writing(immediate=True):
+            self.load_layout()
+            old_layout = self.get_setting('old_layout')
+            if layout is not None:
+                if old_layout and layout != self.tree.layout:
+                    raise StashError(
+                        'Please finish the reshard to %d,%d first.'%
+                        self.tree.layout)
+                if not old_layout:
+                    if layout == self.tree.layout:
+                        return 0
+                    self.set_setting('old_layout', '%d,%d'%self.tree.layout)
+                    self.set_setting('layout', '%d,%d'%layout)
+        self.load_layout()
+        count = self.tree.reshard(callback)
+        if self.tree.old_layout:
+            # Stashes which had not yet seen the new layout may have
+            # added objects to the old one after it was scanned.
+            count += self.tree.reshard(callback)
+            self.delete_setting('old_layout')
+            self.tree.old_layout = None
+        return count
+
+    def _record_object(self, hash_string, extension, size=None,
+                           digest=None):
+        """
+        Record what is known about an object from an older stash.  The
+        digest is its partial hash.
+        """
+        query = """update objects set extension=?,
+                   size=coalesce(?, size), partial=coalesce(?, partial)
+                   where hash=?"""
+        cursor = self.connection.execute(query,
+            (extension, size, digest, hash_string))
+        if cursor.rowcount == 0:
+            query = """insert into objects
+                       (hash, algorithm, extension, size, partial)
+                       values (?, ?, ?, ?, ?)"""
+            self.connection.execute(query,
+                (hash_string, default_algorithm, extension, size, digest))
+
+    def index_objects(self):
+        """
+        Record the extension, size and partial hash of every object for
+        which they are unknown, listing each directory of the tree at
+        most once.  Afterwards no object lookup needs to search a
+        directory and prefilter can be used.  Returns the number of
+        objects which were indexed.
+        """
+        query = """select files.hash, objects.extension
+                   from files left join objects on files.hash=objects.hash
+                   where objects.extension is null or objects.size is null"""
+        rows = self.connection.execute(query).fetchall()
+        by_dir = defaultdict(list)
+        for hash_string, extension in rows:
+            if extension is None:
+                dir = os.path.dirname(self.tree.path(hash_string, ''))
+                by_dir[dir].append(hash_string)
+        found = {}
+        for dir, dir_hashes in by_dir.items():
+            try:
+                names = os.listdir(dir)
+            except FileNotFoundError:
+                names = []
+            extensions = dict(os.path.splitext(name) for name in names)
+            for hash_string in dir_hashes:
+                extension = extensions.get(hash_string)
+                if extension is None and self.tree.old_layout:
+                    # The object has not been resharded yet.
+                    extension = self.tree.find_extension(hash_string)
+                found[hash_string] = extension
+        records = []
+        for hash_string, extension in rows:
+            if extension is None:
+                extension = found[hash_string]
+                if extension is None:
+                    continue
+            path = self.tree.locate(hash_string, extension)
+            try:
+                size = os.path.getsize(path)
+                digest = partial_hash(path)
+            except OSError:
+                size = digest = None
+            records.append((hash_string, extension, size, digest))
+        with self.database.writing():
+            for record in records:
+                self._record_object(*record)
+        self._sizes_known = None
+        return len(records)
+
+    def prefilter(self, filename):
+        """
+        Return True if the size of a file, or if necessary a hash of its
+        first and last few KB, proves that the file is not in the stash
+        without hashing all of it.  A False result means that the whole
+        file must be hashed to decide.  This needs the size of every
+        object, so for stashes created by older versions of Stash it
+        returns False until index_objects has been run.
+        """
+        if self._sizes_known is None:
+            query = """select count(*) from files left join objects
+                       on files.hash=objects.hash where objects.size is null"""
+            count = self.connection.execute(query).fetchone()[0]
+            self._sizes_known = (count == 0)
+        if not self._sizes_known:
+            return False
+        query = 'select partial from objects where size=?'
+        partials = {row[0] for row in self.connection.execute(query,
+            (os.path.getsize(filename),))}
+        if not partials:
+            return True
+        if None in partials:
+            return False
+        return partial_hash(filename) not in partials
+
+    def scan(self, filenames):
+        """
+        Generate a pair (filename, hash_string) for each of the given
+        files which is not in the stash.  Files are only hashed if the
+        prefilter cannot prove that they are new, in which case the
+        hash_string is None.
+        """
+        algorithms = [self.tree.algorithm] + self.legacy_algorithms()
+        for filename in filenames:
+            if self.prefilter(filename):
+                yield filename, None
+                continue
+            hashes = self._hash_source(filename, algorithms)
+            if all(self.check_hash(h) for h in hashes):
+                yield filename, hashes[0]
+
     def init_fields(self):
         """
         Find the search keys for this stash.
         """
         result = self.connection.execute('pragma table_info(files)')
         rows = result.fetchall()
-        self.fields = [Field(row) for row in rows[4:]]
+        indexed = self.indexed_columns()
+        self.fields = [Field(row, row[1] in indexed) for row in rows[4:]]
         result = self.connection.execute('select _keyword from keywords')
         rows = result.fetchall()
         self.keywords = [row[0] for row in rows]
 
-    def add_field(self, field_name, field_type):
+    @_serialized
+    def add_field(self, field_name, field_type, index=False):
         """
-        Add a new search field.
+        Add a new search field.  If index is True the field is indexed,
+        which makes searches for values of the field, or in a range of
+        values, and sorting by the field faster, at the cost of a little
+        space and time whenever a file is added or changed.  Keyword
+        fields are always indexed.
         """
         field_name = field_name.replace('"','')
         if field_type == 'keyword':
@@ -133,8 +767,83 @@ class Stash:
                 field_name, field_type)
         self.connection.execute(query)
         self.connection.commit()
+        if index and field_type != 'keyword':
+            self.index_field(field_name)
         self.init_fields()
+        self._update_full_text()
+
+    def indexed_columns(self):
+        """
+        Return a dict mapping each column of the files table which is
+        the first column of an index to the name of one such index.
+        """
+        result = {}
+        for row in self.connection.execute(
+                'pragma index_list(files)').fetchall():
+            columns = self.connection.execute(
+                'pragma index_info("%s")'%row[1]).fetchall()
+            if columns and columns[0][2] is not None:
+                result.setdefault(columns[0][2], row[1])
+        return result
 
+    @_serialized
+    def index_field(self, field_name):
+        """
+        Create an index on a field, if it has none, and update the
+        statistics which sqlite uses to choose query plans.
+        """
+        field_name = field_name.replace('"', '')
+        if field_name in self.indexed_columns():
+            return
+        self.connection.execute(
+            'create index if not exists "field_index_%s" on files("%s")'%(
+                field_name, field_name))
+        self.connection.execute('analyze files')
+        self.connection.commit()
+        self.init_fields()
+
+    @_serialized
+    def drop_field_index(self, field_name):
+        """
+        Remove the indexes whose first column is the given field.
+        """
+        for row in self.connection.execute(
+                'pragma index_list(files)').fetchall():
+            columns = self.connection.execute(
+                'pragma index_info("%s")'%row[1]).fetchall()
+            if columns and columns[0][2] == field_name and row[3] == 'c':
+                self.connection.execute('drop index "%s"'%row[1])
+        self.connection.commit()
+        self.init_fields()
+
+    def use_index_advisor(self, auto_index=False, threshold=20):
+        """
+        Explain each query made by find_files and count, for each
+        field, the searches which had to scan or sort the files table
+        but could have used an index on it.  The advisor's proposals
+        method lists the fields which reached the threshold.  If
+        auto_index is True those fields are indexed as soon as they
+        reach it.
+        """
+        self.advisor = IndexAdvisor(threshold)
+        self.auto_index = auto_index
+
+    def analyze(self):
+        """
+        Update the statistics which sqlite uses to choose query plans.
+        This is worth doing after many files have been added.
+        """
+        with self.database.writing():
+            self.connection.execute('analyze')
+
+    def _advise(self, connection, query, parameters=()):
+        fields = ['timestamp'] + [field.name for field in self.fields]
+        self.advisor.observe(connection, query, fields, parameters)
+        if self.auto_index:
+            for field_name in self.advisor.proposals(self.indexed_columns()):
+                self.index_field(field_name)
+
+    @_serialized
     def delete_field(self, field):
         """
         Delete a search field.
@@ -145,14 +854,70 @@ class Stash:
             keyword_id = self.connection.execute(query).fetchall()[0][0]
             query = 'delete from keyword_x_file where _keyword_id=%d'%keyword_id
             self.connection.execute(query)
+            self.bitmaps.forget(keyword_id)
             query = 'delete from keywords where _keyword_id=%d'%keyword_id
             self.connection.execute(query)
             self.keywords.remove(field.name)
         else:
+            self.drop_field_index(field.name)
+            # The triggers which maintain the full-text index would
+            # prevent the column from being dropped.
+            for statement in drop_statements:
+                self.connection.execute(statement)
             query = 'alter table files drop column "%s"' % field.name
             self.connection.execute(query)
         self.connection.commit()
         self.init_fields()
+        self._update_full_text()
+
+    def text_columns(self):
+        """
+        Return the names of the columns which are searched as text: the
+        filename and the text fields.
+        """
+        return ['filename'] + [field.name for field in self.fields
+                               if field.type == 'text']
+
+    def _update_full_text(self):
+        """
+        Create the full-text index of the text columns, or rebuild it if
+        the text fields have changed, unless sqlite does not support it.
+        """
+        self.full_text = fts_available(self.connection)
+        if not self.full_text:
+            return
+        columns = self.text_columns()
+        if fts_columns(self.connection) != columns:
+            with self.database.writing():
+                for statement in drop_statements + create_statements(columns):
+                    self.connection.execute(statement)
+
+    def match_clause(self, filters, any_term=False):
+        """
+        Return a where clause for find_files which selects the files
+        matching a list of (column, term) pairs, where a column of None
+        means any text column.  The terms must all match unless any_term
+        is True.  In text columns a term matches the words which begin
+        with it, using the full-text index, and in other columns, or if
+        there is no full-text index, it matches any value containing it.
+        """
+        if not filters:
+            return '1'
+        columns = self.text_columns()
+        if not self.full_text:
+            return like_clause(filters, columns, any_term)
+        indexed = [(column, term) for column, term in filters
+                   if column is None or column in columns]
+        others = [(column, term) for column, term in filters
+                  if not (column is None or column in columns)]
+        clauses = []
+        if indexed:
+            clauses.append("""files._file_id in (select rowid from files_fts
+                where files_fts match %s)"""%sql_string(
+                    match_expression(indexed, any_term)))
+        if others:
+            clauses.append('(%s)'%like_clause(others, columns, any_term))
+        return (' or ' if any_term else ' and ').join(clauses)
 
     def check_hash(self, hash_string):
         query = 'Select count(*) from files where hash="%s"'%hash_string
@@ -160,55 +925,947 @@ class Stash:
         return (count == 0)
 
     def check_file(self, filename):
-        hash_string = self.tree.hash_string(filename)
-        if not self.check_hash(hash_string):
-            raise StashError('That file is already stored in the stash!')
-        return hash_string
-        
-    def insert_file(self, filename, value_dict, hash_string=None):
         """
-        Insert a file into the stash.
+        Raise a StashError if the file is already in the stash, otherwise
+        return its hash, or None if the prefilter shows that the file is
+        new without hashing it.  While older objects hashed with a
+        different algorithm remain in the stash the file is also hashed
+        with those algorithms, in the same pass, to look for duplicates.
+        """
+        if self.prefilter(filename):
+            return None
+        algorithms = [self.tree.algorithm] + self.legacy_algorithms()
+        hashes = self._hash_source(filename, algorithms)
+        for hash_string in hashes:
+            if not self.check_hash(hash_string):
+                raise StashError('That file is already stored in the stash!')
+        return hashes[0]
+
+    def legacy_algorithms(self):
+        """
+        Return a list of the hash algorithms, other than the current one,
+        which were used for objects in the stash.
+        """
+        query = """select distinct coalesce(objects.algorithm, ?)
+                   from files left join objects on files.hash=objects.hash"""
+        rows = self.connection.execute(query, (default_algorithm,))
+        return [row[0] for row in rows if row[0] != self.tree.algorithm]
+
+    def set_hash_algorithm(self, algorithm):
+        """
+        Choose the hash algorithm used for files added to the stash.
+        Existing objects keep their names until migrate_hashes is run.
+        """
+        check_algorithm(algorithm)
+        self.set_setting('hash_algorithm', algorithm)
+        self.tree.algorithm = algorithm
+
+    def migrate_hashes(self, callback=None):
+        """
+        Rename all objects which were hashed with an algorithm other
+        than the current one.  Each object is committed separately, so
+        the migration can be interrupted and resumed, and the stash
+        remains usable while it runs.  If provided, callback is called
+        with each pair (old_hash, new_hash).  Returns the number of
+        objects which were renamed.
+        """
+        query = """select files.hash from files left join objects
+                   on files.hash=objects.hash
+                   where coalesce(objects.algorithm, ?) != ?"""
+        rows = self.connection.execute(query, (default_algorithm,
+            self.tree.algorithm)).fetchall()
+        count = 0
+        for old_hash, in rows:
+            storage, codec = self._stored_as(old_hash)
+            if storage != 'tree':
+                if self._migrate_record(old_hash, storage, callback):
+                    count += 1
+                continue
+            path = self._stored_path(old_hash)
+            if path is None:
+                continue
+            if codec:
+                with open_compressed(path, codec) as infile:
+                    new_hash = hash_stream(infile, (self.tree.algorithm,))[0]
+            else:
+                new_hash = self.tree.hash_string(path)
+            if not self.check_hash(new_hash):
+                # A copy hashed with the new algorithm is already here.
+                continue
+            extension = os.path.splitext(path)[1]
+            self.load_layout()
+            new_path = self.tree.path(new_hash, extension)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            # The link shares the modification time of the object, so
+            # touch it first or collect_garbage, which has not seen the
+            # new hash yet, would remove the link as an old orphan.
+            os.utime(path)
+            os.link(path, new_path)
+            with self.database.writing():
+                self.connection.execute(
+                    'update files set hash=? where hash=?',
+                    (new_hash, old_hash))
+                cursor = self.connection.execute(
+                    'update objects set hash=?, algorithm=? where hash=?',
+                    (new_hash, self.tree.algorithm, old_hash))
+                if cursor.rowcount == 0:
+                    self.connection.execute(
+                        'insert into objects (hash, algorithm, extension) '
+                        'values (?, ?, ?)',
+                        (new_hash, self.tree.algorithm, extension))
+            os.unlink(path)
+            count += 1
+            if callback:
+                callback(old_hash, new_hash)
+        return count
+
+    def _migrate_record(self, old_hash, storage, callback):
+        """
+        Rename a chunked or packed object for migrate_hashes.  Only the
+        database records change.
         """
+        try:
+            with self._open_object(old_hash) as infile:
+                new_hash = hash_stream(infile, (self.tree.algorithm,))[0]
+        except KeyError:
+            return False
+        if not self.check_hash(new_hash):
+            return False
+        with self.database.writing():
+            self.connection.execute('update files set hash=? where hash=?',
+                                    (new_hash, old_hash))
+            self.connection.execute(
+                'update objects set hash=?, algorithm=? where hash=?',
+                (new_hash, self.tree.algorithm, old_hash))
+            if storage == 'chunks':
+                self.chunks.rename(old_hash, new_hash)
+            else:
+                self.packed.rename(old_hash, new_hash)
+        if callback:
+            callback(old_hash, new_hash)
+        return True
+
+    @_serialized
+    def insert_file(self, filename, value_dict, hash_string=None,
+                        single_pass=False):
+        """
+        Insert a file into the stash.  If single_pass is True and the
+        hash is not provided then the file is hashed while it is being
+        copied, or compressed, into the stash.  This does not apply to
+        chunk storage or to packed objects, which are always hashed
+        before they are stored.
+        """
+        codec = self._codec_for(filename)
+        packable = self._packable(filename)
+        storage = 'tree'
+        if self.storage == 'chunks' or codec or packable:
+            temp_path = None
+            if hash_string is None:
+                if codec and single_pass and not packable:
+                    os.makedirs(self.tree.tempdir, exist_ok=True)
+                    temp_path, hashes = copy_and_hash(filename,
+                        self.tree.tempdir, (self.tree.algorithm,), codec)
+                    hash_string = hashes[0]
+                else:
+                    hash_string = self.tree.hash_string(filename)
+                if not self.check_hash(hash_string):
+                    if temp_path:
+                        self.tree.discard(temp_path)
+                    raise ValueError('Hash is in use already.')
+            _, storage, codec = self._store_object(filename, hash_string,
+                                                   temp_path, codec)
+        else:
+            hash_string = self.tree.insert(filename, self,
+                hash_string=hash_string, single_pass=single_pass)
+        self._insert_row(filename, value_dict, hash_string, storage, codec)
+        self.connection.commit()
+
+    def insert_files(self, records, workers=None, batch_size=500,
+                         callback=None, single_pass=False):
+        """
+        Insert many files, given by an iterable of pairs (filename,
+        value_dict), as import_tree does for the files in a directory.
+        The files are hashed by a pool of worker processes, and the rows
+        and metadata of each batch of files are written with a few
+        executemany statements in a single transaction.  Returns an
+        ImportReport.
+        """
+        metadata = {}
+        for filename, value_dict in records:
+            metadata[filename] = value_dict
+        return self._import_paths(list(metadata), metadata.get, workers,
+                                  batch_size, callback, single_pass)
+
+    def _store_object(self, filename, hash_string, temp_path=None,
+                          codec=None, batch=None):
+        """
+        Store a file whose hash is known, without committing.  If
+        temp_path is not None it is a copy of the file in the temporary
+        directory of the tree, compressed with the codec if one is
+        given, which is used instead of the file.  An object which the
+        codec does not make smaller is stored uncompressed.  If batch is
+        an ImportBatch, the records of chunks and packed objects are
+        staged in it instead of being written to the database.  Returns
+        a triple (strategy, storage, codec) where strategy is the way
+        the object was stored, storage is 'tree', 'chunks' or 'packed'
+        and codec is the codec which was actually used.
+        """
+        if self.storage == 'chunks':
+            self._store_chunks(hash_string, temp_path or filename, batch)
+            if temp_path:
+                self.tree.discard(temp_path)
+            return 'chunks', 'chunks', None
+        if self._packable(filename):
+            if temp_path:
+                self.tree.discard(temp_path)
+            with open(filename, 'rb') as infile:
+                data = infile.read()
+            if codec:
+                compressor = new_compressor(codec)
+                compressed = compressor.compress(data) + compressor.flush()
+                if len(compressed) < len(data):
+                    data = compressed
+                else:
+                    codec = None
+            self._store_packed(hash_string, data, batch)
+            return 'packed', 'packed', codec
+        extension = os.path.splitext(filename)[1]
+        if codec:
+            if temp_path is None:
+                os.makedirs(self.tree.tempdir, exist_ok=True)
+                temp_path, _ = copy_and_hash(filename, self.tree.tempdir,
+                                             (), codec)
+            if os.path.getsize(temp_path) < os.path.getsize(filename):
+                self.tree.commit(temp_path, hash_string, extension)
+                return codec, 'tree', codec
+            self.tree.discard(temp_path)
+            temp_path = None
+        if temp_path:
+            self.tree.commit(temp_path, hash_string, extension)
+            return 'single pass', 'tree', None
         self.tree.insert(filename, self, hash_string=hash_string)
-        query = """insert into files (hash, filename, timestamp)
-                   values (?, ?, datetime('now'))"""
-        self.connection.execute(query,(hash_string, os.path.basename(filename)))
+        return self.tree.last_strategy, 'tree', None
+
+    @_serialized
+    def insert_stream(self, source, filename, value_dict=None):
+        """
+        Insert data which is not in a file, such as the output of a
+        subprocess or a decompressor, as a file with the given name.
+        The source is a binary file object or an iterable of bytes-like
+        objects.  It is read once, and the data is hashed while it is
+        written, compressed if a codec applies, into the temporary
+        directory of the tree, from which it is moved into place.  If
+        the data is already in the stash the copy is discarded and a
+        StashError is raised.  Returns the hash of the new object.
+        """
+        filename = os.path.basename(filename)
+        codec = self._codec_for(filename)
+        algorithms = [self.tree.algorithm] + self.legacy_algorithms()
+        os.makedirs(self.tree.tempdir, exist_ok=True)
+        temp_path, hashes, size, partial = stream_and_hash(source,
+            self.tree.tempdir, algorithms, codec)
+        try:
+            for hash_string in hashes:
+                if not self.check_hash(hash_string):
+                    raise StashError('That file is already stored in the '
+                                     'stash!')
+            hash_string = hashes[0]
+            storage, codec = self._store_temp(temp_path, filename,
+                                              hash_string, size, codec)
+        except BaseException:
+            self.tree.discard(temp_path)
+            raise
+        self._insert_row(filename, value_dict, hash_string, storage, codec,
+                         size, partial)
         self.connection.commit()
+        return hash_string
+
+    def _store_chunks(self, hash_string, filename, batch=None):
+        if batch is None:
+            self.chunks.store(hash_string, filename)
+        else:
+            self.chunks.stage(hash_string, filename, batch.chunks,
+                              batch.manifests)
+
+    def _store_packed(self, hash_string, data, batch=None):
+        if batch is None:
+            self.packed.put(hash_string, data)
+        else:
+            self.packed.stage(hash_string, data, batch.packed)
+
+    def _store_temp(self, temp_path, filename, hash_string, size, codec,
+                        batch=None):
+        """
+        Store a temporary file made by stream_and_hash, which holds size
+        bytes of data compressed with the codec, if there is one, as the
+        object with the given hash.  The temporary file is moved into
+        place or removed.  The batch is used as by _store_object.
+        Returns the pair (storage, codec) describing how the object was
+        stored.
+        """
+        if self.storage == 'chunks':
+            self._store_chunks(hash_string, temp_path, batch)
+            self.tree.discard(temp_path)
+            return 'chunks', None
+        if codec and os.path.getsize(temp_path) >= size:
+            fd, raw_path = tempfile.mkstemp(dir=self.tree.tempdir,
+                                            prefix='import-')
+            with open_compressed(temp_path, codec) as infile:
+                with os.fdopen(fd, 'wb') as outfile:
+                    shutil.copyfileobj(infile, outfile, 1 << 20)
+            os.chmod(raw_path, 0o644)
+            self.tree.discard(temp_path)
+            temp_path, codec = raw_path, None
+        if self.pack_threshold and size < self.pack_threshold:
+            with open(temp_path, 'rb') as infile:
+                data = infile.read()
+            self._store_packed(hash_string, data, batch)
+            self.tree.discard(temp_path)
+            return 'packed', codec
+        self.tree.commit(temp_path, hash_string,
+                         os.path.splitext(filename)[1])
+        return 'tree', codec
+
+    def _insert_row(self, filename, value_dict, hash_string, storage='tree',
+                        codec=None, size=None, partial=None):
+        """
+        Add the database records for a newly stored file, without
+        committing.  The storage and codec describe how the object was
+        stored, as returned by _store_object.  The size and partial hash
+        are computed from the file unless they are provided.
+        """
+        batch = ImportBatch()
+        self._add_rows(batch, filename, hash_string, storage, codec, size,
+                       partial)
+        self._insert_rows(batch)
         if value_dict:
             metadata = {'hash': hash_string}
             metadata.update(value_dict)
-            self.set_fields(metadata)
+            self._set_fields(metadata)
+
+    def _add_rows(self, batch, filename, hash_string, storage='tree',
+                      codec=None, size=None, partial=None):
+        """
+        Append the files and objects rows for a newly stored file to an
+        ImportBatch, with the arguments described for _insert_row.
+        """
+        if size is None:
+            size = os.path.getsize(filename)
+        if partial is None:
+            partial = partial_hash(filename)
+        batch.files.append((hash_string, os.path.basename(filename)))
+        batch.objects.append((hash_string, self.tree.algorithm,
+            os.path.splitext(filename)[1], size, partial,
+            None if storage == 'tree' else storage, codec))
+
+    def _insert_rows(self, batch):
+        """
+        Write the rows collected in an ImportBatch, without committing.
+        """
+        self.packed.apply(batch.packed)
+        self.chunks.apply(batch.chunks, batch.manifests)
+        query = """insert into files (hash, filename, timestamp)
+                   values (?, ?, datetime('now'))"""
+        self.connection.executemany(query, batch.files)
+        query = """insert or replace into objects
+                   (hash, algorithm, extension, size, partial, storage, codec)
+                   values (?, ?, ?, ?, ?, ?, ?)"""
+        self.connection.executemany(query, batch.objects)
+
+    def _write_batch(self, batch):
+        """
+        Write the rows and metadata of a batch of imported files in one
+        short transaction.  Raises StashError if a chunk or packed
+        record which the batch refers to was removed meanwhile by a
+        garbage collection in another process, in which case none of
+        the batch is recorded.
+        """
+        try:
+            with self.database.writing():
+                self._insert_rows(batch)
+                self._set_fields_many(batch.metadata)
+                self.connection.executemany("""insert or replace into
+                    sync_manifest (source, path, size, mtime, hash)
+                    values (?, ?, ?, ?, ?)""", batch.synced)
+        except KeyError as E:
+            raise StashError('The record %s was removed while the batch was '
+                             'being imported.'%E.args[0])
+
+    def import_tree(self, path, value_dict=None, workers=None,
+                        batch_size=500, callback=None, single_pass=False):
+        """
+        Import every file below a directory.  The files are hashed by
+        a pool of worker processes, files which are already in the
+        stash are skipped, and the database is committed once per
+        batch.  The value_dict may be a dict of metadata for all of
+        the files, or a function which returns the metadata for a
+        given path.  If provided, callback is called with the
+        ImportResult for each file.  Returns an ImportReport.
+
+        If single_pass is True the workers copy each file into the
+        stash while hashing it, so each file is read only once, and
+        the copies of duplicate files are discarded.  Files which the
+        prefilter proves to be new are always imported that way, since
+        they do not need to be hashed before they are copied.  If the
+        stash uses a hash cache, files with cached hashes are not read
+        before they are copied.  With chunk storage, files are never
+        copied by the workers, since the chunk store only writes the
+        chunks which it does not already have.  Files which are to be
+        compressed are always compressed by the workers, while they are
+        being hashed.
+        """
+        if not os.path.isdir(path):
+            raise StashError('%s is not a directory.'%path)
+        return self._import_paths(walk_files(path), value_dict, workers,
+                                  batch_size, callback, single_pass)
+
+    def _import_paths(self, filenames, value_dict=None, workers=None,
+                          batch_size=500, callback=None, single_pass=False,
+                          manifest_row=None):
+        """
+        Import the files in an iterable of pathnames, as described for
+        import_tree.  If manifest_row is provided, it is called with each
+        ImportResult which has a hash and returns a row for the
+        sync_manifest table, which is written with the rest of the batch.
+        """
+        report = ImportReport()
+        seen = set()
+        if workers == 1:
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(workers,
+                initializer=hashing.configure,
+                initargs=(hashing.block_size, hashing.mmap_threshold))
+        chunksize = max(1, batch_size // (4*(workers or os.cpu_count() or 1)))
+        algorithms = [self.tree.algorithm] + self.legacy_algorithms()
+        copying = self.storage != 'chunks'
+        os.makedirs(self.tree.tempdir, exist_ok=True)
+        work = partial(_import_work, tempdir=self.tree.tempdir,
+                       algorithms=algorithms)
+        try:
+            for batch in batches(filenames, batch_size):
+                cached, stats, jobs = {}, {}, []
+                staged = ImportBatch()
+                for filename in batch:
+                    hashes = self._cached_hashes(filename, algorithms, stats)
+                    if hashes:
+                        cached[filename] = hashes
+                    else:
+                        codec = self._codec_for(filename)
+                        copy = copying and not self._packable(filename) and (
+                            bool(codec) or single_pass or
+                            self._is_new(filename))
+                        jobs.append((filename, copy, codec))
+                if executor:
+                    results = executor.map(work, jobs, chunksize=chunksize)
+                else:
+                    results = map(work, jobs)
+                results = iter(results)
+                for filename in batch:
+                    if filename in cached:
+                        hash_strings, temp_path, error = (
+                            cached[filename], None, None)
+                    else:
+                        hash_strings, temp_path, error = next(results)
+                        if hash_strings and filename in stats:
+                            self.hash_cache.store(stats[filename],
+                                algorithms, hash_strings)
+                    with self.database.lock:
+                        result = self._import_one(filename, hash_strings,
+                            temp_path, error, value_dict, seen, staged)
+                    if manifest_row and result.hash_string:
+                        staged.synced.append(manifest_row(result))
+                    report.add(result)
+                    if callback:
+                        callback(result)
+                self._write_batch(staged)
+                if self.hash_cache:
+                    self.hash_cache.commit()
+        finally:
+            if executor:
+                executor.shutdown()
+        report.done()
+        return report
 
+    def import_archive(self, path, value_dict=None, manifest=None,
+                           workers=None, batch_size=500, callback=None):
+        """
+        Import every file in a zip or tar archive without extracting the
+        archive.  Each member is read once, and is hashed, and compressed
+        if a codec applies, while it is written into the temporary
+        directory of the tree, as by insert_stream.  The members of a
+        zip archive are read by a pool of threads, while those of a tar
+        archive, which can only be read efficiently in order, are read
+        one at a time.  The value_dict may be a dict of metadata for all
+        of the files, or a function which returns the metadata for a
+        given member path.  If manifest is the path of a member which
+        contains a JSON object mapping member paths to dicts of metadata,
+        those values are added to the metadata of each member, and the
+        manifest itself is not imported.  The database is committed
+        once per batch.  Returns an ImportReport whose results have the
+        member paths as their paths.
+        """
+        try:
+            archive = Archive(path)
+        except (OSError, ValueError) as E:
+            raise StashError(str(E))
+        with archive:
+            extra = {}
+            if manifest:
+                try:
+                    extra = json.loads(archive.read(manifest))
+                except KeyError:
+                    raise StashError('The archive has no member %s.'%manifest)
+                except (ValueError, *read_errors) as E:
+                    raise StashError('Could not read the manifest: %s'%E)
+            def metadata(name):
+                values = value_dict(name) if callable(value_dict) else (
+                    value_dict)
+                if name in extra:
+                    values = dict(values or {})
+                    values.update(extra[name])
+                return values
+            return self._import_members(archive, metadata, manifest, workers,
+                                        batch_size, callback)
+
+    def _import_members(self, archive, metadata, manifest, workers,
+                            batch_size, callback):
+        """
+        Import the members of an open Archive, as described for
+        import_archive.
+        """
+        report = ImportReport()
+        seen = set()
+        algorithms = [self.tree.algorithm] + self.legacy_algorithms()
+        os.makedirs(self.tree.tempdir, exist_ok=True)
+        def work(member):
+            name, size, info = member
+            try:
+                with archive.open(info) as infile:
+                    return stream_and_hash(infile, self.tree.tempdir,
+                        algorithms, self._codec_for(name)), None
+            except read_errors as E:
+                return None, str(E)
+        members = (member for member in archive.members()
+                   if member[0] != manifest)
+        executor = ThreadPoolExecutor(workers) if archive.parallel else None
+        def outcomes():
+            if executor:
+                for batch in batches(members, batch_size):
+                    yield from zip(batch, executor.map(work, batch))
+            else:
+                # Each member of a tar archive is read right after its
+                # header, so a compressed archive is never rewound.
+                for member in members:
+                    yield member, work(member)
+        try:
+            for batch in batches(outcomes(), batch_size):
+                staged = ImportBatch()
+                for (name, size, _), (stored, error) in batch:
+                    if error:
+                        result = ImportResult(name, status='error',
+                                              size=size, error=error)
+                    else:
+                        with self.database.lock:
+                            result = self._import_member(name, *stored,
+                                metadata(name), seen, staged)
+                    report.add(result)
+                    if callback:
+                        callback(result)
+                self._write_batch(staged)
+        finally:
+            if executor:
+                executor.shutdown()
+        report.done()
+        return report
+
+    def _import_member(self, name, temp_path, hash_strings, size, partial,
+                           metadata, seen, batch):
+        """
+        Store one archive member, which stream_and_hash has copied to
+        temp_path, for import_archive and return its result.  Its rows
+        and metadata are added to the ImportBatch, as for _import_one.
+        """
+        hash_string = hash_strings[0]
+        if hash_string in seen or not all(
+                self.check_hash(h) for h in hash_strings):
+            self.tree.discard(temp_path)
+            return ImportResult(name, hash_string, 'duplicate', size)
+        filename = member_filename(name)
+        try:
+            storage, codec = self._store_temp(temp_path, filename,
+                hash_string, size, self._codec_for(filename), batch)
+            self._add_rows(batch, filename, hash_string, storage, codec,
+                           size, partial)
+        except (OSError, ValueError, sqlite3.Error) as E:
+            self.tree.discard(temp_path)
+            return ImportResult(name, hash_string, 'error', size, str(E))
+        seen.add(hash_string)
+        if metadata:
+            batch.metadata.append(dict(metadata, hash=hash_string))
+        strategy = storage if storage != 'tree' else codec or 'stream'
+        return ImportResult(name, hash_string, 'imported', size,
+                            strategy=strategy)
+
+    def sync(self, source, value_dict=None, workers=None, callback=None):
+        """
+        Bring the stash up to date with a source directory.  The source
+        is scanned with stat calls and compared with a manifest of the
+        size and modification time of each file seen by the previous
+        sync, and only files which are new or have changed are imported,
+        as by import_tree.  Files removed from the source remain in the
+        stash.  Returns an ImportReport whose unchanged attribute is the
+        number of files which were skipped.
+        """
+        if not os.path.isdir(source):
+            raise StashError('%s is not a directory.'%source)
+        source = os.path.abspath(source)
+        query = 'select path, size, mtime from sync_manifest where source=?'
+        manifest = {path: (size, mtime) for path, size, mtime in
+                    self.connection.execute(query, (source,))}
+        changed, stats, present = [], {}, set()
+        for filename in walk_files(source):
+            relpath = os.path.relpath(filename, source)
+            present.add(relpath)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            stats[filename] = stat
+            if manifest.get(relpath) != (stat.st_size, stat.st_mtime_ns):
+                changed.append(filename)
+        def manifest_row(result):
+            stat = stats[result.path]
+            return (source, os.path.relpath(result.path, source),
+                    stat.st_size, stat.st_mtime_ns, result.hash_string)
+        report = self._import_paths(changed, value_dict, workers,
+                                    callback=callback,
+                                    manifest_row=manifest_row)
+        gone = [(source, path) for path in manifest if path not in present]
+        with self.database.writing():
+            self.connection.executemany(
+                'delete from sync_manifest where source=? and path=?', gone)
+        report.unchanged = len(present) - len(changed)
+        return report
+
+    def _cached_hashes(self, filename, algorithms, stats):
+        """
+        Return the hashes of a file from the hash cache, if there is one
+        and they are in it.  The stat result of the file is saved in the
+        dict stats so the hashes can be cached after they are computed.
+        """
+        if self.hash_cache is None:
+            return None
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        stats[filename] = stat
+        return self.hash_cache.lookup(stat, algorithms)
+
+    def _hash_source(self, filename, algorithms):
+        """
+        Hash a file which is to be imported, using the hash cache if
+        there is one.
+        """
+        if self.hash_cache:
+            return self.hash_cache.hash_file(filename, algorithms)
+        return hash_file_all(filename, algorithms)
+
+    def use_hash_cache(self, path=None, shared=False, max_entries=1000000,
+                           max_age=None):
+        """
+        Remember the hashes of imported files in a cache keyed by their
+        device, inode, size and modification time, so that files which
+        have not changed are not hashed again when they are imported or
+        checked.  By default the cache is kept in the stash directory;
+        if shared is True it is kept in the user's cache directory and
+        shared by all stashes.  Entries are evicted when they have not
+        been used for max_age seconds or, least recently used first,
+        when there are more than max_entries.
+        """
+        if self.hash_cache:
+            self.hash_cache.close()
+        if path is None:
+            if shared:
+                path = user_cache_path()
+            else:
+                path = os.path.join(self.stashdir, 'hashcache.stash')
+        self.hash_cache = HashCache(path, max_entries, max_age)
+
+    def _is_new(self, filename):
+        try:
+            return self.prefilter(filename)
+        except OSError:
+            # The worker will report the error.
+            return False
+
+    def _import_one(self, filename, hash_strings, temp_path, error,
+                        value_dict, seen, batch):
+        """
+        Store one hashed file for import_tree and return its result.
+        The first of the hash_strings uses the current algorithm and
+        any others use legacy algorithms.  If temp_path is not None it
+        is a copy of the file which was made while hashing.  The rows
+        and metadata of the file are added to the ImportBatch, to be
+        written for the whole batch at once.
+        """
+        hash_string = hash_strings[0] if hash_strings else None
+        try:
+            size = os.path.getsize(filename)
+        except OSError as E:
+            error = str(E)
+            size = 0
+        if error:
+            if temp_path:
+                self.tree.discard(temp_path)
+            return ImportResult(filename, status='error', size=size,
+                                    error=error)
+        if hash_string in seen or not all(
+                self.check_hash(h) for h in hash_strings):
+            if temp_path:
+                self.tree.discard(temp_path)
+            return ImportResult(filename, hash_string, 'duplicate', size)
+        if callable(value_dict):
+            metadata = value_dict(filename)
+        else:
+            metadata = value_dict
+        codec = self._codec_for(filename)
+        try:
+            strategy, storage, codec = self._store_object(filename,
+                hash_string, temp_path, codec, batch)
+            self._add_rows(batch, filename, hash_string, storage, codec)
+        except (OSError, ValueError, sqlite3.Error) as E:
+            return ImportResult(filename, hash_string, 'error', size, str(E))
+        seen.add(hash_string)
+        if metadata:
+            batch.metadata.append(dict(metadata, hash=hash_string))
+        return ImportResult(filename, hash_string, 'imported', size,
+                                strategy=strategy)
+
+    def scrub(self, workers=None, bandwidth=None, restart=False,
+                  batch_size=200, callback=None):
+        """
+        Verify that every file in the stash has an object whose content
+        matches its hash, and look for orphaned objects which belong to
+        no file.  The objects are rehashed by a pool of worker
+        processes, which together read at most bandwidth bytes per
+        second if bandwidth is given.  Progress is checkpointed in the
+        database after each batch, so an interrupted scrub resumes where
+        it stopped unless restart is True.  If provided, callback is
+        called with (hash_string, status, detail) for each object.
+        Returns a ScrubReport.
+        """
+        report = ScrubReport()
+        checkpoint = self.get_setting('scrub_checkpoint')
+        if checkpoint is None or restart:
+            checkpoint = 0
+            with self.database.writing():
+                self.connection.execute('delete from scrub_results')
+                self.set_setting('scrub_checkpoint', checkpoint)
+        else:
+            report.resumed = True
+            checkpoint = int(checkpoint)
+        pool_size = workers or os.cpu_count() or 1
+        rate = bandwidth / pool_size if bandwidth else None
+        if workers == 1:
+            executor = None
+            init_worker(rate)
+        else:
+            executor = ProcessPoolExecutor(pool_size, initializer=init_worker,
+                initargs=(rate, hashing.block_size, hashing.mmap_threshold))
+        query = """select files._file_id, files.hash,
+                   coalesce(objects.algorithm, ?), objects.storage,
+                   objects.codec
+                   from files left join objects on files.hash=objects.hash
+                   where files._file_id > ? order by files._file_id limit ?"""
+        try:
+            while True:
+                rows = self.connection.execute(query, (default_algorithm,
+                    checkpoint, batch_size)).fetchall()
+                if not rows:
+                    break
+                jobs = [(hash_string, self._stored_path(hash_string),
+                         algorithm, codec)
+                        for _, hash_string, algorithm, storage, codec
+                        in rows if storage is None]
+                if executor:
+                    results = executor.map(verify_object, jobs)
+                else:
+                    results = map(verify_object, jobs)
+                # Chunked and packed objects are read through the
+                # database, so they are verified in this process.
+                results = itertools.chain(results, (
+                    verify_stream(hash_string,
+                        partial(self._open_object, hash_string), algorithm,
+                        bandwidth)
+                    for _, hash_string, algorithm, storage, _ in rows
+                    if storage is not None))
+                problems = []
+                for hash_string, status, detail in results:
+                    report.checked += 1
+                    if status == 'ok':
+                        report.bytes += detail
+                    else:
+                        problems.append((hash_string, status, str(detail)))
+                    if callback:
+                        callback(hash_string, status, detail)
+                checkpoint = rows[-1][0]
+                with self.database.writing():
+                    self.connection.executemany("""insert or replace into
+                        scrub_results (hash, status, detail)
+                        values (?, ?, ?)""", problems)
+                    self.set_setting('scrub_checkpoint', checkpoint)
+        finally:
+            if executor:
+                executor.shutdown()
+        known = {row[0] for row in self.connection.execute(
+            'select hash from files')}
+        report.orphaned = [path for hash_string, _, path in self.tree.walk()
+                           if hash_string not in known]
+        rows = self.connection.execute(
+            'select hash, status, detail from scrub_results')
+        for hash_string, status, detail in rows:
+            getattr(report, status).append((hash_string, detail))
+        self.delete_setting('scrub_checkpoint')
+        self.set_setting('scrub_finished', time.strftime('%Y-%m-%d %H:%M:%S'))
+        report.done()
+        return report
+
+    def collect_garbage(self, dry_run=False, grace=3600):
+        """
+        Remove objects which belong to no file, such as those left by a
+        crash during an import, temporary files, keyword links to files
+        or keywords which no longer exist, and object records for files
+        which no longer exist.  The tree is walked once and the database
+        is compared using set operations.  Objects, temporary files and
+        pack files modified less than grace seconds ago are left alone,
+        since they may belong to an import which is still running.  If
+        dry_run is True nothing is removed.  Returns a GarbageReport.
+        """
+        report = GarbageReport(dry_run)
+        cutoff = time.time() - grace
+        known = {row[0] for row in self.connection.execute(
+            'select hash from files')}
+        for hash_string, _, path in self.tree.walk():
+            if hash_string not in known:
+                stat = os.stat(path)
+                if stat.st_mtime < cutoff:
+                    report.orphaned.append(path)
+                    report.bytes += stat.st_size
+        for dir in (self.tree.tempdir, self.tree.cachedir):
+            if not os.path.isdir(dir):
+                continue
+            for entry in os.scandir(dir):
+                stat = entry.stat()
+                if entry.is_file() and stat.st_mtime < cutoff:
+                    report.temporary.append(entry.path)
+                    report.bytes += stat.st_size
+        if not dry_run:
+            for path in report.orphaned + report.temporary:
+                self.tree.discard(path)
+        dangling = """from keyword_x_file
+            where _file_id not in (select _file_id from files)
+            or _keyword_id not in (select _keyword_id from keywords)"""
+        stale = """from objects
+            where hash not in (select hash from files)"""
+        manifests = """select distinct hash from object_chunks
+            where hash not in (select hash from files)"""
+        packed = """select key from packed where refs > 0
+            and key not in (select hash from files)"""
+        # The stale records are found and removed in one transaction, so
+        # that records committed meanwhile by an import are not removed.
+        with self.database.writing(immediate=not dry_run):
+            report.dangling_links = self.connection.execute(
+                'select _file_id, _keyword_id ' + dangling).fetchall()
+            report.stale_objects = [row[0] for row in self.connection.execute(
+                'select hash ' + stale)]
+            stale_manifests = [row[0] for row in self.connection.execute(
+                manifests)]
+            stale_packed = [row[0] for row in self.connection.execute(packed)]
+            report.stale_records = stale_manifests + stale_packed
+            for store in (self.chunks.packs, self.packed):
+                count, size = store.garbage()
+                report.dead_records += count
+                if dry_run:
+                    report.bytes += size
+            if dry_run:
+                return report
+            self.connection.execute('delete ' + dangling)
+            self.bitmaps.clear()
+            self.connection.execute('delete ' + stale)
+            self.connection.execute("""delete from scrub_results
+                where hash not in (select hash from files)""")
+            for hash_string in stale_manifests:
+                self.chunks.delete(hash_string)
+            for hash_string in stale_packed:
+                self.packed.release(hash_string, forget=True)
+        report.bytes += self.compact_packs(grace=grace)
+        return report
+
+    @_serialized
     def delete_file(self, hash_string):
         """
         Remove a file from the stash.
         """
-        self.tree.delete(hash_string)
+        storage = self._stored_as(hash_string)[0]
+        if self.tree.hot and storage != 'tree':
+            query = 'select extension from objects where hash=?'
+            row = self.connection.execute(query, (hash_string,)).fetchone()
+            if row and row[0] is not None:
+                self.tree.hot.discard(hash_string + row[0])
+        if storage == 'chunks':
+            self.chunks.delete(hash_string)
+        elif storage == 'packed':
+            self.packed.release(hash_string, forget=True)
+        else:
+            path = self._stored_path(hash_string)
+            if path is not None:
+                self.tree.delete(hash_string, os.path.splitext(path)[1])
+        for name in self.tree.listing(self.tree.cachedir):
+            if os.path.splitext(name)[0] == hash_string:
+                self.tree.discard(os.path.join(self.tree.cachedir, name))
+        query = 'select _file_id from files where hash=?'
+        for file_id, in self.connection.execute(query,
+                (hash_string,)).fetchall():
+            self.connection.execute(
+                'delete from keyword_x_file where _file_id=?', (file_id,))
+            self.bitmaps.remove_file(file_id)
         query = "delete from files where hash='%s'"%hash_string
         self.connection.execute(query)
+        query = "delete from objects where hash='%s'"%hash_string
+        self.connection.execute(query)
         self.connection.commit()
 
     def export_file(self, hash_string, export_path):
         """
-        Copy a file in the stash to another location.
+        Copy a file in the stash to another location.  Returns the name
+        of the copy strategy which was used, e.g. 'reflink'.  Chunked,
+        packed and compressed objects are streamed, and the strategy is
+        'stream'.  If a hot cache is in use, the object is copied into
+        it first and exported from there.
         """
-        if os.path.exists(export_path):
+        try:
+            hot_path = self._hot_path(hash_string)
+            if hot_path is not None:
+                return copy_file(hot_path, export_path, exclusive=True)
+            if self._stored_as(hash_string) == ('tree', None):
+                return copy_file(self._stored_path(hash_string), export_path,
+                                     exclusive=True)
+            with self._open_object(hash_string) as infile:
+                with open(export_path, 'xb') as outfile:
+                    shutil.copyfileobj(infile, outfile, 1 << 20)
+            return 'stream'
+        except FileExistsError:
             raise StashError('File exists.')
-        source = open(self.tree.find(hash_string), 'rb')
-        target = open(export_path, 'wb')
-        while True:
-            block = source.read(8192)
-            if not block:
-                break
-            target.write(block)
-        source.close()
-        target.close()
-    
+        except KeyError:
+            raise StashError('The object %s is missing.'%hash_string)
+
     def view_file(self, hash_string):
         """
         Open a viewer for a file.
         """
-        path = self.tree.find(hash_string)
+        path = self.object_path(hash_string)
         if sys.platform == 'darwin':
             # The webrowser module uses Preview for pdf files and Preview sets
             # the quarantine xattr whenever it is opens a file.  So far, it
@@ -216,59 +1873,178 @@ class Stash:
             # the file.  Now that we are using a real browser this is not an
             # issue.  Still, just in case ...
             subprocess.call(['xattr', '-c', path])
+        # Imported here so that a stash can be used without a browser.
+        from .browse import browser
         browser.open_new_tab('file://%s'%path)
 
+    @_serialized
     def set_fields(self, value_dict):
         """
         Update the metadata for a file.
         """
-        hash_string = value_dict['hash']
-        query = 'select _file_id from files where hash="%s"'%hash_string
-        file_id = self.connection.execute(query).fetchall()[0][0]
-        query = 'select * from keywords'
-        keyword_data = self.connection.execute(query).fetchall()
-        keyword_ids = dict((keyword, id) for id, keyword in keyword_data)
-        file_keywords = set(value_dict['keywords'])
-        query = 'update files set '
-        query += ', '.join(['"%s"=\'%s\''%(
-            key, str(value_dict[key]).replace("'","''"))
-            for key in value_dict.keys()
-            if key[0] != '_' and key not in ('hash', 'keywords')])
-        query += " where hash='%s'"%hash_string
-        self.connection.execute(query)
-        for keyword in keyword_ids:
-            if keyword in file_keywords:
-                query = """insert or ignore into keyword_x_file
-                        (_file_id, _keyword_id)
-                        values (%s, %s)"""%(file_id, keyword_ids[keyword])
-            else:
-                query = """delete from keyword_x_file
-                        where _file_id=%s and _keyword_id=%s """%(
-                            file_id, keyword_ids[keyword])
-            self.connection.execute(query)
+        self._set_fields(value_dict)
         self.connection.commit()
-        
-    def find_files(self, where_clause, keywords=[]):
-        """ Query the stash database."""
-        files_by_hash = {}
-        old_factory = self.connection.row_factory
-        self.connection.row_factory = sqlite3.Row
-        if keywords:
-            kw_clause = 'keywords._keyword in (%s) and ' % ','.join(
-                ['"%s"'%kw for kw in keywords])
+
+    @_serialized
+    def set_fields_many(self, records):
+        """
+        Update the metadata for many files in one transaction.  Each
+        record is a dict like the one passed to set_fields, containing
+        the hash of a file and values for any of its fields.  The
+        keywords of a file are only changed if its record has a list of
+        keywords, and then only the links which differ from that list
+        are written.  Records for files which are not in the stash are
+        ignored.
+        """
+        self._set_fields_many(records)
+        self.connection.commit()
+
+    def _set_fields(self, value_dict):
+        self._set_fields_many([value_dict])
+
+    def _set_fields_many(self, records):
+        query = 'select _keyword, _keyword_id from keywords'
+        keyword_ids = dict(self.connection.execute(query).fetchall())
+        # Updates of the same set of fields share one statement.
+        updates = defaultdict(list)
+        file_keywords = {}
+        for record in records:
+            hash_string = record['hash']
+            names = tuple(key for key in record if key[0] != '_' and
+                          key not in ('hash', 'keywords'))
+            if names:
+                updates[names].append(
+                    [str(record[name]) for name in names] + [hash_string])
+            if 'keywords' in record:
+                file_keywords[hash_string] = {keyword_ids[keyword]
+                    for keyword in record['keywords']
+                    if keyword in keyword_ids}
+        for names, rows in updates.items():
+            query = 'update files set %s where hash=?'%', '.join(
+                '"%s"=?'%name.replace('"', '') for name in names)
+            self.connection.executemany(query, rows)
+        if file_keywords:
+            self._link_keywords(file_keywords)
+
+    def _link_keywords(self, file_keywords):
+        """
+        Make the keyword links of files match a dict mapping hashes to
+        sets of keyword ids, adding and removing only the links which
+        differ.
+        """
+        file_ids, links = {}, defaultdict(set)
+        hashes = list(file_keywords)
+        for start in range(0, len(hashes), 500):
+            some = hashes[start:start + 500]
+            marks = ', '.join('?'*len(some))
+            query = 'select hash, _file_id from files where hash in (%s)'%marks
+            file_ids.update(self.connection.execute(query, some).fetchall())
+            query = """select files.hash, keyword_x_file._keyword_id
+                       from keyword_x_file join files
+                       on keyword_x_file._file_id=files._file_id
+                       where files.hash in (%s)"""%marks
+            for hash_string, keyword_id in self.connection.execute(query,
+                                                                   some):
+                links[hash_string].add(keyword_id)
+        added, removed = [], []
+        for hash_string, keywords in file_keywords.items():
+            file_id = file_ids.get(hash_string)
+            if file_id is None:
+                continue
+            current = links[hash_string]
+            added += [(file_id, k) for k in keywords - current]
+            removed += [(file_id, k) for k in current - keywords]
+        self.connection.executemany("""insert or ignore into keyword_x_file
+            (_file_id, _keyword_id) values (?, ?)""", added)
+        self.connection.executemany("""delete from keyword_x_file
+            where _file_id=? and _keyword_id=?""", removed)
+        self.bitmaps.update(added, removed)
+
+    def find_files(self, where_clause, keywords=[], rank=None,
+                       all_keywords=(), no_keywords=()):
+        """
+        Query the stash database.  The files which are returned must
+        have at least one of the keywords, if any are given, all of the
+        all_keywords and none of the no_keywords.  The keyword tests use
+        the keyword bitmaps, and the where clause is applied to the
+        files they select, without adding any names to its scope.  If
+        rank is a list of (column, term) pairs, as for match_clause,
+        only files which match any of them are returned, in order of
+        relevance by the BM25 ranking of the full-text index.  The where
+        clause must not have an order by clause in that case.  Without a
+        full-text index rank is ignored.
+        """
+        if rank and self.full_text:
+            columns = self.text_columns()
+            rank = [(column, term) for column, term in rank
+                    if column is None or column in columns]
+        if rank and self.full_text:
+            rank_join = """ join (select rowid as _rowid, rank as _rank
+                from files_fts where files_fts match %s) as hits
+                on hits._rowid=files._file_id"""%sql_string(
+                    match_expression(rank, any_term=True))
+            order_by = ' order by hits._rank'
         else:
-            kw_clause = ''
-        query = """select distinct files.* from files left join
-                (
-                keyword_x_file inner join keywords
-                on keyword_x_file._keyword_id=keywords._keyword_id
-                )
-            on files._file_id=keyword_x_file._file_id
-            where """ + kw_clause + where_clause
-        rows = self.connection.execute(query).fetchall()
-        self.connection.row_factory = old_factory
+            rank_join = order_by = ''
+        selected, excluded = self.keyword_selection(keywords, all_keywords,
+                                                    no_keywords)
+        if selected is not None:
+            selected &= ~excluded
+            excluded = 0
+        if selected is None:
+            files, parameters = 'files', ()
+        else:
+            files = """(select * from files where _file_id in
+                (select value from json_each(?))) as files"""
+            parameters = ('[%s]'%','.join(map(str, members(selected))),)
+        query = ('select files.* from ' + files + rank_join +
+                 ' where ' + where_clause + order_by)
+        connection = self.database.reader()
+        if self.advisor:
+            self._advise(connection, query, parameters)
+        cursor = connection.cursor()
+        cursor.row_factory = sqlite3.Row
+        rows = cursor.execute(query, parameters).fetchall()
+        if excluded:
+            excluded = set(members(excluded))
+            rows = [row for row in rows if row['_file_id'] not in excluded]
         return rows
 
+    def keyword_selection(self, any_keywords=(), all_keywords=(),
+                              no_keywords=()):
+        """
+        Return a pair of keyword bitmaps (selected, excluded).  The
+        selected bitmap has the bits of the files which have one of the
+        any_keywords, if there are some, and all of the all_keywords, or
+        is None if both are empty.  The excluded bitmap has the bits of
+        the files which have one of the no_keywords.  Bit n stands for
+        the file whose _file_id is n.
+        """
+        query = 'select _keyword, _keyword_id from keywords'
+        with self.database.lock:
+            self.bitmaps.refresh()
+            keyword_ids = dict(self.connection.execute(query).fetchall())
+            def bitmap(keyword):
+                keyword_id = keyword_ids.get(keyword)
+                if keyword_id is None:
+                    return 0
+                return self.bitmaps.bitmap(keyword_id)
+            selected = None
+            if any_keywords:
+                selected = 0
+                for keyword in any_keywords:
+                    selected |= bitmap(keyword)
+            for keyword in all_keywords:
+                if selected is None:
+                    selected = bitmap(keyword)
+                else:
+                    selected &= bitmap(keyword)
+            excluded = 0
+            for keyword in no_keywords:
+                excluded |= bitmap(keyword)
+        return selected, excluded
+
+    @_serialized
     def set_preference(self, name, value, target='_all_'):
         """
         Save a preference in the preferences table.
@@ -277,22 +2053,76 @@ class Stash:
         result = self.connection.execute(query%(name, value, target))
         self.connection.commit()
 
+    def set_setting(self, name, value):
+        """
+        Save a setting which belongs to the stash itself, rather than to
+        the viewer.  Settings are stored in the preferences table.
+        """
+        self.set_preference(name, value, target='_stash_')
+
+    def get_setting(self, name, default=None):
+        """
+        Retrieve a stash setting, or the default if it has not been set.
+        """
+        query = """select value from preferences
+                   where name=? and target='_stash_'"""
+        row = self.connection.execute(query, (name,)).fetchone()
+        return default if row is None else row[0]
+
+    @_serialized
+    def delete_setting(self, name):
+        """
+        Remove a stash setting.
+        """
+        query = "delete from preferences where name=? and target='_stash_'"
+        self.connection.execute(query, (name,))
+        self.connection.commit()
+
     def get_preference(self, name):
         """
         Retrieve a preference from the preferences table.
         """
         query = "select * from preferences where name='%s'"%name
-        old_factory = self.connection.row_factory
-        self.connection.row_factory = sqlite3.Row
-        result = self.connection.execute(query)
-        self.connection.row_factory = old_factory
-        return result.fetchall()
+        cursor = self.database.reader().cursor()
+        cursor.row_factory = sqlite3.Row
+        return cursor.execute(query).fetchall()
 
     def close(self):
         """
         Detach a stash directory.
         """
-        if self.connection:
-            self.connection.close()
+        if self.database:
+            # Let sqlite run analyze if the statistics are out of date.
+            with self.database.writing():
+                self.connection.execute('pragma optimize')
+            self.database.close()
+            self.database = None
             self.connection = None
+        if self.hash_cache:
+            self.hash_cache.close()
+            self.hash_cache = None
+        if self.chunks:
+            self.chunks.close()
+            self.chunks = None
+        if self.packed:
+            self.packed.close()
+            self.packed = None
         self.stashdir = None
+
+def _import_work(job, tempdir, algorithms):
+    """
+    Hash a file in a worker process, returning a triple
+    (hashes, temp_path, error).  The job is a triple (filename, copy,
+    codec).  If copy is True the file is copied into tempdir while it
+    is hashed, and compressed if codec is not None, otherwise temp_path
+    is None.
+    """
+    filename, copy, codec = job
+    try:
+        if not copy:
+            return hash_file_all(filename, algorithms), None, None
+        temp_path, hash_strings = copy_and_hash(filename, tempdir, algorithms,
+                                                codec)
+        return hash_strings, temp_path, None
+    except OSError as E:
+        return None, None, str(E)
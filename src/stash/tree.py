@@ -24,9 +24,74 @@
 import os
 import sys
 import subprocess
-import hashlib
 import shutil
-import base62
+import tempfile
+import string
+from .copier import copy_file
+from .compression import new_compressor
+from .hashing import (default_algorithm, new_hasher, encode, hash_file,
+                      check_algorithm, file_blocks, blocks, PartialHasher)
+
+def copy_and_hash(filename, tempdir, algorithms=(default_algorithm,),
+                      codec=None):
+    """
+    Copy a file into a temporary file in tempdir, hashing the data as
+    it is copied.  Returns the pair (temp_path, hash_strings) where
+    hash_strings contains one hash for each algorithm.  The source file
+    is only read once.  If a codec is given the copy is compressed with
+    it.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=tempdir, prefix='import-')
+    try:
+        hashers = [new_hasher(algorithm) for algorithm in algorithms]
+        compressor = new_compressor(codec) if codec else None
+        with os.fdopen(fd, 'wb') as outfile:
+            for block in file_blocks(filename):
+                for hasher in hashers:
+                    hasher.update(block)
+                if compressor:
+                    block = compressor.compress(block)
+                outfile.write(block)
+            if compressor:
+                outfile.write(compressor.flush())
+        shutil.copymode(filename, temp_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path, [encode(hasher) for hasher in hashers]
+
+def stream_and_hash(source, tempdir, algorithms=(default_algorithm,),
+                        codec=None):
+    """
+    Copy data into a temporary file in tempdir, hashing it as it is
+    copied, like copy_and_hash.  The source is a binary file object,
+    such as a pipe, or an iterable of bytes-like objects, and it is
+    read once.  Returns a tuple (temp_path, hash_strings, size,
+    partial) where size is the length of the data and partial is its
+    partial hash, since neither can be found from a compressed copy.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=tempdir, prefix='import-')
+    try:
+        hashers = [new_hasher(algorithm) for algorithm in algorithms]
+        partial = PartialHasher()
+        compressor = new_compressor(codec) if codec else None
+        with os.fdopen(fd, 'wb') as outfile:
+            data = blocks(source) if hasattr(source, 'read') else source
+            for block in data:
+                for hasher in hashers:
+                    hasher.update(block)
+                partial.update(block)
+                if compressor:
+                    block = compressor.compress(block)
+                outfile.write(block)
+            if compressor:
+                outfile.write(compressor.flush())
+        os.chmod(temp_path, 0o644)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return (temp_path, [encode(hasher) for hasher in hashers], partial.size,
+            partial.hexdigest())
 
 class Item:
     """
@@ -66,64 +131,307 @@ class Item:
         os.chmod(remove_path, 0o666)
         os.unlink(remove_path)
 
+base62_digits = set(string.digits + string.ascii_letters)
+
+def parse_layout(layout):
+    """
+    Convert a layout given as a string 'depth,width' or as a pair into
+    a pair of ints.
+    """
+    if isinstance(layout, str):
+        layout = layout.split(',')
+    depth, width = (int(x) for x in layout)
+    if not (1 <= depth <= 4 and 1 <= width <= 4):
+        raise ValueError('The shard depth and width must be between 1 and 4.')
+    return depth, width
+
 class StashTree:
     """
-    A collection of files named and ordered by their base 62 encoded md5 hash.
+    A collection of files named and ordered by their base 62 encoded hash.
+    New files are hashed with the tree's algorithm, which is md5 unless
+    the stash specifies another one.
+
+    The files are sharded into directories named by prefixes of the
+    hash.  The layout (depth, width) means that there are depth levels
+    of directories, each named by the next width characters of the
+    hash.  So the default layout (1, 2) stores a file as ab/abcd...,
+    and (2, 2) stores it as ab/cd/abcd... .  While the tree is being
+    resharded, old_layout is the layout which is being replaced.
     """
 
-    def __init__(self, rootpath):
+    def __init__(self, rootpath, algorithm=default_algorithm,
+                     cache_listings=False, layout=(1, 2), old_layout=None):
         self.root = os.path.abspath(rootpath)
+        self.algorithm = check_algorithm(algorithm)
+        self.layout = parse_layout(layout)
+        self.old_layout = parse_layout(old_layout) if old_layout else None
+        self._listings = {} if cache_listings else None
+        # The copy strategy used by the most recent insert.
+        self.last_strategy = None
+        # Temporary files live in a directory whose name cannot be
+        # a base62 prefix.
+        self.tempdir = os.path.join(self.root, '.tmp')
+        # Copies of objects which are not stored as files in the tree,
+        # made so that they can be opened by other programs.
+        self.cachedir = os.path.join(self.root, '.cache')
+        # An optional HotCache holding copies of recently used objects
+        # on a faster disk.
+        self.hot = None
+        # An optional function which reloads the layouts, called before
+        # an object is placed, since another process may be resharding.
+        self.reload_layout = None
 
     def hash_string(self, filename):
         """
-        Return the base62 encoding of the md5 hash of a file.
+        Return the base62 encoding of the hash of a file.
+        """
+        return hash_file(filename, self.algorithm)
+
+    def path(self, hash_string, extension, layout=None):
+        """
+        Return the pathname where an object with this hash and extension
+        is stored, using the current layout unless another is specified.
+        """
+        depth, width = layout or self.layout
+        shards = [hash_string[n*width:(n + 1)*width] for n in range(depth)]
+        return os.path.join(self.root, *shards, hash_string + extension)
+
+    def locate(self, hash_string, extension):
+        """
+        Return the pathname of an object.  This is the same as path,
+        except while the tree is being resharded, when the object may
+        still be in its old location.
         """
-        infile = open(filename, 'rb')
-        hasher = hashlib.md5()
-        while True:
-            block = infile.read(8192)
-            if not block:
-                break
-            hasher.update(block)
-        infile.close()
-        return base62.encode(int(hasher.hexdigest(), 16))
+        path = self.path(hash_string, extension)
+        if self.old_layout and not os.path.exists(path):
+            old_path = self.path(hash_string, extension, self.old_layout)
+            if os.path.exists(old_path):
+                return old_path
+        return path
 
-    def insert(self, filename, stash, hash_string=None):
+    def insert(self, filename, stash, hash_string=None, single_pass=False):
         """
         Add a new file to the stash.  If the hash is provided it will
-        be used, instead of computing the hash.
+        be used, instead of computing the hash.  If single_pass is True
+        and no hash is provided then the file is hashed while it is
+        being copied, so it is only read once.  Otherwise the copy is
+        made by the copier module, which avoids copying data through user
+        space when it can.
         """
         name, extension = os.path.splitext(filename)
+        if hash_string is None and single_pass:
+            temp_path, hash_string = self.copy_and_hash(filename)
+            if not stash.check_hash(hash_string):
+                self.discard(temp_path)
+                raise ValueError('Hash is in use already.')
+            self.commit(temp_path, hash_string, extension)
+            self.last_strategy = 'single pass'
+            return hash_string
         if hash_string is None:
             hash_string = self.hash_string(filename)
             if not stash.check_hash(hash_string):
                 raise ValueError('Hash is in use already.')
-        dir = os.path.join(self.root, str(hash_string[:2]))
-        os.makedirs(dir, exist_ok=True)
-        path = os.path.join(dir, hash_string + extension)
-        if not os.path.exists(path):
-            shutil.copy(filename, path)
-        else:
+        if self.reload_layout:
+            self.reload_layout()
+        path = self.path(hash_string, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            self.last_strategy = copy_file(filename, path, exclusive=True)
+        except FileExistsError:
             raise ValueError('File exists.')
+        shutil.copymode(filename, path)
+        self._cache(path)
         return hash_string
 
-    def delete(self, hash_string):
+    def copy_and_hash(self, filename):
+        """
+        Copy a file into the temporary directory of this tree, computing
+        its hash on the way.  Returns the pair (temp_path, hash_string).
+        """
+        os.makedirs(self.tempdir, exist_ok=True)
+        temp_path, hashes = copy_and_hash(filename, self.tempdir,
+                                              (self.algorithm,))
+        return temp_path, hashes[0]
+
+    def commit(self, temp_path, hash_string, extension):
         """
-        Delete a stashed file.
+        Move a temporary file created by copy_and_hash to its place in
+        the tree.
         """
-        dir = os.path.join(self.root, hash_string[:2])
-        for filename in os.listdir(dir):
-            if filename.startswith(hash_string):
-                break
-        else:
-            return
-        os.unlink(os.path.join(dir, filename))
+        if self.reload_layout:
+            self.reload_layout()
+        path = self.path(hash_string, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            self.discard(temp_path)
+            raise ValueError('File exists.')
+        os.replace(temp_path, path)
+        self._cache(path)
 
-    def find(self, hash_string):
+    def discard(self, path):
+        """
+        Remove a temporary file, e.g. one whose hash is a duplicate, or
+        an orphaned object.
+        """
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._uncache(path)
+
+    def delete(self, hash_string, extension=None):
+        """
+        Delete a stashed file, and its copy in the hot cache if there is
+        one.
+        """
+        if extension is None:
+            extension = self.find_extension(hash_string)
+            if extension is None:
+                return
+        if self.hot:
+            self.hot.discard(hash_string + extension)
+        path = self.locate(hash_string, extension)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._uncache(path)
+
+    def find(self, hash_string, extension=None):
         """
         Return the pathname of the stashed file with the specified hash.
+        If the extension is not known, which is the case for objects in
+        stashes created by older versions of Stash, the directory which
+        would contain the file is searched.  When there is a hot cache
+        which holds a copy of the file, the path of the copy is returned.
+        """
+        if extension is None:
+            extension = self.find_extension(hash_string)
+            if extension is None:
+                return None
+        if self.hot:
+            path = self.hot.get(hash_string + extension)
+            if path is not None:
+                return path
+        return self.locate(hash_string, extension)
+
+    def find_extension(self, hash_string):
+        """
+        Search the directory which would contain a stashed file for the
+        file, and return its extension or None if it is not there.
+        """
+        layouts = [self.layout]
+        if self.old_layout:
+            layouts.append(self.old_layout)
+        for layout in layouts:
+            dir = os.path.dirname(self.path(hash_string, '', layout))
+            for filename in self.listing(dir):
+                name, extension = os.path.splitext(filename)
+                if name == hash_string:
+                    return extension
+        return None
+
+    def shard_dirs(self, layout=None):
+        """
+        Generate the leaf directories of the tree for a layout, as pairs
+        (prefix, dir) where prefix is the concatenation of the shard
+        names.  Only directories whose names are valid shard names are
+        included, so the temporary directory and the directories of a
+        different layout are skipped.
         """
-        dir = os.path.join(self.root, hash_string[:2])
-        for filename in os.listdir(dir):
-            if filename.startswith(hash_string):
-                return os.path.join(self.root, hash_string[:2], filename)
+        depth, width = layout or self.layout
+        def is_shard(name):
+            return len(name) == width and set(name) <= base62_digits
+        level = [('', self.root)]
+        for n in range(depth):
+            next_level = []
+            for prefix, dir in level:
+                try:
+                    entries = sorted(os.scandir(dir), key=lambda e: e.name)
+                except FileNotFoundError:
+                    continue
+                next_level += [(prefix + e.name, e.path) for e in entries
+                               if e.is_dir() and is_shard(e.name)]
+            level = next_level
+        return level
+
+    def walk(self):
+        """
+        Generate a triple (hash_string, extension, path) for every object
+        in the tree, including objects which are waiting to be resharded.
+        Each directory is listed once.
+        """
+        layouts = [self.layout]
+        if self.old_layout and self.old_layout != self.layout:
+            layouts.append(self.old_layout)
+        for layout in layouts:
+            for prefix, dir in self.shard_dirs(layout):
+                for entry in os.scandir(dir):
+                    if entry.is_file() and entry.name.startswith(prefix):
+                        hash_string, extension = os.path.splitext(entry.name)
+                        yield hash_string, extension, entry.path
+
+    def reshard(self, callback=None):
+        """
+        Move every object which is stored in the old layout to its place
+        in the current layout.  Each move is a rename, so the tree stays
+        usable and an interrupted reshard can simply be run again.  If
+        provided, callback is called with each new pathname.  Returns
+        the number of objects which were moved.
+        """
+        if not self.old_layout or self.old_layout == self.layout:
+            return 0
+        count = 0
+        for prefix, dir in self.shard_dirs(self.old_layout):
+            for entry in os.scandir(dir):
+                name = entry.name
+                if not entry.is_file() or not name.startswith(prefix):
+                    continue
+                hash_string, extension = os.path.splitext(name)
+                path = self.path(hash_string, extension)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.rename(entry.path, path)
+                self._uncache(entry.path)
+                self._cache(path)
+                count += 1
+                if callback:
+                    callback(path)
+        self._remove_empty_dirs(self.old_layout)
+        return count
+
+    def _remove_empty_dirs(self, layout):
+        depth, width = layout
+        for n in range(depth, 0, -1):
+            for prefix, dir in self.shard_dirs((n, width)):
+                try:
+                    os.rmdir(dir)
+                except OSError:
+                    pass
+
+    def listing(self, dir):
+        """
+        Return the filenames in a directory of the tree.  If the tree was
+        created with cache_listings=True, each directory is only listed
+        once.
+        """
+        if self._listings is not None and dir in self._listings:
+            return self._listings[dir]
+        try:
+            names = set(os.listdir(dir))
+        except FileNotFoundError:
+            names = set()
+        if self._listings is not None:
+            self._listings[dir] = names
+        return names
+
+    def _cache(self, path):
+        if self._listings is not None:
+            dir, name = os.path.split(path)
+            if dir in self._listings:
+                self._listings[dir].add(name)
+
+    def _uncache(self, path):
+        if self._listings is not None:
+            dir, name = os.path.split(path)
+            if dir in self._listings:
+                self._listings[dir].discard(name)
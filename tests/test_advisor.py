@@ -0,0 +1,80 @@
+import sqlite3
+from stash.advisor import IndexAdvisor
+from stash.stash import Stash
+
+def make_stash(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.add_field('year', 'integer')
+    stash.add_field('author', 'text')
+    stash.add_field('notes', 'text')
+    for n in range(20):
+        source = tmp_path / ('note%d.txt' % n)
+        source.write_text('note %d' % n)
+        stash.insert_file(str(source), {'year': 2000 + n % 5,
+            'author': 'author %d' % n, 'notes': 'note %d' % n})
+    return stash
+
+def test_observe():
+    connection = sqlite3.connect(':memory:')
+    connection.execute('create table files (year integer, "first name" text)')
+    advisor = IndexAdvisor(threshold=2, log_size=3)
+    fields = ['year', 'first name']
+    assert advisor.observe(connection, 'select * from files where year > ?',
+                           fields, (2000,)) == ['year']
+    assert advisor.observe(connection,
+        'select * from files where 1 order by "first name"', fields) == [
+        'first name']
+    # Like patterns and mere mentions of a field cannot use an index.
+    assert advisor.observe(connection,
+        "select * from files where \"first name\" like '%a%'", fields) == []
+    assert advisor.observe(connection,
+        'select year from files where 1', fields) == []
+    assert len(advisor.log) == 3
+    assert advisor.log[-1][0] == 'select year from files where 1'
+    assert advisor.proposals() == []
+    advisor.observe(connection, 'select * from files where year between 1 '
+                    'and 2 order by "first name"', fields)
+    assert advisor.proposals() == ['year', 'first name']
+    assert advisor.proposals(indexed=['year']) == ['first name']
+    connection.execute('create index year_index on files(year)')
+    assert advisor.observe(connection, 'select * from files where year = 1',
+                           fields) == []
+
+def test_proposals(tmp_path):
+    stash = make_stash(tmp_path)
+    stash.use_index_advisor(threshold=3)
+    for n in range(3):
+        stash.find_files('year = %d' % (2000 + n))
+        stash.find_files("notes like '%%%d%%'" % n)
+    for n in range(5):
+        stash.find_files("author = 'author 1' order by author")
+    stash.find_files('1 order by year')
+    assert stash.advisor.proposals(stash.indexed_columns()) == [
+        'author', 'year']
+    # Indexed fields are not proposed, and are no longer counted.
+    stash.index_field('year')
+    assert 'year' in stash.indexed_columns()
+    assert stash.advisor.proposals(stash.indexed_columns()) == ['author']
+    stash.find_files('year = 2001')
+    assert stash.advisor.counts['year'] == 4
+    stash.drop_field_index('year')
+    assert 'year' not in stash.indexed_columns()
+    assert stash.advisor.proposals(stash.indexed_columns()) == [
+        'author', 'year']
+    assert [row['year'] for row in stash.find_files('year = 2001')] == [
+        2001] * 4
+    stash.close()
+
+def test_auto_index(tmp_path):
+    stash = make_stash(tmp_path)
+    stash.add_field('pages', 'integer', index=True)
+    assert 'pages' in stash.indexed_columns()
+    stash.use_index_advisor(auto_index=True, threshold=2)
+    stash.find_files("author = 'author 2'")
+    assert 'author' not in stash.indexed_columns()
+    rows = stash.find_files("author = 'author 2'")
+    assert 'author' in stash.indexed_columns()
+    assert len(rows) == len(stash.find_files("author = 'author 2'")) == 1
+    assert stash.advisor.counts['author'] == 2
+    stash.close()
@@ -0,0 +1,120 @@
+import io
+import gzip
+import json
+import tarfile
+import zipfile
+import pytest
+from stash.stash import Stash, StashError
+
+def test_tar_is_read_in_one_pass(tmp_path, monkeypatch):
+    source = tmp_path / 'source'
+    source.mkdir()
+    archive = str(tmp_path / 'notes.tar.gz')
+    with tarfile.open(archive, 'w:gz') as tar:
+        for n in range(25):
+            filename = source / ('note%02d.txt' % n)
+            filename.write_text('note %d' % n)
+            tar.add(str(filename), arcname='notes/' + filename.name)
+    rewinds = []
+    rewind = gzip._GzipReader._rewind
+    def counted_rewind(reader):
+        rewinds.append(reader)
+        rewind(reader)
+    monkeypatch.setattr(gzip._GzipReader, '_rewind', counted_rewind)
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    report = stash.import_archive(archive, batch_size=10)
+    assert len(report.imported) == 25
+    assert rewinds == []
+    for row in stash.find_files('1'):
+        with stash.open_object(row['hash']) as infile:
+            assert infile.read() == (source / row['filename']).read_bytes()
+    stash.close()
+
+NOTES = {'notes/a.txt': b'first note', 'notes/b.txt': b'second note',
+         'notes/old/c.txt': b'third note', 'copy.txt': b'first note'}
+MANIFEST = {'notes/a.txt': {'title': 'First'},
+            'notes/old/c.txt': {'title': 'Third', 'keywords': ['old']}}
+
+def make_stash(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.add_field('title', 'text')
+    stash.add_field('old', 'keyword')
+    return stash
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('notes/', b'')
+        for name, data in members.items():
+            archive.writestr(name, data)
+
+def write_tar(path, members, mode):
+    with tarfile.open(path, mode) as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+def check_import(stash, report, members):
+    assert sorted(result.path for result in report.imported) == [
+        'notes/a.txt', 'notes/b.txt', 'notes/old/c.txt']
+    assert [result.path for result in report.duplicates] == ['copy.txt']
+    assert report.errors == []
+    rows = {row['filename']: row for row in stash.find_files('1')}
+    assert sorted(rows) == ['a.txt', 'b.txt', 'c.txt']
+    for result in report.imported:
+        with stash.open_object(result.hash_string) as infile:
+            assert infile.read() == members[result.path]
+
+@pytest.mark.parametrize('kind', ['zip', 'tar', 'tar.gz', 'tar.xz'])
+def test_import_with_manifest(tmp_path, kind):
+    members = dict(NOTES, **{'manifest.json': json.dumps(MANIFEST).encode()})
+    path = str(tmp_path / ('notes.' + kind))
+    if kind == 'zip':
+        write_zip(path, members)
+    else:
+        write_tar(path, members, 'w:' + kind[4:])
+    stash = make_stash(tmp_path)
+    results = []
+    report = stash.import_archive(path, {'title': 'Note'}, 'manifest.json',
+                                  workers=3, batch_size=2,
+                                  callback=results.append)
+    assert results == report.results and len(results) == 4
+    check_import(stash, report, members)
+    titles = {row['filename']: row['title'] for row in stash.find_files('1')}
+    assert titles == {'a.txt': 'First', 'b.txt': 'Note', 'c.txt': 'Third'}
+    assert [row['filename'] for row in stash.find_files('1', ['old'])] == [
+        'c.txt']
+    # Importing the archive again finds only duplicates.
+    report = stash.import_archive(path, None, 'manifest.json')
+    assert len(report.duplicates) == 4 and not report.imported
+    stash.close()
+
+def test_metadata_function(tmp_path):
+    path = str(tmp_path / 'notes.tar')
+    write_tar(path, NOTES, 'w')
+    stash = make_stash(tmp_path)
+    report = stash.import_archive(path, lambda name: {'title': name})
+    check_import(stash, report, NOTES)
+    titles = {row['filename']: row['title'] for row in stash.find_files('1')}
+    assert titles == {'a.txt': 'notes/a.txt', 'b.txt': 'notes/b.txt',
+                      'c.txt': 'notes/old/c.txt'}
+    stash.close()
+
+def test_bad_archives(tmp_path):
+    stash = make_stash(tmp_path)
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'not an archive')
+    with pytest.raises(StashError):
+        stash.import_archive(str(path))
+    with pytest.raises(StashError):
+        stash.import_archive(str(tmp_path / 'missing.zip'))
+    path = str(tmp_path / 'notes.zip')
+    write_zip(path, dict(NOTES, **{'manifest.json': b'{not json'}))
+    with pytest.raises(StashError):
+        stash.import_archive(path, None, 'index.json')
+    with pytest.raises(StashError):
+        stash.import_archive(path, None, 'manifest.json')
+    assert stash.find_files('1') == []
+    stash.close()
@@ -0,0 +1,36 @@
+from stash.stash import Stash
+
+def test_changes_from_another_stash(tmp_path):
+    first = Stash()
+    first.create(str(tmp_path / 'stash'))
+    first.add_field('red', 'keyword')
+    first.add_field('blue', 'keyword')
+    second = Stash()
+    second.open(str(tmp_path / 'stash'))
+    source = tmp_path / 'note.txt'
+    source.write_text('note')
+    first.insert_file(str(source), {'keywords': ['red']})
+    assert len(first.find_files('1', ['red'])) == 1
+    hash_string = second.find_files('1')[0]['hash']
+    second.set_fields({'hash': hash_string, 'keywords': ['blue']})
+    assert first.find_files('1', ['red']) == []
+    assert len(first.find_files('1', ['blue'])) == 1
+    assert len(first.find_files('1', no_keywords=['red'])) == 1
+    first.close()
+    second.close()
+
+def test_where_clause_scope_with_keywords(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.add_field('type', 'text')
+    stash.add_field('red', 'keyword')
+    for name, kind in (('memo.txt', 'memo'), ('list.txt', 'list')):
+        source = tmp_path / name
+        source.write_text(name)
+        stash.insert_file(str(source), {'type': kind, 'keywords': ['red']})
+    rows = stash.find_files("type = 'memo'", ['red'])
+    assert [row['filename'] for row in rows] == ['memo.txt']
+    rows = stash.find_files("type = 'memo' or type = 'list' order by type",
+                            all_keywords=['red'])
+    assert [row['filename'] for row in rows] == ['list.txt', 'memo.txt']
+    stash.close()
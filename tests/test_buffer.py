@@ -0,0 +1,16 @@
+import os
+from stash.stash import Stash
+
+def test_buffer_does_not_fill_hot_cache(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.use_hot_cache(str(tmp_path / 'hot'), max_bytes=1 << 20)
+    source = tmp_path / 'note.txt'
+    source.write_bytes(b'note' * 1000)
+    stash.insert_file(str(source), None)
+    hash_string = stash.find_files('1')[0]['hash']
+    view = stash.object_buffer(hash_string)
+    assert view == source.read_bytes()
+    view.release()
+    assert os.listdir(str(tmp_path / 'hot')) == []
+    stash.close()
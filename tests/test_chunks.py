@@ -0,0 +1,68 @@
+import io
+import hashlib
+import pytest
+from stash.chunks import Chunker, chunk_key
+from stash.stash import Stash
+
+def pseudorandom(count, seed=b''):
+    return b''.join(hashlib.sha256(seed + b'%d' % n).digest()
+                    for n in range(count))
+
+def test_boundaries_are_fixed():
+    # The boundaries of stored objects depend on these, so they must
+    # never change.
+    data = pseudorandom(1 << 15)
+    chunks = list(Chunker().chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert [len(chunk) for chunk in chunks] == [185752, 41072, 163030,
+        209359, 45384, 126491, 158244, 33215, 86029]
+    assert chunk_key(chunks[0]) == 'D7GJgal72XkPssbkeBkCF1BqEjH'
+
+def test_sizes_and_insertions():
+    chunker = Chunker(min_size=1024, avg_size=4096, max_size=16384)
+    data = pseudorandom(1 << 13)
+    chunks = list(chunker.chunks(io.BytesIO(data)))
+    assert all(1024 <= len(chunk) <= 16384 for chunk in chunks[:-1])
+    edited = data[:100] + b'inserted' + data[100:]
+    edited_chunks = list(chunker.chunks(io.BytesIO(edited)))
+    assert b''.join(edited_chunks) == edited
+    unchanged = set(map(chunk_key, chunks)) & set(map(chunk_key,
+                                                      edited_chunks))
+    assert len(unchanged) >= len(chunks) - 2
+    with pytest.raises(ValueError):
+        Chunker(min_size=16384, max_size=1024)
+
+def test_chunk_storage(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'), storage='chunks')
+    source = tmp_path / 'source'
+    source.mkdir()
+    data = pseudorandom(1 << 14)
+    (source / 'first.bin').write_bytes(data)
+    (source / 'second.bin').write_bytes(data[:100] + b'edit' + data[100:])
+    (source / 'copy.bin').write_bytes(data)
+    report = stash.import_tree(str(source), workers=1)
+    assert len(report.imported) == 2 and len(report.duplicates) == 1
+    assert not any(stash.tree.walk())
+    for row in stash.find_files('1'):
+        with stash.open_object(row['hash']) as infile:
+            assert infile.read() == (source / row['filename']).read_bytes()
+        manifest = stash.connection.execute(
+            'select seq from object_chunks where hash=? order by seq',
+            (row['hash'],)).fetchall()
+        assert [seq for seq, in manifest] == list(range(len(manifest)))
+    chunks = stash.connection.execute(
+        'select count(*), sum(refs) from chunks').fetchone()
+    manifests = stash.connection.execute(
+        'select count(*) from object_chunks').fetchone()
+    # The second file shares all but its first chunk with the first.
+    assert chunks[1] == manifests[0] and chunks[0] < manifests[0]
+    first = stash.find_files("filename != 'second.bin'")[0]['hash']
+    stash.delete_file(first)
+    garbage = stash.collect_garbage(grace=0)
+    assert garbage.dead_records > 0
+    second = stash.find_files("filename='second.bin'")[0]['hash']
+    with stash.open_object(second) as infile:
+        assert infile.read() == (source / 'second.bin').read_bytes()
+    assert stash.scrub(workers=1).clean
+    stash.close()
@@ -0,0 +1,112 @@
+import io
+import os
+import zlib
+import hashlib
+import pytest
+from stash.compression import (codecs, DecompressingReader, parse_rules,
+                               format_rules, choose_codec)
+from stash.stash import Stash
+
+TEXT = b''.join(b'line %d of a compressible note\n' % n for n in range(2000))
+
+def make_stash(tmp_path, codec, pack_threshold=0):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.set_compression(codec)
+    stash.set_pack_threshold(pack_threshold)
+    return stash
+
+def stored(stash, hash_string):
+    return stash.connection.execute(
+        'select storage, codec, size from objects where hash=?',
+        (hash_string,)).fetchone()
+
+def check_object(stash, hash_string, data, tmp_path):
+    with stash.open_object(hash_string) as infile:
+        assert infile.read() == data
+    with open(stash.object_path(hash_string), 'rb') as infile:
+        assert infile.read() == data
+    export = str(tmp_path / 'export')
+    stash.export_file(hash_string, export)
+    with open(export, 'rb') as infile:
+        assert infile.read() == data
+    os.unlink(export)
+
+@pytest.mark.parametrize('codec', (None,) + codecs)
+@pytest.mark.parametrize('pack_threshold', [0, 1 << 20])
+@pytest.mark.parametrize('single_pass', [False, True])
+def test_insert_file(tmp_path, codec, pack_threshold, single_pass):
+    stash = make_stash(tmp_path, codec, pack_threshold)
+    source = tmp_path / 'note.txt'
+    source.write_bytes(TEXT)
+    stash.insert_file(str(source), None, single_pass=single_pass)
+    hash_string = stash.find_files('1')[0]['hash']
+    storage, stored_codec, size = stored(stash, hash_string)
+    assert storage == ('packed' if pack_threshold else None)
+    assert stored_codec == codec and size == len(TEXT)
+    if codec and not pack_threshold:
+        assert os.path.getsize(stash._stored_path(hash_string)) < len(TEXT)
+    check_object(stash, hash_string, TEXT, tmp_path)
+    with pytest.raises(ValueError):
+        stash.insert_file(str(source), None, single_pass=single_pass)
+    assert stash.scrub(workers=1).clean
+    stash.close()
+
+@pytest.mark.parametrize('codec', (None,) + codecs)
+def test_import_and_stream(tmp_path, codec):
+    stash = make_stash(tmp_path, codec)
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'note.txt').write_bytes(TEXT)
+    (source / 'copy.txt').write_bytes(TEXT)
+    (source / 'other.txt').write_bytes(TEXT + b'more')
+    report = stash.import_tree(str(source), workers=2)
+    assert len(report.imported) == 2 and len(report.duplicates) == 1
+    hash_string = stash.insert_stream(io.BytesIO(TEXT + b'streamed'),
+                                      'streamed.txt')
+    assert stored(stash, hash_string)[1] == codec
+    check_object(stash, hash_string, TEXT + b'streamed', tmp_path)
+    for row in stash.find_files("filename != 'streamed.txt'"):
+        assert stored(stash, row['hash'])[1] == codec
+        check_object(stash, row['hash'],
+                     (source / row['filename']).read_bytes(), tmp_path)
+    stash.close()
+
+def test_codec_choice(tmp_path):
+    stash = make_stash(tmp_path, 'zlib')
+    stash.set_compression('zlib', {'.csv': 'lzma', '.log': None})
+    noise = b''.join(hashlib.sha256(b'%d' % n).digest() for n in range(1000))
+    files = {name: TEXT + name.encode()
+             for name in ('a.csv', 'a.log', 'a.jpg', 'a.txt')}
+    files['noise.txt'] = noise
+    expected = {'a.csv': 'lzma', 'a.log': None, 'a.jpg': None,
+                'a.txt': 'zlib', 'noise.txt': None}
+    for name, data in files.items():
+        source = tmp_path / name
+        source.write_bytes(data)
+        stash.insert_file(str(source), None)
+    for row in stash.find_files('1'):
+        assert stored(stash, row['hash'])[1] == expected[row['filename']]
+        check_object(stash, row['hash'], files[row['filename']], tmp_path)
+    stash.close()
+
+def test_rules():
+    rules = parse_rules('.CSV=lzma,.jpg=none')
+    assert rules == {'.csv': 'lzma', '.jpg': None}
+    assert parse_rules(format_rules(rules)) == rules
+    assert choose_codec('.Csv', 'zlib', rules) == 'lzma'
+    assert choose_codec('.jpg', 'zlib', rules) is None
+    assert choose_codec('.png', 'zlib', {}) is None
+    assert choose_codec('.txt', None, {}) is None
+
+def test_bounded_and_truncated_reads(monkeypatch):
+    monkeypatch.setattr(DecompressingReader, 'BLOCK_SIZE', 1000)
+    data = bytes(1 << 20)
+    compressed = zlib.compress(data)
+    reader = DecompressingReader(io.BytesIO(compressed), 'zlib')
+    pieces = iter(lambda: reader.read(1 << 16), b'')
+    assert b''.join(pieces) == data
+    reader = io.BufferedReader(DecompressingReader(
+        io.BytesIO(compressed[:len(compressed) // 2]), 'zlib'))
+    with pytest.raises(OSError):
+        reader.read()
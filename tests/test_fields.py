@@ -0,0 +1,74 @@
+from stash.stash import Stash
+
+def make_stash(tmp_path, count):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.add_field('title', 'text')
+    stash.add_field('year', 'integer')
+    for keyword in ('red', 'green', 'blue'):
+        stash.add_field(keyword, 'keyword')
+    source = tmp_path / 'source'
+    source.mkdir()
+    records = []
+    for n in range(count):
+        filename = source / ('note%d.txt' % n)
+        filename.write_text('note %d' % n)
+        records.append((str(filename), {'title': 'Note %d' % n,
+            'year': 2000 + n, 'keywords': ['red'] if n % 2 else []}))
+    report = stash.insert_files(records, workers=2, batch_size=4)
+    assert len(report.imported) == count
+    return stash
+
+def links(stash):
+    query = """select files.filename, keywords._keyword from keyword_x_file
+               join files on keyword_x_file._file_id=files._file_id
+               join keywords on keyword_x_file._keyword_id=keywords._keyword_id
+               order by files.filename, keywords._keyword"""
+    return [tuple(row) for row in stash.connection.execute(query)]
+
+def names(rows):
+    return sorted(row['filename'] for row in rows)
+
+def test_insert_files(tmp_path):
+    stash = make_stash(tmp_path, 10)
+    rows = {row['filename']: row for row in stash.find_files('1')}
+    assert len(rows) == 10
+    for n in range(10):
+        row = rows['note%d.txt' % n]
+        assert row['title'] == 'Note %d' % n and row['year'] == 2000 + n
+    assert links(stash) == [('note%d.txt' % n, 'red') for n in (1, 3, 5, 7, 9)]
+    assert names(stash.find_files('year > 2007')) == ['note8.txt',
+                                                      'note9.txt']
+    stash.close()
+
+def test_set_fields_many(tmp_path):
+    stash = make_stash(tmp_path, 4)
+    hashes = {row['filename']: row['hash'] for row in stash.find_files('1')}
+    stash.set_fields_many([
+        {'hash': hashes['note0.txt'], 'keywords': ['green', 'blue']},
+        {'hash': hashes['note1.txt'], 'keywords': ['red', 'blue']},
+        {'hash': hashes['note2.txt'], 'title': 'Renamed', 'year': 1999},
+        {'hash': hashes['note3.txt'], 'keywords': [], 'title': 'Plain'},
+        {'hash': 'unknown', 'title': 'Ignored', 'keywords': ['red']}])
+    assert links(stash) == [('note0.txt', 'blue'), ('note0.txt', 'green'),
+                            ('note1.txt', 'blue'), ('note1.txt', 'red')]
+    assert names(stash.find_files('1', ['blue'])) == ['note0.txt',
+                                                      'note1.txt']
+    assert names(stash.find_files('1', ['red'])) == ['note1.txt']
+    assert names(stash.find_files('1', all_keywords=['green', 'blue'])) == [
+        'note0.txt']
+    assert names(stash.find_files('1', no_keywords=['blue'])) == [
+        'note2.txt', 'note3.txt']
+    rows = {row['filename']: row for row in stash.find_files('1')}
+    assert rows['note2.txt']['title'] == 'Renamed'
+    assert rows['note2.txt']['year'] == 1999
+    assert rows['note3.txt']['title'] == 'Plain'
+    assert stash.find_files("title = 'Ignored'") == []
+    # Records whose keywords have not changed write nothing.
+    changes = stash.connection.total_changes
+    stash.set_fields_many([
+        {'hash': hashes['note0.txt'], 'keywords': ['blue', 'green']},
+        {'hash': hashes['note3.txt'], 'keywords': []}])
+    assert stash.connection.total_changes == changes
+    assert len(links(stash)) == 4
+    stash.close()
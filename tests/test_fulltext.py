@@ -0,0 +1,112 @@
+import pytest
+from stash.fulltext import fts_available, fts_columns
+from stash.stash import Stash
+
+NOTES = {
+    'apples.txt': ('Apple harvest', 'apples, apples and more apples'),
+    'orchard.txt': ('Orchard', 'an apple tree'),
+    'cafe.txt': ('Café notes', 'coffee and an applesauce cake'),
+    'memo.txt': ('Memo', 'nothing to see'),
+}
+
+def make_stash(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    if not stash.full_text:
+        stash.close()
+        pytest.skip('sqlite was built without FTS5')
+    stash.add_field('title', 'text')
+    stash.add_field('body', 'text')
+    stash.add_field('year', 'integer')
+    for name, (title, body) in NOTES.items():
+        source = tmp_path / name
+        source.write_text(name)
+        stash.insert_file(str(source), {'title': title, 'body': body,
+                                        'year': 2020})
+    return stash
+
+def search(stash, filters, any_term=False):
+    rows = stash.find_files(stash.match_clause(filters, any_term))
+    return sorted(row['filename'] for row in rows)
+
+def test_search(tmp_path):
+    stash = make_stash(tmp_path)
+    assert fts_columns(stash.connection) == ['filename', 'title', 'body']
+    assert search(stash, [(None, 'appl')]) == [
+        'apples.txt', 'cafe.txt', 'orchard.txt']
+    assert search(stash, [('title', 'apple')]) == ['apples.txt']
+    assert search(stash, [('body', 'apple'), ('body', 'tree')]) == [
+        'orchard.txt']
+    assert search(stash, [('title', 'memo'), ('body', 'coffee')],
+                  any_term=True) == ['cafe.txt', 'memo.txt']
+    # Diacritics are ignored and other columns are matched with like.
+    assert search(stash, [('title', 'cafe')]) == ['cafe.txt']
+    assert search(stash, [('year', '202'), (None, 'memo')]) == ['memo.txt']
+    assert search(stash, [(None, 'pear')]) == []
+    assert stash.match_clause([]) == '1'
+    stash.close()
+
+def test_rank(tmp_path):
+    stash = make_stash(tmp_path)
+    rows = stash.find_files('1', rank=[(None, 'tree')])
+    assert [row['filename'] for row in rows] == ['orchard.txt']
+    rows = stash.find_files('1', rank=[(None, 'apple')])
+    assert rows[0]['filename'] == 'apples.txt' and len(rows) == 3
+    rows = stash.find_files('year = 2020', rank=[('body', 'apple'),
+                                                 ('body', 'coffee')])
+    # The only file matching both terms ranks first.
+    assert rows[0]['filename'] == 'cafe.txt'
+    assert sorted(row['filename'] for row in rows) == [
+        'apples.txt', 'cafe.txt', 'orchard.txt']
+    # Columns which are not indexed are left out of the ranking.
+    rows = stash.find_files('1', rank=[('year', '2020'), (None, 'tree')])
+    assert [row['filename'] for row in rows] == ['orchard.txt']
+    stash.close()
+
+def test_updates(tmp_path):
+    stash = make_stash(tmp_path)
+    hash_string = stash.find_files("filename = 'memo.txt'")[0]['hash']
+    stash.set_fields({'hash': hash_string, 'body': 'a pear'})
+    assert search(stash, [(None, 'pear')]) == ['memo.txt']
+    assert search(stash, [(None, 'nothing')]) == []
+    stash.close()
+
+def test_rebuild_on_field_changes(tmp_path):
+    stash = make_stash(tmp_path)
+    # Files stored before a text field is added are indexed when it is.
+    stash.add_field('summary', 'text')
+    assert fts_columns(stash.connection) == ['filename', 'title', 'body',
+                                             'summary']
+    hash_string = stash.find_files("filename = 'memo.txt'")[0]['hash']
+    stash.set_fields({'hash': hash_string, 'summary': 'zebra crossing'})
+    assert search(stash, [('summary', 'zeb')]) == ['memo.txt']
+    assert search(stash, [(None, 'tree')]) == ['orchard.txt']
+    # Adding a field which is not text leaves the index alone.
+    stash.add_field('pages', 'integer')
+    assert 'pages' not in fts_columns(stash.connection)
+    field = next(field for field in stash.fields if field.name == 'body')
+    stash.delete_field(field)
+    assert fts_columns(stash.connection) == ['filename', 'title', 'summary']
+    assert search(stash, [(None, 'coffee')]) == []
+    assert search(stash, [(None, 'zebra'), ('title', 'memo')]) == ['memo.txt']
+    stash.set_fields({'hash': hash_string, 'title': 'Errand'})
+    assert search(stash, [('title', 'errand')]) == ['memo.txt']
+    assert search(stash, [('title', 'memo')]) == []
+    # A reopened stash finds the same index.
+    reopened = Stash()
+    reopened.open(str(tmp_path / 'stash'))
+    assert reopened.full_text == fts_available(reopened.connection)
+    assert search(reopened, [(None, 'errand')]) == ['memo.txt']
+    reopened.close()
+    stash.close()
+
+def test_without_fts(tmp_path):
+    stash = make_stash(tmp_path)
+    stash.full_text = False
+    assert search(stash, [(None, 'apple')]) == [
+        'apples.txt', 'cafe.txt', 'orchard.txt']
+    assert search(stash, [('title', 'memo'), ('body', 'coffee')],
+                  any_term=True) == ['cafe.txt', 'memo.txt']
+    rows = stash.find_files('1', rank=[(None, 'apple')])
+    assert len(rows) == 4
+    stash.close()
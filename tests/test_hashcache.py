@@ -0,0 +1,78 @@
+import os
+from stash import hashcache
+from stash.hashcache import HashCache
+from stash.stash import Stash
+import stash.stash as stash_module
+
+def count_hashing(monkeypatch):
+    calls = []
+    hash_file_all = hashcache.hash_file_all
+    def counted(filename, algorithms):
+        calls.append(filename)
+        return hash_file_all(filename, algorithms)
+    monkeypatch.setattr(hashcache, 'hash_file_all', counted)
+    return calls
+
+def test_hits_and_changes(tmp_path, monkeypatch):
+    calls = count_hashing(monkeypatch)
+    cache = HashCache(str(tmp_path / 'cache.sqlite'))
+    filename = tmp_path / 'note.txt'
+    filename.write_text('note')
+    first = cache.hash_file(str(filename), ['md5', 'blake2b-32'])
+    assert cache.hash_file(str(filename), ['md5', 'blake2b-32']) == first
+    assert len(calls) == 1
+    # A missing algorithm is a miss.
+    cache.hash_file(str(filename), ['md5', 'sha256'])
+    assert len(calls) == 2
+    filename.write_text('changed')
+    os.utime(str(filename), ns=(0, 10**18))
+    changed = cache.hash_file(str(filename), ['md5', 'blake2b-32'])
+    assert changed != first and len(calls) == 3
+    cache.close()
+
+def test_eviction(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = HashCache(path, max_entries=2, max_age=3600)
+    for n in range(4):
+        filename = tmp_path / ('note%d.txt' % n)
+        filename.write_text('note %d' % n)
+        cache.hash_file(str(filename), ['md5'])
+    # Make the first note expired and the second one least recently used.
+    rows = cache.connection.execute(
+        'select rowid from hashes order by rowid').fetchall()
+    cache.connection.execute('update hashes set used=0 where rowid=?',
+                             rows[0])
+    cache.connection.execute('update hashes set used=used-100 where rowid=?',
+                             rows[1])
+    cache.commit()
+    cache.close()
+    cache = HashCache(path)
+    stats = [os.stat(str(tmp_path / ('note%d.txt' % n))) for n in range(4)]
+    assert [cache.lookup(stat, ['md5']) is not None for stat in stats] == [
+        False, False, True, True]
+    cache.close()
+
+def test_import_uses_cache(tmp_path, monkeypatch):
+    calls = []
+    import_work = stash_module._import_work
+    def counted(job, **kwargs):
+        calls.append(job)
+        return import_work(job, **kwargs)
+    monkeypatch.setattr(stash_module, '_import_work', counted)
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.use_hash_cache()
+    source = tmp_path / 'source'
+    source.mkdir()
+    for n in range(5):
+        (source / ('note%d.txt' % n)).write_text('note %d' % n)
+    report = stash.import_tree(str(source), workers=1)
+    assert len(report.imported) == 5 and len(calls) == 5
+    cache = HashCache(os.path.join(stash.stashdir, 'hashcache.stash'))
+    for row in stash.find_files('1'):
+        stat = os.stat(str(source / row['filename']))
+        assert cache.lookup(stat, [stash.tree.algorithm]) == [row['hash']]
+    cache.close()
+    report = stash.import_tree(str(source), workers=1)
+    assert len(report.duplicates) == 5 and len(calls) == 5
+    stash.close()
@@ -0,0 +1,76 @@
+import hashlib
+import pytest
+from stash import hashing
+from stash.hashing import TreeHasher, new_hasher, encode
+
+def pseudorandom(count, seed=b''):
+    return b''.join(hashlib.sha256(seed + b'%d' % n).digest()
+                    for n in range(count))
+
+def treehash(algorithm, data):
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return encode(hasher)
+
+def test_treehash_is_fixed():
+    # Stored hash strings depend on the leaf size and the personalization
+    # strings, so these digests must never change.
+    data = pseudorandom(300000)
+    assert treehash('treehash', b'') == (
+        'q5XeWITMr3r11WjbFe9JIY0ff51FoX5yfkNdGdibHem')
+    assert treehash('treehash', b'stash') == (
+        'kRSC4DPvr0OS3lbQy7ps6fN80emUCLp4G4v1DQms98')
+    assert treehash('treehash', data[:TreeHasher.LEAF_SIZE]) == (
+        'ZRO8JvUnOYt6ggI9kiBH5e0Q3oM6hIFtloI9d37oTom')
+    assert treehash('treehash', data) == (
+        'ZGJtt7a35JO4d0B24KVCMIfydTdHn5vxag2KkzfPnhO')
+    assert treehash('treehash-20', b'stash') == 'RRlSCYS8Zu6iMmpIFwquUJgE1PH'
+
+def test_treehash_definition():
+    data = pseudorandom(300000)
+    leaf_size = 1 << 22
+    leaves = [data[start:start + leaf_size]
+              for start in range(0, len(data), leaf_size)]
+    root = hashlib.blake2b(digest_size=32, person=b'stash-root')
+    for leaf in leaves:
+        root.update(hashlib.blake2b(leaf, digest_size=32,
+                                    person=b'stash-leaf').digest())
+    root.update(len(data).to_bytes(8, 'big'))
+    hasher = new_hasher('treehash')
+    hasher.update(data)
+    assert len(leaves) == 3
+    assert hasher.digest() == root.digest()
+
+def test_treehash_updates():
+    data = pseudorandom(300000)
+    expected = treehash('treehash', data)
+    for size in (1000, 1 << 20, (1 << 22) + 1, 5 << 20):
+        hasher = new_hasher('treehash')
+        for start in range(0, len(data), size):
+            hasher.update(data[start:start + size])
+        assert encode(hasher) == expected
+
+def test_treehash_files(tmp_path):
+    data = pseudorandom(300000)
+    filename = tmp_path / 'data'
+    filename.write_bytes(data)
+    expected = treehash('treehash', data)
+    assert hashing.hash_file(filename, 'treehash') == expected
+    with open(filename, 'rb') as infile:
+        assert hashing.hash_stream(infile, ['md5', 'treehash']) == [
+            encode(hashlib.md5(data)), expected]
+    # Memory mapped files give the same digests.
+    old_threshold = hashing.mmap_threshold
+    hashing.configure(mmap_threshold=0)
+    try:
+        assert hashing.hash_file(filename, 'treehash') == expected
+    finally:
+        hashing.configure(mmap_threshold=old_threshold)
+
+def test_digest_sizes():
+    assert len(new_hasher('treehash').digest()) == 32
+    assert len(new_hasher('treehash-20').digest()) == 20
+    assert len(new_hasher('treehash-64').digest()) == 64
+    for algorithm in ('treehash-8', 'treehash-65', 'md5-20', 'nohash'):
+        with pytest.raises(ValueError):
+            new_hasher(algorithm)
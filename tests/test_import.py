@@ -0,0 +1,25 @@
+import pytest
+from stash.stash import Stash
+
+@pytest.mark.parametrize('storage', ['tree', 'chunks'])
+def test_no_transaction_while_storing(tmp_path, storage):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.set_storage(storage)
+    stash.set_pack_threshold(1000)
+    source = tmp_path / 'source'
+    source.mkdir()
+    for n in range(10):
+        (source / ('note%d.txt' % n)).write_bytes(b'note %d ' % n * 200 * n)
+    def check(result):
+        assert result.status == 'imported'
+        assert not stash.connection.in_transaction
+    report = stash.import_tree(str(source), workers=1, batch_size=4,
+                               callback=check)
+    assert len(report.imported) == 10
+    for hash_string, filename in stash.connection.execute(
+            'select hash, filename from files'):
+        with stash.open_object(hash_string) as infile:
+            assert infile.read() == (source / filename).read_bytes()
+    assert not stash.scrub(workers=1).corrupt
+    stash.close()
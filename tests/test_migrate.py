@@ -0,0 +1,29 @@
+import os
+import time
+from stash.stash import Stash
+
+def test_garbage_collection_during_migration(tmp_path, monkeypatch):
+    first = Stash()
+    first.create(str(tmp_path / 'stash'))
+    second = Stash()
+    second.open(str(tmp_path / 'stash'))
+    source = tmp_path / 'note.txt'
+    source.write_text('note')
+    first.insert_file(str(source), None)
+    old_hash = first.find_files('1')[0]['hash']
+    long_ago = time.time() - 86400
+    os.utime(first._stored_path(old_hash), (long_ago, long_ago))
+    first.set_hash_algorithm('treehash')
+    link = os.link
+    def link_and_collect(source, destination):
+        # Another stash collects garbage before the new hash is recorded.
+        link(source, destination)
+        second.collect_garbage()
+    monkeypatch.setattr(os, 'link', link_and_collect)
+    assert first.migrate_hashes() == 1
+    new_hash = first.find_files('1')[0]['hash']
+    assert new_hash != old_hash
+    with first.open_object(new_hash) as infile:
+        assert infile.read() == b'note'
+    first.close()
+    second.close()
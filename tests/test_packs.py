@@ -0,0 +1,76 @@
+import sqlite3
+from stash.stash import Stash
+from stash.packs import PackStore, pack_schema
+
+def make_stashes(tmp_path):
+    first = Stash()
+    first.create(str(tmp_path / 'stash'))
+    first.set_pack_threshold(1000)
+    second = Stash()
+    second.open(str(tmp_path / 'stash'))
+    return first, second
+
+def test_alternating_appends(tmp_path):
+    first, second = make_stashes(tmp_path)
+    source = tmp_path / 'source'
+    source.mkdir()
+    contents = {}
+    for n in range(20):
+        filename = source / ('note%02d.txt' % n)
+        filename.write_bytes(b'note %d ' % n * (n + 1))
+        stash = second if n % 2 else first
+        stash.insert_file(str(filename), None)
+        contents[filename.name] = filename.read_bytes()
+    for stash in (first, second):
+        rows = stash.connection.execute(
+            'select hash, filename from files').fetchall()
+        assert len(rows) == 20
+        for hash_string, filename in rows:
+            with stash.open_object(hash_string) as infile:
+                assert infile.read() == contents[filename]
+    report = first.scrub(workers=1)
+    assert not report.corrupt
+    first.close()
+    second.close()
+
+def test_pack_objects_uses_raw_size(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    stash.set_compression('zlib')
+    small, large = tmp_path / 'small.txt', tmp_path / 'large.txt'
+    small.write_bytes(b'small ' * 100)
+    large.write_bytes(b'large ' * 1000)
+    stash.insert_file(str(small), None)
+    stash.insert_file(str(large), None)
+    stash.set_pack_threshold(1000)
+    assert stash.pack_objects() == 1
+    rows = stash.connection.execute(
+        'select files.filename, objects.storage from files join objects '
+        'on files.hash=objects.hash').fetchall()
+    assert dict(rows) == {'small.txt': 'packed', 'large.txt': None}
+    stash.close()
+
+def test_pack_numbers_are_not_reused(tmp_path):
+    database = str(tmp_path / 'db.stash')
+    directory = str(tmp_path / 'packs')
+    stores = []
+    for n in range(3):
+        connection = sqlite3.connect(database)
+        connection.execute(pack_schema('packed'))
+        stores.append(PackStore(directory, connection, 'packed',
+                                pack_size=100))
+    first, second, third = stores
+    first.put('one', b'1' * 80)
+    first.put('two', b'2' * 80)
+    first.connection.commit()
+    assert second.get('two') == b'2' * 80
+    first.release('two')
+    first.connection.commit()
+    first.compact()
+    third.put('three', b'3' * 80)
+    third.connection.commit()
+    assert second.get('three') == b'3' * 80
+    assert second.get('one') == b'1' * 80
+    for store in stores:
+        store.close()
+        store.connection.close()
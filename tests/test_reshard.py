@@ -0,0 +1,80 @@
+import os
+import pytest
+from stash.stash import Stash, StashError
+
+def test_insert_by_stash_opened_before_reshard(tmp_path):
+    first = Stash()
+    first.create(str(tmp_path / 'stash'))
+    second = Stash()
+    second.open(str(tmp_path / 'stash'))
+    source = tmp_path / 'old.txt'
+    source.write_text('old')
+    first.insert_file(str(source), None)
+    first.reshard((2, 2))
+    source = tmp_path / 'new.txt'
+    source.write_text('new')
+    second.insert_file(str(source), None)
+    third = Stash()
+    third.open(str(tmp_path / 'stash'))
+    for row in third.find_files('1'):
+        with third.open_object(row['hash']) as infile:
+            assert infile.read() == (tmp_path / row['filename']).read_bytes()
+    report = third.scrub(workers=1)
+    assert not report.missing and not report.corrupt
+    for stash in (first, second, third):
+        stash.close()
+
+def make_stash(tmp_path, count=20, layout=(1, 2)):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'), layout=layout)
+    source = tmp_path / 'source'
+    source.mkdir()
+    contents = {}
+    for n in range(count):
+        filename = source / ('note%02d.txt' % n)
+        filename.write_text('note %d' % n)
+        stash.insert_file(str(filename), None)
+        contents[filename.name] = filename.read_bytes()
+    return stash, contents
+
+def check_contents(stash, contents):
+    rows = stash.find_files('1')
+    assert len(rows) == len(contents)
+    for row in rows:
+        with stash.open_object(row['hash']) as infile:
+            assert infile.read() == contents[row['filename']]
+
+def test_layout(tmp_path):
+    stash, contents = make_stash(tmp_path, 3, layout=(2, 3))
+    for row in stash.find_files('1'):
+        hash_string = row['hash']
+        path = stash._stored_path(hash_string)
+        assert path == os.path.join(stash.tree.root, hash_string[:3],
+            hash_string[3:6], hash_string + '.txt')
+        assert os.path.isfile(path)
+    stash.close()
+
+def test_interrupted_reshard(tmp_path):
+    stash, contents = make_stash(tmp_path)
+    moved = []
+    def interrupt(path):
+        moved.append(path)
+        if len(moved) == 5:
+            raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        stash.reshard((2, 1), callback=interrupt)
+    assert stash.get_setting('old_layout') == '1,2'
+    check_contents(stash, contents)
+    with pytest.raises(StashError):
+        stash.reshard((3, 1))
+    assert stash.reshard() == len(contents) - 5
+    assert stash.get_setting('old_layout') is None
+    assert stash.tree.layout == (2, 1)
+    paths = [path for _, _, path in stash.tree.walk()]
+    assert len(paths) == len(contents)
+    for path in paths:
+        name = os.path.basename(path)
+        assert path == os.path.join(stash.tree.root, name[0], name[1], name)
+    check_contents(stash, contents)
+    assert stash.reshard((2, 1)) == 0
+    stash.close()
@@ -0,0 +1,64 @@
+import os
+import pytest
+from stash.stash import Stash
+
+def make_stash(tmp_path, count=10):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    source = tmp_path / 'source'
+    source.mkdir()
+    hashes = []
+    for n in range(count):
+        filename = source / ('note%02d.txt' % n)
+        filename.write_text('note %d' % n)
+        stash.insert_file(str(filename), None)
+        hashes.append(stash.find_files(
+            "filename='%s'" % filename.name)[0]['hash'])
+    return stash, hashes
+
+def test_clean_scrub(tmp_path):
+    stash, hashes = make_stash(tmp_path)
+    report = stash.scrub(workers=2)
+    assert report.clean and report.checked == len(hashes)
+    assert not report.resumed
+    assert stash.get_setting('scrub_finished') is not None
+    stash.close()
+
+def test_problems(tmp_path):
+    stash, hashes = make_stash(tmp_path)
+    corrupt, missing = hashes[2], hashes[5]
+    with open(stash._stored_path(corrupt), 'w') as outfile:
+        outfile.write('not the note')
+    os.unlink(stash._stored_path(missing))
+    orphan = stash.tree.path('Orphan0123456789abcdef', '.txt')
+    os.makedirs(os.path.dirname(orphan), exist_ok=True)
+    with open(orphan, 'w') as outfile:
+        outfile.write('orphan')
+    report = stash.scrub(workers=1)
+    assert [hash_string for hash_string, _ in report.corrupt] == [corrupt]
+    assert [hash_string for hash_string, _ in report.missing] == [missing]
+    assert report.orphaned == [orphan]
+    assert report.checked == len(hashes)
+    stash.close()
+
+def test_resume(tmp_path):
+    stash, hashes = make_stash(tmp_path)
+    with open(stash._stored_path(hashes[0]), 'w') as outfile:
+        outfile.write('not the note')
+    calls = []
+    def interrupt(hash_string, status, detail):
+        calls.append(hash_string)
+        if len(calls) == 5:
+            raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        stash.scrub(workers=1, batch_size=3, callback=interrupt)
+    report = stash.scrub(workers=1, batch_size=3)
+    assert report.resumed
+    assert report.checked == len(hashes) - 3
+    assert [hash_string for hash_string, _ in report.corrupt] == [hashes[0]]
+    report = stash.scrub(workers=1, batch_size=3)
+    assert not report.resumed and report.checked == len(hashes)
+    assert [hash_string for hash_string, _ in report.corrupt] == [hashes[0]]
+    report = stash.scrub(workers=1, restart=True)
+    assert not report.resumed and report.checked == len(hashes)
+    stash.close()
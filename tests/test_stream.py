@@ -0,0 +1,67 @@
+import io
+import os
+import sys
+import subprocess
+import pytest
+from stash.hashing import hash_file, partial_hash
+from stash.stash import Stash, StashError
+
+DATA = b''.join(b'record %d of a stream\n' % n for n in range(100000))
+
+def make_stash(tmp_path, storage='tree'):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'), storage=storage)
+    return stash
+
+def check_stream(stash, hash_string, data, tmp_path):
+    source = tmp_path / 'copy'
+    source.write_bytes(data)
+    assert hash_string == hash_file(str(source), stash.tree.algorithm)
+    size, partial = stash.connection.execute(
+        'select size, partial from objects where hash=?',
+        (hash_string,)).fetchone()
+    assert size == len(data) and partial == partial_hash(str(source))
+    with stash.open_object(hash_string) as infile:
+        assert infile.read() == data
+    # The recorded size and partial hash let the prefilter see copies.
+    assert not stash.prefilter(str(source))
+    os.unlink(source)
+
+@pytest.mark.parametrize('storage', ['tree', 'chunks'])
+def test_sources(tmp_path, storage):
+    stash = make_stash(tmp_path, storage)
+    stash.add_field('title', 'text')
+    hash_string = stash.insert_stream(io.BytesIO(DATA), 'file.txt',
+                                      {'title': 'A file'})
+    check_stream(stash, hash_string, DATA, tmp_path)
+    blocks = [DATA[n:n + 1000] + b'blocks' for n in range(0, 50000, 1000)]
+    hash_string = stash.insert_stream(iter(blocks), 'blocks.txt')
+    check_stream(stash, hash_string, b''.join(blocks), tmp_path)
+    command = [sys.executable, '-c',
+               'import sys; sys.stdout.buffer.write(b"piped" * 100000)']
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        hash_string = stash.insert_stream(process.stdout, 'piped.txt')
+    check_stream(stash, hash_string, b'piped' * 100000, tmp_path)
+    hash_string = stash.insert_stream([], 'empty.txt')
+    check_stream(stash, hash_string, b'', tmp_path)
+    rows = stash.find_files('1')
+    assert stash.find_files("title='A file'")[0]['filename'] == 'file.txt'
+    assert sorted(row['filename'] for row in rows) == [
+        'blocks.txt', 'empty.txt', 'file.txt', 'piped.txt']
+    assert stash.scrub(workers=1).clean
+    stash.close()
+
+def test_duplicates(tmp_path):
+    stash = make_stash(tmp_path)
+    source = tmp_path / 'file.txt'
+    source.write_bytes(DATA)
+    stash.insert_file(str(source), None)
+    with pytest.raises(StashError):
+        stash.insert_stream(io.BytesIO(DATA), 'again.txt')
+    # Data hashed with an older algorithm is also recognized.
+    stash.set_hash_algorithm('sha256')
+    with pytest.raises(StashError):
+        stash.insert_stream(io.BytesIO(DATA), 'again.txt')
+    assert os.listdir(stash.tree.tempdir) == []
+    assert [row['filename'] for row in stash.find_files('1')] == ['file.txt']
+    stash.close()
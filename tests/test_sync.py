@@ -0,0 +1,20 @@
+from stash.stash import Stash
+
+def test_sync(tmp_path):
+    stash = Stash()
+    stash.create(str(tmp_path / 'stash'))
+    source = tmp_path / 'source'
+    source.mkdir()
+    for n in range(8):
+        (source / ('note%d.txt' % n)).write_text('note %d' % n)
+    def check(result):
+        assert not stash.connection.in_transaction
+    report = stash.sync(str(source), workers=1, callback=check)
+    assert len(report.imported) == 8 and report.unchanged == 0
+    (source / 'note0.txt').write_text('changed')
+    (source / 'note8.txt').write_text('note 8')
+    report = stash.sync(str(source), workers=1, callback=check)
+    assert len(report.imported) == 2 and report.unchanged == 7
+    report = stash.sync(str(source), workers=1)
+    assert report.results == [] and report.unchanged == 9
+    stash.close()